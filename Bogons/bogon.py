@@ -1,9 +1,37 @@
 #!/usr/bin/env python
+import Queue
+import argparse
+import array
+import bz2
+import collections
+import contextlib
+import copy
+import cProfile
+import csv
+import errno
+import gzip
+import hashlib
+import itertools
+import heapq
+import httplib
+import json
+import mmap
+import operator
+import os
+import random
+import re
+import signal
+import socket
+import struct
 import subprocess
+import sys
 import syslog
+import threading
+import time
+import urlparse
+import zipfile
+import zlib
 from logging import *
-from urllib2 import *
-from netaddr import *
 from re import *
 """
 ---------------------------------------------------------------
@@ -12,14 +40,177 @@ from re import *
 ---------------------------------------------------------------
 
  ipset create ipv4Bogons hash:net family inet
+ ipset create ipv6Bogons hash:net family inet6
+
+ Sets are created by the updater with hashsize and maxelem sized for
+ the aggregated entries (twice the entries for maxelem, about one entry
+ per hash bucket). When a set can no longer hold the entries or its
+ hash falls far behind, it is rebuilt at the new size and swapped in.
+ -S/-shards N spreads the entries over N hash:net sets by their leading
+ address bits, joined under the set name by a list:set, so iptables
+ keeps matching one set. An existing set of the wrong type is left
+ alone and reported, it has to be destroyed by hand.
+
+ -L/-layout split keeps single addresses in a hash:ip set (one probe
+ per lookup) and networks in a hash:net set, joined by a list:set under
+ the set name. hash:net probes once per distinct prefix length, so rare
+ prefix lengths are expanded into the next longer length present (or
+ into hosts) while that adds no more than IPSET_PREFIX_GROWTH entries.
 
  iptables -I INPUT 1 -i eth0 -m set --match-set banned_ipv4_net src -j DROP
 
+ IPv4 and IPv6 entries are read from the same feeds in one pass and
+ applied to the set pair above (-i/-inet selects the families), a
+ missing set is created on first use.
+
+ FEED_SETS (or "sets") maps feeds to more named sets, e.g. Tor exits
+ into ipv4Tor/ipv6Tor next to everything in ipv4Bogons. Every feed is
+ still downloaded and parsed once per run, and the changes of all sets
+ are streamed into one "ipset restore" (not for -m single).
+
+ Feed formats (FEED_OPTIONS "format"):
+   scan     - every address or CIDR found anywhere on a line (default)
+   list     - the first field of each line only
+   spamhaus - DROP/EDROP lists, "net/len ; SBL..." lines
+   dshield  - block.txt "start end netblock ..." ranges
+   csv      - one column ("column", a name or index) or a start/end
+              column pair ("end_column") of a delimited file
+ gzip, bzip2 and zip bodies are detected by their magic bytes and
+ decompressed while streaming.
+
+ Settings can be overridden by a JSON config file (-c/-config):
+   {"urls": [...], "defaults": {...}, "feeds": {"<url>": {...}},
+    "exclude": ["<cidr>", "<address>", "<first>-<last>", ...],
+    "sets": {"<name>": {"feeds": ["<url>", ...] or null}}}
+
+ Excluded ranges (EXCLUDE_NETS or "exclude") are subtracted after
+ aggregation, a feed prefix covering an excluded range is split into
+ the fewest CIDRs around it.
+
+ Feeds are fetched over keep-alive connections pooled per host with
+ gzip/deflate transfer encoding, at most HTTP_MAX_REDIRECTS redirects
+ and "max_bytes" of decoded body. Bytes on the wire and decoded bytes
+ are logged per feed.
+
+ -D/-daemon keeps running, refreshes every feed on its own "interval"
+ (seconds, +/- "jitter" as a fraction) and only touches ipset when the
+ merged result changed. SIGHUP reloads the config file, SIGUSR1 forces
+ an immediate refresh of every feed, SIGTERM exits.
+
+ -J/-json and -T/-textfile write a report of every run (per stage
+ timings, per feed time/bytes/entries, aggregation ratio, diff size,
+ apply time and ipset calls) as JSON and as a node_exporter textfile,
+ -P/-profile dumps cProfile statistics of a one-shot run.
+
+ Apply modes (-m/-mode):
+   batch  - stream every add/del into a single "ipset restore" (default)
+   swap   - build a temporary set, swap it in atomically, destroy the old one
+   single - one ipset process per changed entry (legacy)
+
+ Every successful apply is recorded in a journal under the state
+ directory. Later runs diff against the journal and only list the
+ kernel set when its entry count no longer matches, runs with unchanged
+ feeds compare the counts too before they skip. "bogon.py -r"
+ reloads the journal into the set without downloading anything, run
+ it from /config/scripts/post-config.d to repopulate the set at boot.
+
+ -g/-grace-runs N and -G/-grace-time SECONDS keep entries which drop
+ out of the feeds blocked until they have been missing for N merges or
+ SECONDS (whichever lasts longer), feeds which drop and re-add the same
+ entries no longer churn the kernel set. New entries are added at once.
+ Last seen times are kept in <set>.grace in the state directory, while
+ entries are held runs with unchanged feeds still merge once the first
+ of them is due for release.
+
+ Every apply also writes <set>.index to the state directory, sorted
+ (start, end, feed bitmap, first seen) records of the blocked ranges.
+ "bogon.py -q <address> ..." (or "-q -" to read addresses from stdin)
+ answers from it which feeds block an address and since when, with a
+ binary search over the memory mapped file.
+
 ---------------------------------------------------------------
 """
 IPSET_PATH                     = "/sbin/ipset"
+APPLY_MODES                    = ("batch", "swap", "single")
+SET_LAYOUTS                    = ("net", "split")
+INET_BITS                      = {"ipv4": 32, "ipv6": 128}
+INET_MODES                     = {"ipv4": ("ipv4",), "ipv6": ("ipv6",), "dual": ("ipv4", "ipv6")}
 # IPV4_NETS_URL                = ["http://dshield.org/block.txt"]
 IPV4_NETS_URL                  = ["http://rules.emergingthreats.net/fwrules/emerging-Block-IPs.txt", "https://check.torproject.org/cgi-bin/TorBulkExitList.py?ip=1.1.1.1"]
+DOWNLOAD_WORKERS               = 4                            # parallel feed downloads
+DOWNLOAD_DEADLINE              = 300                          # seconds allowed for all feeds
+READ_CHUNK                     = 65536                        # bytes per socket read
+RECORD_CHUNK                   = 4096                         # records packed per write of journals and indexes
+HTTP_MAX_REDIRECTS             = 5                            # redirects followed per feed
+HTTP_POOL_SIZE                 = 2                            # idle keep-alive connections kept per host
+HTTP_IDLE_SECONDS              = 60                           # idle connections older than this are closed
+STATE_DIR                      = "/config/user-data/bogon"    # survives reboots and upgrades
+CONFIG_FILE                    = os.path.join(STATE_DIR, "bogon.conf")
+PID_FILE                       = "/var/run/bogon.pid"
+RETRY_INTERVAL                 = 300                          # daemon retry delay after a failed apply
+IPSET_HASHSIZE                 = 1024                         # smallest hashsize of a created set (kernel default)
+IPSET_MAXELEM                  = 65536                        # smallest maxelem of a created set (kernel default)
+IPSET_HEADROOM                 = 2                            # maxelem over entries when a set is created
+IPSET_HASHSIZE_LAG             = 4                            # rebuild when hashsize falls this far behind the entries
+IPSET_PREFIX_GROWTH            = 0.25                         # split layout: extra entries allowed to drop prefix lengths
+GRACE_RUNS                     = 0                            # keep dropped entries this many merges, 0 off
+GRACE_SECONDS                  = 0                            # keep dropped entries this many seconds, 0 off
+GRACE_FEED                     = "(grace period)"             # provenance index name of held ranges
+# Named sets, each kept per family as <inet><name> (ipv4Bogons,
+# ipv6Bogons), "feeds" lists the urls merged into the set, None all
+FEED_SETS                      = {
+    "Bogons"                   : {"feeds": None},
+}
+# Per feed settings, FEED_OPTIONS entries override FEED_DEFAULTS
+# connect_timeout also bounds every blocking socket read, read_timeout
+# bounds the whole body transfer
+FEED_DEFAULTS                  = {
+    "connect_timeout"          : 15,
+    "read_timeout"             : 120,
+    "format"                   : "scan",
+    "column"                   : 0,                           # csv address or range start column
+    "end_column"               : None,                        # csv range end column
+    "delimiter"                : ",",                         # csv field separator
+    "member"                   : None,                        # zip archive member, default the first file
+    "interval"                 : 86400,                       # daemon refresh period in seconds
+    "jitter"                   : 0.1,                         # +/- fraction of interval
+    "max_bytes"                : 256 << 20,                   # decoded body size limit
+}
+FEED_OPTIONS                   = {
+    "https://check.torproject.org/cgi-bin/TorBulkExitList.py?ip=1.1.1.1": {
+        "read_timeout"         : 240,
+        "format"               : "list",
+        "interval"             : 3600,
+    },
+    "http://rules.emergingthreats.net/fwrules/emerging-Block-IPs.txt": {
+        "format"               : "list",
+    },
+    # "http://feeds.dshield.org/block.txt": {
+    #     "format"             : "dshield",
+    # },
+    # "https://www.spamhaus.org/drop/drop.txt": {
+    #     "format"             : "spamhaus",
+    # },
+}
+# Allow list carved out of the merged feeds, CIDRs, addresses or
+# "first-last" ranges, e.g. our own prefixes and upstream resolvers
+EXCLUDE_NETS                   = [
+    # "203.0.113.0/24",
+    # "2001:db8::/32",
+    # "198.51.100.10-198.51.100.20",
+]
+BUILTIN_FEED_DEFAULTS          = copy.deepcopy(FEED_DEFAULTS)
+BUILTIN_FEED_OPTIONS           = copy.deepcopy(FEED_OPTIONS)
+BUILTIN_EXCLUDE_NETS           = list(EXCLUDE_NETS)
+BUILTIN_FEED_SETS              = copy.deepcopy(FEED_SETS)
+PARSE_OPTIONS                  = ("format", "column", "end_column", "delimiter", "member")  # feed settings shaping the parsed ranges
+COMPRESSION_MAGIC              = (("gzip", "\x1f\x8b"), ("bz2", "BZh"), ("zip", "PK\x03\x04"))
+RETOKEN                        = re.compile(r"[0-9A-Fa-f:.]*[:.][0-9A-Fa-f:.]*(?:/\d{1,3})?")  # IPv4 or IPv6 candidate
+RESETNAME                      = re.compile(r"^Name: (\S+)", re.M)
+RESETTYPE                      = re.compile(r"^Type: (\S+)", re.M)
+RESETCOUNT                     = re.compile(r"^Number of entries: (\d+)", re.M)
+RESETHASHSIZE                  = re.compile(r"\bhashsize (\d+)")
+RESETMAXELEM                   = re.compile(r"\bmaxelem (\d+)")
 #---------------------------------------------------------------
 syslog.openlog(ident="THREAT UPDATE", logoption=syslog.LOG_PID, facility=syslog.LOG_LOCAL0)
 
@@ -30,11 +221,645 @@ syslog.openlog(ident="THREAT UPDATE", logoption=syslog.LOG_PID, facility=syslog.
 #                     )
 
 #---------------------------------------------------------------
-def get_v4_ip_and_subnet_list(data):
+def feed_option(url, key):
+    """
+        Look up a per feed setting, falling back to FEED_DEFAULTS
+    """
+    return FEED_OPTIONS.get(url, {}).get(key, FEED_DEFAULTS[key])
+
+#---------------------------------------------------------------
+def load_config(filename):
+    """
+        Apply the optional JSON config file over the built in settings,
+        returns the feed url list (with every feed a set names) or
+        None if the file is unreadable
+    """
+    try:
+        with open(filename) as fh:
+            config             = json.load(fh)
+    except IOError as error:
+        if error.errno != errno.ENOENT:
+            syslog.syslog(syslog.LOG_ERR, "Cannot read config %s: %s" % (filename, error))
+            return None
+        config                 = dict()
+    except ValueError as error:
+        syslog.syslog(syslog.LOG_ERR, "Invalid config %s: %s" % (filename, error))
+        return None
+
+    FEED_DEFAULTS.clear()
+    FEED_DEFAULTS.update(copy.deepcopy(BUILTIN_FEED_DEFAULTS))
+    FEED_DEFAULTS.update(config.get("defaults", {}))
+    FEED_OPTIONS.clear()
+    FEED_OPTIONS.update(copy.deepcopy(BUILTIN_FEED_OPTIONS))
+    for url, options in config.get("feeds", {}).items():
+        FEED_OPTIONS.setdefault(url, {}).update(options)
+    EXCLUDE_NETS[:]            = [str(entry) for entry in config.get("exclude", BUILTIN_EXCLUDE_NETS)]
+    FEED_SETS.clear()
+    FEED_SETS.update(copy.deepcopy(config.get("sets", BUILTIN_FEED_SETS)))
+    urls                       = [str(url) for url in config.get("urls", IPV4_NETS_URL)]
+    for name, options in sorted(FEED_SETS.items()):
+        for url in options.get("feeds") or ():
+            if str(url) not in urls:
+                urls.append(str(url))
+    return urls
+
+#---------------------------------------------------------------
+def get_args():
+    parser                     = argparse.ArgumentParser(
+        description            = 'Download threat feeds and update the ipv4Bogons ipset.')
+
+    parser.add_argument(
+        '-m',
+        '-mode',
+        choices                = APPLY_MODES,
+        default                = "batch",
+        dest                   = 'apply_mode',
+        help                   = 'How changes are applied to the kernel set (default: %(default)s).')
+
+    parser.add_argument(
+        '-i',
+        '-inet',
+        choices                = sorted(INET_MODES),
+        default                = "dual",
+        dest                   = 'inet',
+        help                   = 'Address families to update (default: %(default)s).')
+
+    parser.add_argument(
+        '-w',
+        '-workers',
+        type                   = int,
+        default                = DOWNLOAD_WORKERS,
+        dest                   = 'workers',
+        help                   = 'Number of feeds downloaded in parallel (default: %(default)s).')
+
+    parser.add_argument(
+        '-d',
+        '-deadline',
+        type                   = int,
+        default                = DOWNLOAD_DEADLINE,
+        dest                   = 'deadline',
+        help                   = 'Seconds allowed for all feed downloads to finish (default: %(default)s).')
+
+    parser.add_argument(
+        '-S',
+        '-shards',
+        type                   = int,
+        default                = 1,
+        dest                   = 'shards',
+        help                   = 'Spread each family over this many hash:net sets joined by a list:set, a power of two (default: %(default)s).')
+
+    parser.add_argument(
+        '-L',
+        '-layout',
+        choices                = SET_LAYOUTS,
+        default                = "net",
+        dest                   = 'layout',
+        help                   = 'net keeps everything in one hash:net set, split moves hosts to a hash:ip set (default: %(default)s).')
+
+    parser.add_argument(
+        '-s',
+        '-state',
+        default                = STATE_DIR,
+        dest                   = 'state_dir',
+        help                   = 'Directory holding the feed cache and run state (default: %(default)s).')
+
+    parser.add_argument(
+        '-r',
+        '-restore',
+        action                 = "store_true",
+        default                = False,
+        dest                   = 'restore',
+        help                   = 'Reload the last applied entries from the journal into the set and exit, for use at boot; the sets get the shards and layout of the last update, whatever -S and -L say.')
+
+    parser.add_argument(
+        '-g',
+        '-grace-runs',
+        type                   = int,
+        default                = GRACE_RUNS,
+        dest                   = 'grace_runs',
+        help                   = 'Keep entries which dropped out of the feeds for this many runs, 0 deletes at once (default: %(default)s).')
+
+    parser.add_argument(
+        '-G',
+        '-grace-time',
+        type                   = int,
+        default                = GRACE_SECONDS,
+        dest                   = 'grace_seconds',
+        help                   = 'Keep entries which dropped out of the feeds for this many seconds, 0 deletes at once (default: %(default)s).')
+
+    parser.add_argument(
+        '-q',
+        '-query',
+        default                = None,
+        dest                   = 'query',
+        metavar                = 'ADDRESS',
+        nargs                  = '+',
+        help                   = 'Print which feeds block the given addresses and since when, "-" reads addresses from stdin.')
+
+    parser.add_argument(
+        '-c',
+        '-config',
+        default                = CONFIG_FILE,
+        dest                   = 'config',
+        help                   = 'JSON file overriding the feed list and feed settings (default: %(default)s).')
+
+    parser.add_argument(
+        '-D',
+        '-daemon',
+        action                 = "store_true",
+        default                = False,
+        dest                   = 'daemon',
+        help                   = 'Keep running and refresh every feed on its own interval.')
+
+    parser.add_argument(
+        '-J',
+        '-json',
+        default                = None,
+        dest                   = 'json_report',
+        help                   = 'Write a JSON report of every run to this file.')
+
+    parser.add_argument(
+        '-T',
+        '-textfile',
+        default                = None,
+        dest                   = 'prom_report',
+        help                   = 'Write run metrics to this node_exporter textfile collector file (*.prom).')
+
+    parser.add_argument(
+        '-P',
+        '-profile',
+        default                = None,
+        dest                   = 'profile',
+        help                   = 'Dump cProfile statistics of a one-shot run to this file.')
+
+    parser.add_argument(
+        '-f',
+        '-force',
+        action                 = "store_true",
+        default                = False,
+        dest                   = 'force',
+        help                   = 'Parse and apply the feeds even when none of them changed since the last run.')
+
+    args                       = parser.parse_args()
+    if args.shards < 1 or args.shards & (args.shards - 1):
+        parser.error("-shards must be a power of two")
+    return args
+
+#---------------------------------------------------------------
+def read_body_lines(filename, member=None):
+    """
+        Stream the lines of a cached feed body, gzip, bzip2 and zip
+        bodies are decompressed on the fly
+    """
+    with open(filename, "rb") as fh:
+        magic                  = fh.read(4)
+        fh.seek(0)
+        compression            = next((name for name, sig in COMPRESSION_MAGIC if magic.startswith(sig)), None)
+
+        if compression == "gzip":
+            stream             = gzip.GzipFile(fileobj=fh, mode="rb")
+        elif compression == "bz2":
+            stream             = bz2.BZ2File(filename)
+        elif compression == "zip":
+            archive            = zipfile.ZipFile(fh)
+            stream             = archive.open(member or next(name for name in archive.namelist() if not name.endswith("/")))
+        else:
+            stream             = fh
+
+        try:
+            for line in stream:
+                yield line
+        finally:
+            if stream is not fh:
+                stream.close()
+
+#---------------------------------------------------------------
+def iter_lines(fh, comments="#;"):
+    """
+        Yield the non comment part of every feed line
+    """
+    recomment                  = re.compile("[%s]" % re.escape(comments))
+    for line in fh:
+        line                   = recomment.split(line, 1)[0].strip()
+        if line:
+            yield line
+
+#---------------------------------------------------------------
+def iter_networks(lines):
+    """
+        Single pass over feed lines classifying every address token as
+        IPv4 or IPv6, yields (address bits, network int, prefix length)
+        triples, malformed tokens are skipped
+    """
+    unpack4                    = struct.Struct("!L").unpack
+    unpack6                    = struct.Struct("!QQ").unpack
+    for line in lines:
+        for token in RETOKEN.findall(line):
+            addr, _, prefix    = token.partition("/")
+            if ":" in addr and "." in addr:
+                host, _, port  = addr.rpartition(":")
+                if ":" not in host and (port.isdigit() or not port):
+                    addr       = host                                 # host:port of proxy lists, not IPv6
+            try:
+                if ":" in addr:
+                    bits       = 128
+                    high, low  = unpack6(socket.inet_pton(socket.AF_INET6, addr))
+                    ip         = (high << 64) | low
+                else:
+                    addr       = addr.rstrip(".")
+                    if addr.count(".") != 3:
+                        continue
+                    bits       = 32
+                    ip         = unpack4(socket.inet_aton(addr))[0]
+            except socket.error:
+                continue
+            prefix             = int(prefix) if prefix else bits
+            if prefix > bits:
+                continue
+            yield bits, ip & ~((1 << (bits - prefix)) - 1), prefix
+
+#---------------------------------------------------------------
+def iter_ranges(networks):
+    """
+        Turn (bits, network, prefix) triples into (bits, start, end) ranges
+    """
+    for bits, network, prefix in networks:
+        yield bits, network, network | ((1 << (bits - prefix)) - 1)
+
+#---------------------------------------------------------------
+def parse_address(field):
+    """
+        (bits, address int) of a single address field or None
+    """
+    for bits, network, prefix in iter_networks([field]):
+        return bits, network
+    return None
+
+#---------------------------------------------------------------
+def parse_scan(lines, url):
+    """
+        Every address or CIDR found anywhere on a line
+    """
+    return iter_ranges(iter_networks(iter_lines(lines)))
+
+#---------------------------------------------------------------
+def parse_list(lines, url):
+    """
+        One address or CIDR per line, later fields are ignored
+    """
+    return iter_ranges(iter_networks(line.split(None, 1)[0] for line in iter_lines(lines)))
+
+#---------------------------------------------------------------
+def parse_dshield(lines, url):
+    """
+        DShield block.txt, tab separated start and end address per line
+    """
+    for line in iter_lines(lines, "#"):
+        fields                 = line.split()
+        if len(fields) < 2:
+            continue
+        start, end             = parse_address(fields[0]), parse_address(fields[1])
+        if start and end and start[0] == end[0] and start[1] <= end[1]:
+            yield start[0], start[1], end[1]
+
+#---------------------------------------------------------------
+def parse_csv(lines, url):
+    """
+        Delimited file, addresses or CIDRs in one column or start and
+        end addresses in a column pair, columns may be given by header name
+    """
+    column                     = feed_option(url, "column")
+    end_column                 = feed_option(url, "end_column")
+    reader                     = csv.reader(iter_lines(lines, "#"), delimiter=str(feed_option(url, "delimiter")))
+
+    if not isinstance(column, int) or (end_column is not None and not isinstance(end_column, int)):
+        header                 = [name.strip() for name in next(reader, [])]
+        try:
+            if not isinstance(column, int):
+                column         = header.index(column)
+            if end_column is not None and not isinstance(end_column, int):
+                end_column     = header.index(end_column)
+        except ValueError:
+            syslog.syslog(syslog.LOG_ERR, "CSV column not found in header: %s" % url)
+            return
+
+    for row in reader:
+        if len(row) <= max(column, end_column):
+            continue
+        if end_column is None:
+            for entry in iter_ranges(iter_networks([row[column]])):
+                yield entry
+            continue
+        start, end             = parse_address(row[column].strip()), parse_address(row[end_column].strip())
+        if start and end and start[0] == end[0] and start[1] <= end[1]:
+            yield start[0], start[1], end[1]
+
+#---------------------------------------------------------------
+# Feed format registry, a parser takes the body lines and the feed url
+# and yields (address bits, first address, last address) ranges
+FEED_FORMATS                   = {
+    "scan"                     : parse_scan,
+    "list"                     : parse_list,
+    "spamhaus"                 : parse_list,
+    "dshield"                  : parse_dshield,
+    "csv"                      : parse_csv,
+}
+
+#---------------------------------------------------------------
+def new_buffer(bits):
+    """
+        Compact integer buffer able to hold addresses of the given width
+    """
+    if bits <= 32:
+        return array.array("L")
+    return list()
+
+#---------------------------------------------------------------
+class KeyBuffer:
+    """
+        Sorted (network, prefix) set keys held in two compact buffers
+        instead of a list of tuples
+    """
+    #---------------------------------------------------------------
+    def __init__(self, bits, keys=()):
+        self.bits              = bits                         # address width
+        self.networks          = new_buffer(bits)             # network integers
+        self.prefixes          = array.array("B")             # prefix lengths
+        self.extend(keys)
+
+    #---------------------------------------------------------------
+    def append(self, key):
+        self.networks.append(key[0])
+        self.prefixes.append(key[1])
+
+    #---------------------------------------------------------------
+    def extend(self, keys):
+        for network, prefix in keys:
+            self.networks.append(network)
+            self.prefixes.append(prefix)
+
+    #---------------------------------------------------------------
+    def __len__(self):
+        return len(self.prefixes)
+
+    #---------------------------------------------------------------
+    def __iter__(self):
+        return itertools.izip(self.networks, self.prefixes)
+
+    #---------------------------------------------------------------
+    def __getitem__(self, i):
+        return self.networks[i], self.prefixes[i]
+
+    #---------------------------------------------------------------
+    def __eq__(self, other):
+        return isinstance(other, KeyBuffer) and self.prefixes == other.prefixes and self.networks == other.networks
+
+    #---------------------------------------------------------------
+    def __ne__(self, other):
+        return not self == other
+
+#---------------------------------------------------------------
+def aggregate_ranges(ranges, bits=32):
+    """
+        Sort and sweep (start, end) pairs into the minimal sorted list of
+        disjoint, non adjacent ranges, returned as (starts, ends) buffers
+    """
+    mask                       = (1 << bits) - 1
+    keys                       = sorted((start << bits) | end for start, end in ranges)
+    starts, ends               = new_buffer(bits), new_buffer(bits)
+
+    first = last               = None
+    for key in keys:
+        start, end             = key >> bits, key & mask
+        if last is not None and start <= last + 1:
+            if end > last:
+                last           = end
+            continue
+        if last is not None:
+            starts.append(first)
+            ends.append(last)
+        first, last            = start, end
+
+    if last is not None:
+        starts.append(first)
+        ends.append(last)
+    return starts, ends
+
+#---------------------------------------------------------------
+def parse_exclude(entries):
+    """
+        Aggregate allow list entries (CIDR, address or "first-last"
+        range) into {bits: (starts, ends)}
+    """
+    ranges                     = dict((bits, list()) for bits in INET_BITS.values())
+    for entry in entries:
+        if "-" in entry:
+            first, last        = [parse_address(field.strip()) for field in entry.split("-", 1)]
+            if first and last and first[0] == last[0] and first[1] <= last[1]:
+                ranges[first[0]].append((first[1], last[1]))
+                continue
+        else:
+            found              = list(iter_ranges(iter_networks([entry])))
+            if len(found) == 1:
+                bits, start, end = found[0]
+                ranges[bits].append((start, end))
+                continue
+        syslog.syslog(syslog.LOG_WARNING, "Ignoring invalid exclude entry %r" % entry)
+    return dict((bits, aggregate_ranges(found, bits)) for bits, found in ranges.items())
+
+#---------------------------------------------------------------
+def subtract_ranges(starts, ends, xstarts, xends, bits=32):
+    """
+        Remove the sorted, disjoint ranges (xstarts, xends) from the
+        sorted, disjoint ranges (starts, ends) in one merge pass,
+        returns (starts, ends, removed, split) where removed counts the
+        ranges left empty and split the ranges cut or split in pieces
+    """
+    outstarts, outends         = new_buffer(bits), new_buffer(bits)
+    removed = split = j        = 0
+    for start, end in itertools.izip(starts, ends):
+        while j < len(xstarts) and xends[j] < start:
+            j += 1
+        if j == len(xstarts) or xstarts[j] > end:
+            outstarts.append(start)
+            outends.append(end)
+            continue
+
+        pieces                 = len(outstarts)
+        while j < len(xstarts) and xstarts[j] <= end:
+            if xstarts[j] > start:
+                outstarts.append(start)
+                outends.append(xstarts[j] - 1)
+            start              = max(start, xends[j] + 1)
+            if xends[j] > end:
+                break                                         # overlaps the next range too
+            j += 1
+        if start <= end:
+            outstarts.append(start)
+            outends.append(end)
+
+        if len(outstarts) == pieces:
+            removed += 1
+        else:
+            split += 1
+    return outstarts, outends, removed, split
+
+#---------------------------------------------------------------
+def range_to_cidrs(start, end, bits=32):
+    """
+        Split an address range into the fewest covering CIDR blocks,
+        yields (network int, prefix length) pairs
+    """
+    while start <= end:
+        size                   = (start & -start) or (1 << bits)  # largest block aligned on start
+        while size > end - start + 1:
+            size >>= 1
+        yield start, bits - size.bit_length() + 1
+        start += size
 
+#---------------------------------------------------------------
+def get_ip_and_subnet_list(ranges, bits=32):
+    """
+        Merge (start, end) address ranges, returns the same sorted
+        minimal CIDR list netaddr's cidr_merge would
+    """
+    starts, ends               = aggregate_ranges(ranges, bits)
     outputlist                 = list()
-    outputlist += [IPNetwork(i) for i in re.findall(r'\b\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}\/?[0-9]{1,2}?\b',data)]
-    return sorted(set(cidr_merge(outputlist)))
+    for start, end in itertools.izip(starts, ends):
+        outputlist.extend(range_to_cidrs(start, end, bits))
+    return outputlist
+
+#---------------------------------------------------------------
+def diff_sorted(current, desired):
+    """
+        Sorted merge of two sorted, unique KeyBuffers, returns
+        (added, deleted, same) where same is a count
+    """
+    added, deleted             = KeyBuffer(desired.bits), KeyBuffer(current.bits)
+    cnetworks, cprefixes       = current.networks, current.prefixes
+    dnetworks, dprefixes       = desired.networks, desired.prefixes
+    same = i = j               = 0
+    while i < len(cprefixes) and j < len(dprefixes):
+        network, prefix        = cnetworks[i], cprefixes[i]
+        other, oprefix         = dnetworks[j], dprefixes[j]
+        if network == other and prefix == oprefix:
+            same += 1
+            i += 1
+            j += 1
+        elif network < other or network == other and prefix < oprefix:
+            deleted.append((network, prefix))
+            i += 1
+        else:
+            added.append((other, oprefix))
+            j += 1
+    deleted.networks.extend(cnetworks[i:])
+    deleted.prefixes.extend(cprefixes[i:])
+    added.networks.extend(dnetworks[j:])
+    added.prefixes.extend(dprefixes[j:])
+    return added, deleted, same
+
+#---------------------------------------------------------------
+def cidr_str(network, prefix, bits=32):
+    """
+        CIDR string of a (network int, prefix length) pair
+    """
+    if bits == 32:
+        return "%s/%d" % (socket.inet_ntoa(struct.pack("!L", network)), prefix)
+    packed                     = struct.pack("!QQ", network >> 64, network & 0xFFFFFFFFFFFFFFFF)
+    return "%s/%d" % (socket.inet_ntop(socket.AF_INET6, packed), prefix)
+
+#---------------------------------------------------------------
+def reduce_prefix_lengths(counts, bits, budget):
+    """
+        Greedily expand the network prefix length costing the fewest
+        extra entries into the next longer length present (or into
+        hosts) while the total added stays within budget, returns
+        {prefix: stored prefix}
+    """
+    counts                     = dict(counts)
+    targets                    = dict((prefix, prefix) for prefix in counts)
+    while True:
+        lengths                = sorted(prefix for prefix in counts if prefix < bits)
+        best                   = None
+        for i, prefix in enumerate(lengths):
+            longer             = lengths[i + 1] if i + 1 < len(lengths) else bits
+            cost               = counts[prefix] * ((1 << (longer - prefix)) - 1)
+            if cost <= budget and (best is None or cost < best[0]):
+                best           = (cost, prefix, longer)
+        if best is None:
+            return targets
+
+        cost, prefix, longer   = best
+        budget -= cost
+        counts[longer]         = counts.get(longer, 0) + (counts.pop(prefix) << (longer - prefix))
+        for source, target in targets.items():
+            if target == prefix:
+                targets[source] = longer
+
+#---------------------------------------------------------------
+def set_size(entries):
+    """
+        (hashsize, maxelem) for a hash set holding entries, maxelem
+        leaves IPSET_HEADROOM to grow and hashsize keeps about one
+        entry per bucket
+    """
+    hashsize, maxelem          = IPSET_HASHSIZE, IPSET_MAXELEM
+    while maxelem < entries * IPSET_HEADROOM:
+        maxelem <<= 1
+    while hashsize < entries:
+        hashsize <<= 1
+    return hashsize, maxelem
+
+#---------------------------------------------------------------
+def ipset_headers():
+    """
+        parse the headers of every kernel set from one terse list,
+        returns name -> {"type", "entries", "hashsize", "maxelem"}
+    """
+    cmd                        = [IPSET_PATH, "list", "-t"]
+    try:
+        result                 = subprocess.check_output(cmd)
+    except (subprocess.CalledProcessError, OSError) as error:
+        syslog.syslog(syslog.LOG_ERR, "Cannot list ipset headers: %s" % error)
+        return dict()
+
+    headers                    = dict()
+    for block in re.split(r"\n(?=Name: )", result):
+        name                   = RESETNAME.search(block)
+        if not name:
+            continue
+        header                 = {"type": None, "entries": None, "hashsize": None, "maxelem": None}
+        for key, regex in (("type", RESETTYPE), ("entries", RESETCOUNT), ("hashsize", RESETHASHSIZE), ("maxelem", RESETMAXELEM)):
+            match              = regex.search(block)
+            if match:
+                header[key]    = match.group(1) if key == "type" else int(match.group(1))
+        headers[name.group(1)] = header
+    return headers
+
+#---------------------------------------------------------------
+def ipset_restore(cmds):
+    """
+        stream ipset commands into a single ipset restore process
+    """
+    cmd                        = [IPSET_PATH, "-exist", "restore"]
+    proc                       = subprocess.Popen(cmd, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    try:
+        for line in cmds:
+            proc.stdin.write(line + "\n")
+    except IOError:
+        pass                                                  # ipset exited early, error is on stderr
+    finally:
+        try:
+            proc.stdin.close()
+        except IOError:
+            pass
+
+    err                        = proc.stderr.read()
+    if proc.wait() != 0:
+        syslog.syslog(syslog.LOG_ERR, "ipset restore failed: %s" % err.strip())
+        return False
+    return True
 
 #---------------------------------------------------------------
 class Ipset:
@@ -42,127 +867,1870 @@ class Ipset:
         Manage ipset entry Read/Add/Delete
     """
     #---------------------------------------------------------------
-    def __init__(self, inet):
-        self.setname           = "ipv4Bogons"                 # ipset chain name
+    def __init__(self, inet, apply_mode="batch", state_dir=STATE_DIR, shards=1, layout="net", name="Bogons"):
+        self.setname           = inet + name                  # ipset chain name
+        self.bits              = INET_BITS[inet]              # address width
+        self.family            = "inet" if self.bits == 32 else "inet6"
         self.inet              = inet                         # inet mode
-        self.ripset            = re.compile(r"^\d")           # ipset regexp
-        self.currentstor       = set()                        # ipset stor
+        self.apply_mode        = apply_mode                   # batch, swap or single
+        self.reshape(shards, layout)
+        self.kernel            = dict()                       # set name -> header of every kernel set
+        self.currentstor       = KeyBuffer(self.bits)         # sorted (network, prefix) keys as stored in the kernel
+        self.netlist           = KeyBuffer(self.bits)         # aggregated keys of the last apply
+        self.loaded            = False                        # currentstor holds the last apply
+        self.calls             = 0                            # ipset processes of the last apply
+        self.pending           = None                         # diff prepared but not committed yet
+        self.last              = dict()                       # counters of the last apply
+        self.journal           = Journal(os.path.join(state_dir, self.setname + ".journal"), self.bits)
+
+    #---------------------------------------------------------------
+    def reshape(self, shards, layout):
+        """
+            name and type the member sets of a shard count and layout
+        """
+        self.shape             = (shards, layout)             # recorded in the journal
+        self.shards            = shards                       # member sets per kind
+        self.depth             = shards.bit_length() - 1      # leading address bits picking the shard
+        self.shift             = self.bits - self.depth       # network >> shift is the shard index
+        self.split_hosts       = layout == "split"            # hosts in hash:ip, networks in hash:net
+        self.kinds             = ["hash:ip", "hash:net"] if self.split_hosts else ["hash:net"]
+        self.members           = list()                       # member set names, kind major, shard minor
+        self.types             = list()                       # member set types
+        for kind in self.kinds:
+            for shard in range(shards):
+                name           = self.setname
+                if self.split_hosts:
+                    name += "-" + kind.split(":")[1]
+                if shards > 1:
+                    name += "-%d" % shard
+                self.members.append(name)
+                self.types.append(kind)
+
+    #---------------------------------------------------------------
+    def prepare(self, netlist, kernel=None):
+        """
+            diff netlist against the current set content, returns the
+            restore commands applying it (empty when there is nothing
+            to restore) or None if the set cannot be read; kernel holds
+            the headers when the caller listed them already
+        """
+        self.calls             = 0
+        self.pending           = None
+        started                = time.time()
+        if not self.read(kernel):
+            self.last          = {"entries": len(netlist), "stored": 0, "prefix_lengths": 0, "added": 0, "deleted": 0, "unchanged": 0,
+                                  "read_seconds": 0, "apply_seconds": 0, "ipset_calls": self.calls, "applied": False, "resized": 0}
+            return None
+
+        keys                   = self.layout(netlist)
+        added, deleted, same   = diff_sorted(self.currentstor, keys)
+
+        parts                  = self.split(keys)
+        grown                  = [i for i, part in enumerate(parts) if self.undersized(self.members[i], len(part))]
+        for i in grown:
+            syslog.syslog(syslog.LOG_NOTICE, "%s growing %s to hashsize %d maxelem %d" % ((self.inet, self.members[i]) + set_size(len(parts[i]))))
+        rebuild                = range(len(self.members)) if self.apply_mode == "swap" else grown
+
+        self.pending           = {"netlist": netlist, "keys": keys, "added": added, "deleted": deleted, "unchanged": same,
+                                  "rebuild": rebuild, "resized": len(grown), "read_seconds": time.time() - started}
+        if not (self.apply_mode == "swap" or rebuild or added or deleted):
+            return list()
+        if self.apply_mode == "single":
+            return list(itertools.chain(self.create_cmds(parts), self.swap_cmds((i, parts[i]) for i in rebuild)))
+        return itertools.chain(self.create_cmds(parts),
+                               self.swap_cmds((i, parts[i]) for i in rebuild),
+                               self.batch_cmds(added, deleted, rebuild))
 
     #---------------------------------------------------------------
-    def process(self, netlist):
+    def commit(self, applied, seconds=0):
         """
-            Process the blocklist data downloaded
+            record the outcome of the restore of the prepared commands,
+            seconds it took, and with -m single add and delete every
+            changed entry; returns True if the set holds netlist
         """
-        self.read()
+        pending                = self.pending
+        self.pending           = None
+        if pending is None:
+            self.last["ipset_calls"] = self.calls
+            return False
 
-        deleted                = self.currentstor.difference(netlist)
-        added                  = netlist.difference(self.currentstor)
-        same                   = netlist.intersection(self.currentstor)
+        started                = time.time()
+        if applied and self.apply_mode == "single":
+            rebuild            = pending["rebuild"]
+            for i, ip in self.route(pending["deleted"]):
+                if i not in rebuild:
+                    self.del_ip(i, ip)
+            for i, ip in self.route(pending["added"]):
+                if i not in rebuild:
+                    self.add_ip(i, ip)
 
-        for ip in deleted:
-            self.del_ip(ip)
+        keys                   = pending["keys"]
+        syslog.syslog(syslog.LOG_INFO, "%s | Add : %s | Dup : %s | Del : %s" % (self.setname, len(pending["added"]), pending["unchanged"], len(pending["deleted"])))
+        self.last              = {
+            "entries"          : len(pending["netlist"]),
+            "stored"           : len(keys),
+            "prefix_lengths"   : len(set(prefix for network, prefix in keys if not self.split_hosts or prefix < self.bits)),
+            "added"            : len(pending["added"]),
+            "deleted"          : len(pending["deleted"]),
+            "unchanged"        : pending["unchanged"],
+            "read_seconds"     : round(pending["read_seconds"], 3),
+            "apply_seconds"    : round(seconds + time.time() - started, 3),
+            "ipset_calls"      : self.calls,
+            "applied"          : applied,
+            "resized"          : pending["resized"],
+        }
 
-        for ip in added:
-            self.add_ip(ip)
+        if applied:
+            self.journal.save(keys, *self.shape)
+            self.currentstor   = keys
+            self.netlist       = pending["netlist"]
+            self.loaded        = True
+        else:
+            self.journal.discard()                            # kernel state unknown, force a full read
+            self.loaded        = False
+        return applied
+
+    #---------------------------------------------------------------
+    def read(self, kernel=None):
+        """
+            load the current set content from memory or the journal,
+            falling back to a full kernel read when the journal is
+            missing or has drifted from the kernel entry count,
+            False if the kernel sets do not match the layout
+        """
+        self.kernel            = self.headers() if kernel is None else kernel
+        if not self.check_layout():
+            return False
+
+        entries                = self.currentstor if self.loaded else self.load_journal()
+        if entries is not None:
+            if self.count() == len(entries):
+                self.currentstor   = entries
+                return True
+            syslog.syslog(syslog.LOG_NOTICE, "%s journal out of step with the kernel, reading %s" % (self.inet, self.setname))
+        self.read_kernel()
+        return True
+
+    #---------------------------------------------------------------
+    def in_step(self, kernel):
+        """
+            True if the kernel sets hold as many entries as were last
+            applied, a set never applied has neither journal nor sets
+        """
+        self.kernel            = kernel
+        entries                = self.currentstor if self.loaded else self.load_journal()
+        if entries is None:
+            return not any(name in kernel for name in self.members)
+        return self.count() == len(entries)
 
-        syslog.syslog(syslog.LOG_INFO, "%s net | Add : %s | Dup : %s | Del : %s" % (self.inet, len(added), len(same), len(deleted)))
+    #---------------------------------------------------------------
+    def load_journal(self):
+        """
+            entries of the journal, None if it is missing or was written
+            for another shard count or layout
+        """
+        entries                = self.journal.load()
+        if entries is not None and self.journal.shape != self.shape:
+            return None
+        return entries
 
     #---------------------------------------------------------------
-    def read(self):
+    def read_kernel(self):
         """
             read and parse current ipset list content
         """
-        cmd                    = [IPSET_PATH, "list", self.setname]
-        result                 = subprocess.check_output(cmd)
-        data                   = result.decode("utf-8")
+        keys                   = list()
+        for name in self.members:
+            if name not in self.kernel:
+                continue
+            cmd                = [IPSET_PATH, "list", name]
+            self.calls += 1
+            result             = subprocess.check_output(cmd)
+            data               = result.decode("utf-8")
+            members            = data.split("Members:", 1)[-1].split("\n")
+            keys.extend((network, prefix) for bits, network, prefix in iter_networks(members) if bits == self.bits)
+        self.currentstor       = KeyBuffer(self.bits, sorted(set(keys)))
+
+    #---------------------------------------------------------------
+    def headers(self):
+        """
+            headers of every kernel set
+        """
+        self.calls += 1
+        return ipset_headers()
 
-        for item in data.split("\n"):
-            if self.ripset.match(item):
-                self.currentstor.add(item.strip())
+    #---------------------------------------------------------------
+    def check_layout(self):
+        """
+            True unless an existing kernel set has a different type than
+            the layout needs, swap cannot change a set type and a set
+            referenced by iptables cannot be destroyed
+        """
+        wanted                 = zip(self.members, self.types)
+        if len(self.members) > 1:
+            wanted.append((self.setname, "list:set"))
+        for name, kind in wanted:
+            if name in self.kernel and self.kernel[name]["type"] != kind:
+                syslog.syslog(syslog.LOG_ERR, "%s is a %s set, expected %s: remove it from iptables and destroy it first" % (name, self.kernel[name]["type"], kind))
+                return False
+        return True
 
     #---------------------------------------------------------------
-    def add_ip(self, ip):
+    def count(self):
         """
-            add ip to ipset
+            kernel entry count of all member sets, None if unknown
         """
-        cmd                    = [IPSET_PATH, "add", "-q", "-!", self.setname, str(ip)]
-        subprocess.call(cmd)
+        counts                 = [self.kernel.get(name, dict()).get("entries") for name in self.members]
+        if None in counts:
+            return None
+        return sum(counts)
+
+    #---------------------------------------------------------------
+    def layout(self, netlist):
+        """
+            the sorted keys netlist is stored as in the kernel: prefixes
+            wider than a shard are split at shard boundaries and, with
+            the split layout, rare network prefix lengths are expanded
+            into longer ones
+        """
+        targets                = dict()
+        if self.split_hosts:
+            counts             = collections.Counter()
+            for network, prefix in netlist:
+                counts[max(prefix, self.depth)] += 1 << max(self.depth - prefix, 0)
+            targets            = reduce_prefix_lengths(counts, self.bits, int(len(netlist) * IPSET_PREFIX_GROWTH))
+            for prefix, target in sorted(targets.items()):
+                if target != prefix:
+                    syslog.syslog(syslog.LOG_DEBUG, "%s storing %d /%d networks as /%d" % (self.inet, counts[prefix], prefix, target))
+
+        if not self.depth and all(target == prefix for prefix, target in targets.items()):
+            return netlist
+
+        keys                   = KeyBuffer(self.bits)
+        for network, prefix in netlist:
+            target             = targets.get(max(prefix, self.depth), max(prefix, self.depth))
+            if target == prefix:
+                keys.append((network, prefix))
+                continue
+            step               = 1 << (self.bits - target)
+            keys.extend((network + i * step, target) for i in xrange(1 << (target - prefix)))
+        return keys
+
+    #---------------------------------------------------------------
+    def route(self, keys):
+        """
+            yields (member index, key) for every stored key
+        """
+        for network, prefix in keys:
+            kind               = 1 if self.split_hosts and prefix < self.bits else 0
+            yield kind * self.shards + (network >> self.shift if self.depth else 0), (network, prefix)
+
+    #---------------------------------------------------------------
+    def split(self, keys):
+        """
+            stored keys of every member set
+        """
+        if len(self.members) == 1:
+            return [keys]
+        parts                  = [KeyBuffer(self.bits) for name in self.members]
+        for i, key in self.route(keys):
+            parts[i].append(key)
+        return parts
+
+    #---------------------------------------------------------------
+    def undersized(self, name, entries):
+        """
+            True if an existing member set cannot hold entries or its
+            hash table has fallen far behind the entry count
+        """
+        header                 = self.kernel.get(name)
+        if not header or header["maxelem"] is None:
+            return False
+        hashsize, maxelem      = set_size(entries)
+        return header["maxelem"] < entries or (header["hashsize"] or 0) * IPSET_HASHSIZE_LAG < hashsize
+
+    #---------------------------------------------------------------
+    def definition(self, i, entries):
+        """
+            create arguments of member set i sized for entries
+        """
+        return "%s family %s hashsize %d maxelem %d" % ((self.types[i], self.family) + set_size(entries))
+
+    #---------------------------------------------------------------
+    def entry(self, i, ip):
+        """
+            restore/add argument of a key in member set i, hash:ip sets
+            take plain addresses
+        """
+        cidr                   = cidr_str(ip[0], ip[1], self.bits)
+        if self.types[i] == "hash:ip":
+            return cidr.split("/")[0]
+        return cidr
 
     #---------------------------------------------------------------
-    def del_ip(self, ip):
+    def boot(self):
         """
-            del ip to ipset
+            repopulate the set from the journal without any download,
+            in the shards and layout the journal was applied to
         """
-        cmd                    = [IPSET_PATH, "del", "-q", "-!", self.setname, str(ip)]
+        entries                = self.journal.load()
+        if entries is None:
+            syslog.syslog(syslog.LOG_NOTICE, "%s no journal to restore" % self.setname)
+            return False
+        if self.journal.shape != self.shape:
+            self.reshape(*self.journal.shape)
+
+        self.kernel            = self.headers()
+        if not self.check_layout():
+            return False
+        parts                  = self.split(entries)
+        applied                = self.restore(itertools.chain(self.create_cmds(parts), self.swap_cmds(enumerate(parts))))
+        if applied:
+            syslog.syslog(syslog.LOG_INFO, "%s | Restored : %s" % (self.setname, len(entries)))
+        return applied
+
+    #---------------------------------------------------------------
+    def add_ip(self, i, ip):
+        """
+            add ip to member set i
+        """
+        cmd                    = [IPSET_PATH, "add", "-q", "-!", self.members[i], self.entry(i, ip)]
+        self.calls += 1
         subprocess.call(cmd)
 
-#---------------------------------------------------------------
-class Updater:
-    """
-        Download and Parse files
-    """
     #---------------------------------------------------------------
-    def __init__(self, url, mode):
-        self.urls              = url                                              # download url
-        self.oip               = Ipset(mode)                                      # ipset object
-        self.rethreat          = re.compile(r"(^([0-9]{1,3}\.){3}[0-9]{1,3}).*$") # emerging threats regexp
-        self.currentstor       = set()                                            # downloaded ip stor
+    def del_ip(self, i, ip):
+        """
+            del ip from member set i
+        """
+        cmd                    = [IPSET_PATH, "del", "-q", "-!", self.members[i], self.entry(i, ip)]
+        self.calls += 1
+        subprocess.call(cmd)
 
     #---------------------------------------------------------------
-    def download(self, url):
+    def create_cmds(self, parts):
         """
-            Download Files and launch parser
+            generate restore commands creating the member sets (sized
+            for their entries) and the list:set joining them, only for
+            the sets which do not exist yet
         """
-        try:
-            req                = Request(url)
-            data               = urlopen(req)
-            code               = data.getcode()
+        for i, part in enumerate(parts):
+            if self.members[i] not in self.kernel:
+                yield "create %s %s" % (self.members[i], self.definition(i, len(part)))
+        if len(self.members) > 1 and self.setname not in self.kernel:
+            yield "create %s list:set size %d" % (self.setname, len(self.members))
+        if len(self.members) > 1:
+            for name in self.members:
+                if name not in self.kernel or self.setname not in self.kernel:
+                    yield "add %s %s" % (self.setname, name)
 
-            if code == 200:
-                urlsplit       = re.split("/", url)
-                filename       = urlsplit[len(urlsplit)-1]
-                if filename == "emerging-Block-IPs.txt":
-                    self.parse_ethreats_txt(data.read())
-                elif filename == "TorBulkExitList.py?ip=1.1.1.1":
-                    self.parse_ethreats_txt(data.read())
-                elif filename == "anonymous-proxy-fraudulent-ip-address-list":
-                    self.parse_ethreats_txt(data.read())
-                elif filename == "blist.php":
-                    self.parse_ethreats_txt(data.read())
+    #---------------------------------------------------------------
+    def batch_cmds(self, added, deleted, skip=()):
+        """
+            generate restore commands which patch the live sets in
+            place, leaving out the members in skip
+        """
+        for i, ip in self.route(deleted):
+            if i not in skip:
+                yield "del %s %s" % (self.members[i], self.entry(i, ip))
 
-        except HTTPError as error:
-            syslog.syslog(syslog.LOG_ERR, "HTTP Error: %s %s" % (error.code, url))
-        except URLError as error:
-            syslog.syslog(syslog.LOG_ERR, "URL Error: %s %s" % (error.reason, url))
+        for i, ip in self.route(added):
+            if i not in skip:
+                yield "add %s %s" % (self.members[i], self.entry(i, ip))
 
     #---------------------------------------------------------------
-    def parse_ethreats_txt(self, data):
+    def swap_cmds(self, parts):
         """
-            Parse emerging threats IP addresses
+            generate restore commands which fill a temporary set for
+            every (member index, keys) pair and swap it with the live
+            member, so iptables never matches against a half updated
+            set and the new set is sized for its entries
         """
-        dec                    = get_v4_ip_and_subnet_list(data.decode("utf-8"))
-        for line in dec:
-            if self.rethreat.match(str(line)):
-                self.currentstor.add(str(line).strip())
+        for i, part in parts:
+            name               = self.members[i]
+            tmpname            = name + "-tmp"
+            if tmpname in self.kernel:
+                yield "destroy %s" % tmpname                  # left over by an interrupted run, maybe sized differently
+            yield "create %s %s" % (tmpname, self.definition(i, len(part)))
 
-#---------------------------------------------------------------
-    def run(self):
+            for ip in part:
+                yield "add %s %s" % (tmpname, self.entry(i, ip))
+
+            yield "swap %s %s" % (tmpname, name)
+            yield "destroy %s" % tmpname
+
+    #---------------------------------------------------------------
+    def restore(self, cmds):
         """
-            main run func
+            stream ipset commands into a single ipset restore process
         """
-        for url in self.urls:
-            self.download(url)
+        self.calls += 1
+        return ipset_restore(cmds)
 
-        if len(self.currentstor) != 0:
-            self.oip.process(self.currentstor)
-        else:
-            syslog.syslog(syslog.LOG_NOTICE, "Download failed!")
+#---------------------------------------------------------------
+def atomic_write(filename, chunks, header=None):
+    """
+        replace a file with the given string chunks through a temporary
+        file and a rename, a crash never leaves a torn copy; header is
+        called once every chunk is written and its string overwrites
+        the start of the file, for counts and checksums of a streamed
+        body; creates the directory and raises IOError/OSError
+    """
+    dirname                    = os.path.dirname(filename)
+    if dirname and not os.path.isdir(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError:
+            if not os.path.isdir(dirname):                    # not created by another thread
+                raise
+
+    tmpname                    = "%s.%s.tmp" % (filename, threading.current_thread().ident)
+    try:
+        with open(tmpname, "wb") as fh:
+            for chunk in chunks:
+                fh.write(chunk)
+            if header is not None:
+                fh.seek(0)
+                fh.write(header())
+        os.rename(tmpname, filename)
+    except:
+        if os.path.exists(tmpname):
+            os.unlink(tmpname)
+        raise
 
 #---------------------------------------------------------------
-if __name__ == "__main__":
-    syslog.syslog(syslog.LOG_NOTICE, "Starting emerging threats update...")
-    Updater(IPV4_NETS_URL, "ipv4").run()
-    syslog.syslog(syslog.LOG_NOTICE, "Emerging threats update completed.")
+class RecordFile:
+    """
+        Checksummed file of fixed size records, each holding address
+        integers followed by plain fields, written atomically
+    """
+    #---------------------------------------------------------------
+    def __init__(self, filename, magic, kind, bits, addresses, fields, extra=""):
+        self.filename          = filename                     # file name
+        self.magic             = magic                        # format tag, 8 bytes
+        self.kind              = kind                         # name in log messages
+        self.bits              = bits                         # address width
+        self.addresses         = addresses                    # address integers per record
+        self.header            = struct.Struct("!8sBL%s20s" % extra)  # magic, address bits, count, extra fields, sha1
+        self.shifts            = range(bits - 32, -1, -32)    # 32 bit words, most significant first
+        self.words             = len(self.shifts)
+        self.record            = struct.Struct("!%dL%s" % (self.words * addresses, fields))
+
+    #---------------------------------------------------------------
+    def load(self):
+        """
+            (extra header fields, iterator of record tuples), None if
+            the file is missing or fails its checks
+        """
+        try:
+            with open(self.filename, "rb") as fh:
+                data           = fh.read()
+        except IOError:
+            return None
+
+        if len(data) < self.header.size:
+            return None
+        fields                 = self.header.unpack_from(data)
+        magic, bits, count, digest = fields[0], fields[1], fields[2], fields[-1]
+        body                   = buffer(data, self.header.size)
+        if magic != self.magic or bits != self.bits or len(body) != count * self.record.size or hashlib.sha1(body).digest() != digest:
+            syslog.syslog(syslog.LOG_WARNING, "Ignoring damaged %s %s" % (self.kind, self.filename))
+            return None
+
+        return fields[3:-1], self.records(body)
+
+    #---------------------------------------------------------------
+    def records(self, body):
+        """
+            yield the record tuples of a checked body
+        """
+        unpack                 = self.record.unpack_from
+        size                   = self.record.size
+        words                  = self.words
+        if words == 1:
+            for offset in xrange(0, len(body), size):
+                yield unpack(body, offset)                    # 32 bit addresses are single words
+            return
+        for offset in xrange(0, len(body), size):
+            values             = unpack(body, offset)
+            record             = list()
+            for i in range(0, words * self.addresses, words):
+                address        = 0
+                for word in values[i:i + words]:
+                    address    = (address << 32) | word
+                record.append(address)
+            yield tuple(record) + values[words * self.addresses:]
+
+    #---------------------------------------------------------------
+    def save(self, records, *extra):
+        """
+            stream the given record tuples into the file, the count and
+            checksum are filled in once the last is written; logs failures
+        """
+        sha1                   = hashlib.sha1()
+        count                  = [0]
+
+        def body():
+            pack               = self.record.pack
+            chunk              = list()
+            for record in records:
+                if self.words == 1:
+                    chunk.append(pack(*record))
+                else:
+                    words      = [(address >> shift) & 0xFFFFFFFF for address in record[:self.addresses] for shift in self.shifts]
+                    chunk.append(pack(*(words + list(record[self.addresses:]))))
+                if len(chunk) == RECORD_CHUNK:
+                    yield self.flush(chunk, sha1, count)
+            yield self.flush(chunk, sha1, count)
+
+        def header():
+            return self.header.pack(*((self.magic, self.bits, count[0]) + extra + (sha1.digest(),)))
+
+        try:
+            atomic_write(self.filename, itertools.chain([header()], body()), header)
+        except (IOError, OSError) as error:
+            syslog.syslog(syslog.LOG_WARNING, "Cannot write %s %s: %s" % (self.kind, self.filename, error))
+
+    #---------------------------------------------------------------
+    def flush(self, chunk, sha1, count):
+        """
+            join and checksum a chunk of packed records, empties it
+        """
+        data                   = "".join(chunk)
+        sha1.update(data)
+        count[0] += len(chunk)
+        del chunk[:]
+        return data
+
+#---------------------------------------------------------------
+class Journal:
+    """
+        Compact on disk record of the entries last applied to a set
+    """
+    MAGIC                      = "BOGONJ2\n"
+
+    #---------------------------------------------------------------
+    def __init__(self, filename, bits=32):
+        self.filename          = filename                     # journal file
+        self.bits              = bits                         # address width
+        self.file              = RecordFile(filename, self.MAGIC, "journal", bits, 1, "B", "HB")  # (network, prefix) records, shards and layout in the header
+        self.shape             = None                         # (shards, layout) the loaded pairs are stored for
+
+    #---------------------------------------------------------------
+    def load(self):
+        """
+            KeyBuffer of the journal entries, None if it is missing or
+            fails its checksum; shape holds the shards and layout of the
+            sets they were applied to
+        """
+        loaded                 = self.file.load()
+        if loaded is None or loaded[0][1] >= len(SET_LAYOUTS):
+            return None
+        (shards, layout), records = loaded
+        self.shape             = (shards, SET_LAYOUTS[layout])
+        return KeyBuffer(self.bits, records)
+
+    #---------------------------------------------------------------
+    def save(self, entries, shards=1, layout="net"):
+        """
+            replace the journal with the given (network, prefix) pairs
+            as stored in sets of the given shards and layout
+        """
+        self.file.save(entries, shards, SET_LAYOUTS.index(layout))
+
+    #---------------------------------------------------------------
+    def discard(self):
+        """
+            remove the journal so the next run reads the kernel set
+        """
+        try:
+            os.unlink(self.filename)
+        except OSError as error:
+            if error.errno != errno.ENOENT:
+                syslog.syslog(syslog.LOG_WARNING, "Cannot remove journal %s: %s" % (self.filename, error))
+
+#---------------------------------------------------------------
+class GracePeriod:
+    """
+        Last seen time and run of every range listed by the feeds, so
+        ranges which drop out of the feeds stay blocked for a while
+    """
+    MAGIC                      = "BOGONG1\n"
+
+    #---------------------------------------------------------------
+    def __init__(self, filename, bits=32, runs=GRACE_RUNS, seconds=GRACE_SECONDS):
+        self.filename          = filename                     # last seen file
+        self.bits              = bits                         # address width
+        self.runs              = runs                         # merges a missing range is kept
+        self.seconds           = seconds                      # seconds a missing range is kept
+        self.file              = RecordFile(filename, self.MAGIC, "grace file", bits, 2, "LL", "L")  # (start, end, seen, run) records, run in the header
+        self.records           = None                         # sorted (start, end, last seen time, last seen run)
+        self.run               = 0                            # merges so far
+        self.held              = (list(), list())             # (starts, ends) kept only by the grace period
+        self.expires           = None                         # earliest release of a held range, 0 next merge, None nothing held
+
+    #---------------------------------------------------------------
+    def load(self):
+        """
+            read the last seen records, start over when the file is
+            missing or damaged
+        """
+        loaded                 = self.file.load()
+        if loaded is None:
+            self.records, self.run = list(), 0
+        else:
+            (self.run,), records = loaded
+            self.records       = list(records)
+
+    #---------------------------------------------------------------
+    def save(self):
+        """
+            replace the last seen file
+        """
+        self.file.save(self.records, self.run)
+
+    #---------------------------------------------------------------
+    def within(self, seen, run, now):
+        """
+            True if a range last seen at (seen, run) is still held
+        """
+        return bool(self.runs and self.run - run <= self.runs or self.seconds and now - seen <= self.seconds)
+
+    #---------------------------------------------------------------
+    def release(self, seen, run):
+        """
+            time a range last seen at (seen, run) leaves the grace
+            period, 0 when it is held by a run count
+        """
+        if self.runs and self.run - run <= self.runs:
+            return 0
+        return seen + self.seconds + 1
+
+    #---------------------------------------------------------------
+    def update(self, starts, ends, now=None):
+        """
+            Record the sorted, disjoint current feed ranges as seen now,
+            returns the (starts, ends) to block: the current ranges plus
+            the missing ones still inside the grace period
+        """
+        if self.records is None:
+            self.load()
+        self.run += 1
+        now                    = int(now or time.time())
+
+        held                   = list()
+        j                      = 0
+        for start, end, seen, run in self.records:
+            if not self.within(seen, run, now):
+                continue
+            while j < len(starts) and ends[j] < start:
+                j += 1
+            while j < len(starts) and starts[j] <= end:
+                if starts[j] > start:
+                    held.append((start, starts[j] - 1, seen, run))
+                start          = max(start, ends[j] + 1)
+                if ends[j] > end:
+                    break                                     # covers the next record too
+                j += 1
+            if start <= end:
+                held.append((start, end, seen, run))
+
+        current                = ((start, end, now, self.run) for start, end in itertools.izip(starts, ends))
+        self.records           = list()
+        for record in heapq.merge(held, current):
+            last               = self.records[-1] if self.records else None
+            if last and last[1] == record[0] - 1 and last[2:] == record[2:]:
+                self.records[-1] = (last[0], record[1]) + record[2:]
+            else:
+                self.records.append(record)
+        self.save()
+
+        self.held              = aggregate_ranges(((start, end) for start, end, seen, run in held), self.bits)
+        self.expires           = min([self.release(seen, run) for start, end, seen, run in held] or [None])
+        if not held:
+            return starts, ends
+        return aggregate_ranges(((start, end) for start, end, seen, run in self.records), self.bits)
+
+#---------------------------------------------------------------
+class ProvenanceIndex:
+    """
+        Sorted, memory mapped (start, end, feed bitmap, first seen)
+        records of the ranges blocked by a set, feed bit n stands for
+        the nth url of the feed table in the header
+    """
+    MAGIC                      = "BOGONI1\n"
+    HEADER                     = struct.Struct("!8sBLL")      # magic, address bits, count, feed table bytes
+    MAX_FEEDS                  = 64                           # bits of the feed bitmap
+    EXCLUDED                   = 1 << 64                      # sweep flag of allow listed ranges
+
+    #---------------------------------------------------------------
+    def __init__(self, filename, bits=32):
+        self.filename          = filename                     # index file
+        self.bits              = bits                         # address width
+        self.shifts            = range(bits - 32, -1, -32)    # 32 bit words, most significant first
+        self.words             = len(self.shifts)
+        self.record            = struct.Struct("!%dL%dLQL" % (self.words, self.words))
+        self.feeds             = list()                       # url of every feed bit, None when free
+        self.count             = 0                            # records
+        self.base              = 0                            # offset of the first record
+        self.data              = None                         # mmap of the file
+
+    #---------------------------------------------------------------
+    def open(self):
+        """
+            map the index, False if it is missing or damaged
+        """
+        try:
+            with open(self.filename, "rb") as fh:
+                self.data      = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError):
+            return False
+
+        if len(self.data) >= self.HEADER.size:
+            magic, bits, count, table = self.HEADER.unpack_from(self.data)
+            base               = self.HEADER.size + table
+            if magic == self.MAGIC and bits == self.bits and len(self.data) == base + count * self.record.size:
+                self.feeds     = json.loads(self.data[self.HEADER.size:base])
+                self.count     = count
+                self.base      = base
+                return True
+        syslog.syslog(syslog.LOG_WARNING, "Ignoring damaged index %s" % self.filename)
+        self.close()
+        return False
+
+    #---------------------------------------------------------------
+    def close(self):
+        if self.data is not None:
+            self.data.close()
+        self.data              = None
+        self.count             = 0
+
+    #---------------------------------------------------------------
+    def get(self, i):
+        """
+            record i as (start, end, feed bitmap, first seen)
+        """
+        fields                 = self.record.unpack_from(self.data, self.base + i * self.record.size)
+        start = end            = 0
+        for word in fields[:self.words]:
+            start              = (start << 32) | word
+        for word in fields[self.words:2 * self.words]:
+            end                = (end << 32) | word
+        return start, end, fields[-2], fields[-1]
+
+    #---------------------------------------------------------------
+    def lookup(self, address):
+        """
+            (urls, first seen) of the record holding address, None if
+            the address is not blocked
+        """
+        lo, hi                 = 0, self.count
+        while lo < hi:
+            mid                = (lo + hi) // 2
+            start, end, bitmap, first = self.get(mid)
+            if address < start:
+                hi             = mid
+            elif address > end:
+                lo             = mid + 1
+            else:
+                return [url for bit, url in enumerate(self.feeds) if url and bitmap >> bit & 1], first
+        return None
+
+    #---------------------------------------------------------------
+    def feed_bits(self, urls):
+        """
+            url -> feed bit, urls keep the bit of the previous index and
+            new urls take free bits
+        """
+        table                  = [url if url in urls else None for url in self.feeds]
+        bits                   = dict((url, bit) for bit, url in enumerate(table) if url)
+        for url in urls:
+            if url in bits:
+                continue
+            if None in table:
+                bit            = table.index(None)
+            elif len(table) < self.MAX_FEEDS:
+                bit            = len(table)
+                table.append(None)
+            else:
+                syslog.syslog(syslog.LOG_WARNING, "Index %s full, not tracking %s" % (self.filename, url))
+                continue
+            table[bit]         = url
+            bits[url]          = bit
+        self.feeds             = table
+        return bits
+
+    #---------------------------------------------------------------
+    def events(self, starts, ends, flag):
+        """
+            sorted (position, flag) toggles of disjoint sorted ranges
+        """
+        for start, end in itertools.izip(starts, ends):
+            yield start, flag
+            yield end + 1, flag
+
+    #---------------------------------------------------------------
+    def sweep(self, feeds, exclude):
+        """
+            yields (start, end, feed bitmap) of the disjoint ranges
+            listed by at least one feed and not allow listed, feeds
+            maps feed bit -> (starts, ends)
+        """
+        streams                = [self.events(*aggregate_ranges(itertools.izip(*ranges), self.bits) + (1 << bit,)) for bit, ranges in feeds.items()]
+        streams.append(self.events(exclude[0], exclude[1], self.EXCLUDED))
+
+        bitmap = start         = 0
+        for position, toggles in itertools.groupby(heapq.merge(*streams), operator.itemgetter(0)):
+            if bitmap and not bitmap & self.EXCLUDED:
+                yield start, position - 1, bitmap
+            for position, flag in toggles:
+                bitmap ^= flag
+            start              = position
+
+    #---------------------------------------------------------------
+    def pieces(self, ranges, now):
+        """
+            split (start, end, feed bitmap) ranges at the records of the
+            mapped index, yields them with the first seen time of the
+            record they fall in or now, reading one record at a time
+        """
+        j                      = 0
+        previous               = self.get(0) if self.count else None
+        for start, end, bitmap in ranges:
+            while previous is not None and previous[1] < start:
+                j += 1
+                previous       = self.get(j) if j < self.count else None
+            while previous is not None:
+                ostart, oend, obitmap, first = previous
+                if ostart > end:
+                    break
+                if ostart > start:
+                    yield start, ostart - 1, bitmap, now
+                    start      = ostart
+                yield start, min(end, oend), bitmap, first
+                start          = min(end, oend) + 1
+                if oend > end:
+                    break
+                j += 1
+                previous       = self.get(j) if j < self.count else None
+            if start <= end:
+                yield start, end, bitmap, now
+
+    #---------------------------------------------------------------
+    def stamp(self, ranges, now):
+        """
+            yields (start, end, feed bitmap) ranges with first seen
+            times added, addresses already blocked in the mapped index
+            keep theirs and adjacent pieces alike are joined
+        """
+        last                   = None
+        for record in self.pieces(ranges, now):
+            if last is not None and last[1] == record[0] - 1 and last[2:] == record[2:]:
+                last           = (last[0],) + record[1:]
+                continue
+            if last is not None:
+                yield last
+            last               = record
+        if last is not None:
+            yield last
+
+    #---------------------------------------------------------------
+    def rebuild(self, feeds, exclude, now=None):
+        """
+            replace the index with the ranges of the given
+            {url: (starts, ends)} feeds minus the exclude ranges,
+            streamed from the mapped previous index; returns the number
+            of records
+        """
+        self.open()
+        bits                   = self.feed_bits(sorted(feeds))
+        ranges                 = self.sweep(dict((bits[url], feeds[url]) for url in feeds if url in bits), exclude)
+        table                  = json.dumps(self.feeds)
+        count                  = [0]
+
+        def packed():
+            for start, end, bitmap, first in self.stamp(ranges, int(now or time.time())):
+                count[0] += 1
+                yield self.record.pack(*([(start >> shift) & 0xFFFFFFFF for shift in self.shifts] +
+                                         [(end >> shift) & 0xFFFFFFFF for shift in self.shifts] + [bitmap, first]))
+
+        def header():
+            return self.HEADER.pack(self.MAGIC, self.bits, count[0], len(table))
+
+        try:
+            atomic_write(self.filename, itertools.chain([header(), table], packed()), header)
+        except (IOError, OSError) as error:
+            syslog.syslog(syslog.LOG_WARNING, "Cannot write index %s: %s" % (self.filename, error))
+        finally:
+            self.close()                                      # mapped until the last record is read
+        return count[0]
+
+#---------------------------------------------------------------
+class FeedTooLarge(IOError):
+    """
+        A feed body went past its max_bytes limit
+    """
+
+#---------------------------------------------------------------
+class HttpResponse:
+    """
+        A pooled connection's response, read() returns the decoded
+        body and counts bytes on the wire and decoded bytes
+    """
+    #---------------------------------------------------------------
+    def __init__(self, key, conn, response, max_bytes):
+        self.key               = key                          # pool key of the connection
+        self.conn              = conn                         # httplib connection
+        self.response          = response                     # httplib response
+        self.status            = response.status              # HTTP status
+        self.max_bytes         = max_bytes                    # decoded size limit
+        self.wire_bytes        = 0                            # body bytes received
+        self.decoded_bytes     = 0                            # body bytes after content decoding
+        self.eof               = False                        # body fully read
+        self.encoding          = (response.getheader("Content-Encoding") or "").strip().lower()
+        if self.encoding in ("gzip", "x-gzip"):
+            self.decoder       = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif self.encoding == "deflate":
+            self.decoder       = zlib.decompressobj()
+        else:
+            self.decoder       = None
+
+    #---------------------------------------------------------------
+    def getheader(self, name):
+        return self.response.getheader(name)
+
+    #---------------------------------------------------------------
+    def read(self, size=READ_CHUNK):
+        """
+            next decoded chunk of the body, "" at the end
+        """
+        while not self.eof:
+            raw                = self.response.read(size)
+            self.wire_bytes += len(raw)
+            if not raw:
+                self.eof       = True
+                data           = self.decoder.flush() if self.decoder else ""
+            elif self.decoder:
+                data           = self.decode(raw)
+            else:
+                data           = raw
+            self.decoded_bytes += len(data)
+            if self.decoded_bytes > self.max_bytes:
+                raise FeedTooLarge("body larger than %d bytes" % self.max_bytes)
+            if data:
+                return data
+        return ""
+
+    #---------------------------------------------------------------
+    def decode(self, raw):
+        """
+            inflate a chunk, deflate bodies may come as raw deflate
+            instead of zlib streams
+        """
+        try:
+            return self.decoder.decompress(raw)
+        except zlib.error:
+            if self.encoding != "deflate" or self.wire_bytes != len(raw):
+                raise IOError("bad %s body" % self.encoding)
+            self.encoding      = "raw deflate"
+            self.decoder       = zlib.decompressobj(-zlib.MAX_WBITS)
+            return self.decoder.decompress(raw)
+
+    #---------------------------------------------------------------
+    def drain(self):
+        """
+            read the rest of a small body so the connection can be reused
+        """
+        if int(self.response.getheader("Content-Length") or READ_CHUNK + 1) <= READ_CHUNK:
+            self.response.read()
+            self.eof           = True
+
+#---------------------------------------------------------------
+class HttpPool:
+    """
+        Keep-alive connections per (scheme, host, port) shared by the
+        download threads and kept between daemon runs
+    """
+    #---------------------------------------------------------------
+    def __init__(self):
+        self.lock              = threading.Lock()             # guards idle
+        self.idle              = dict()                       # key -> [(connection, released at)]
+
+    #---------------------------------------------------------------
+    def connection(self, key, timeout):
+        """
+            an idle connection for key or a new one, the flag is True
+            for reused connections
+        """
+        now                    = time.time()
+        with self.lock:
+            idle               = self.idle.get(key, list())
+            while idle:
+                conn, released = idle.pop()
+                if now - released < HTTP_IDLE_SECONDS:
+                    conn.timeout = timeout
+                    if conn.sock:
+                        conn.sock.settimeout(timeout)
+                    return conn, True
+                conn.close()
+        return self.connect(key, timeout), False
+
+    #---------------------------------------------------------------
+    def connect(self, key, timeout):
+        """
+            a new connection for key
+        """
+        scheme, host, port     = key
+        factory                = httplib.HTTPSConnection if scheme == "https" else httplib.HTTPConnection
+        return factory(host, port, timeout=timeout)
+
+    #---------------------------------------------------------------
+    def open(self, url, headers, timeout, max_bytes):
+        """
+            GET url following at most HTTP_MAX_REDIRECTS redirects,
+            returns an HttpResponse which has to be passed to release()
+        """
+        headers                = dict(headers, **{"Accept-Encoding": "gzip, deflate", "Connection": "keep-alive"})
+        for redirect in range(HTTP_MAX_REDIRECTS + 1):
+            parts              = urlparse.urlsplit(url)
+            if parts.scheme not in ("http", "https"):
+                raise httplib.HTTPException("unsupported url")
+            key                = (parts.scheme, parts.hostname, parts.port)
+            path               = urlparse.urlunsplit(("", "", parts.path or "/", parts.query, ""))
+
+            conn, reused       = self.connection(key, timeout)
+            try:
+                conn.request("GET", path, headers=dict(headers, Host=parts.netloc))
+                response       = conn.getresponse()
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                if not reused:
+                    raise
+                # the server closed an idle connection, retry on a fresh one
+                conn           = self.connect(key, timeout)
+                try:
+                    conn.request("GET", path, headers=dict(headers, Host=parts.netloc))
+                    response   = conn.getresponse()
+                except:
+                    conn.close()
+                    raise
+
+            result             = HttpResponse(key, conn, response, max_bytes)
+            location           = response.getheader("Location")
+            if response.status not in (301, 302, 303, 307, 308) or not location:
+                return result
+            result.drain()
+            self.release(result)
+            url                = urlparse.urljoin(url, location)
+        raise httplib.HTTPException("more than %d redirects" % HTTP_MAX_REDIRECTS)
+
+    #---------------------------------------------------------------
+    def release(self, result):
+        """
+            return a fully read connection to the pool, close others
+        """
+        if not result.eof or result.response.will_close:
+            result.conn.close()
+            return
+        with self.lock:
+            idle               = self.idle.setdefault(result.key, list())
+            idle.append((result.conn, time.time()))
+            while len(idle) > HTTP_POOL_SIZE:
+                idle.pop(0)[0].close()
+
+#---------------------------------------------------------------
+class FeedCache:
+    """
+        On disk copy of every feed body with its HTTP validators
+    """
+    #---------------------------------------------------------------
+    def __init__(self, path):
+        self.path              = path                         # cache directory
+
+    #---------------------------------------------------------------
+    def filename(self, url, ext):
+        """
+            cache file name for a feed
+        """
+        return os.path.join(self.path, "%s.%s" % (hashlib.sha1(url).hexdigest(), ext))
+
+    #---------------------------------------------------------------
+    def meta(self, url):
+        """
+            stored ETag, Last-Modified and sha1 of a feed, empty if not cached
+        """
+        try:
+            with open(self.filename(url, "json")) as fh:
+                meta           = json.load(fh)
+            if os.path.exists(self.filename(url, "body")):
+                return meta
+        except (IOError, ValueError):
+            pass
+        return dict()
+
+    #---------------------------------------------------------------
+    def headers(self, url):
+        """
+            conditional request headers for a feed
+        """
+        meta                   = self.meta(url)
+        headers                = dict()
+        if meta.get("etag"):
+            headers["If-None-Match"]     = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+        return headers
+
+    #---------------------------------------------------------------
+    def body(self, url):
+        """
+            file name of the cached body of a feed or None
+        """
+        filename               = self.filename(url, "body")
+        if os.path.exists(filename):
+            return filename
+        return None
+
+    #---------------------------------------------------------------
+    def store(self, url, chunks, etag, last_modified):
+        """
+            stream a feed body to disk chunk by chunk and write its
+            validators, returns (body file name, body sha1)
+        """
+        filename               = self.filename(url, "body")
+        sha1                   = hashlib.sha1()
+
+        def hashed():
+            for chunk in chunks:
+                sha1.update(chunk)
+                yield chunk
+
+        atomic_write(filename, hashed())
+        digest                 = sha1.hexdigest()
+        meta                   = {"url": url, "etag": etag, "last_modified": last_modified, "sha1": digest}
+        self.write(self.filename(url, "json"), json.dumps(meta))
+        return filename, digest
+
+    #---------------------------------------------------------------
+    def forget(self, url):
+        """
+            drop the validators of a feed so it is fetched in full and
+            counts as changed next time, the body stays as a fallback
+        """
+        try:
+            os.unlink(self.filename(url, "json"))
+        except OSError:
+            pass
+
+    #---------------------------------------------------------------
+    def applied(self):
+        """
+            (fingerprint of the feeds behind the last successful apply,
+            earliest release of an entry held by the grace period or None)
+        """
+        try:
+            with open(os.path.join(self.path, "applied")) as fh:
+                fields         = fh.read().split()
+        except IOError:
+            return None, None
+        if len(fields) > 1 and fields[1].isdigit():
+            return fields[0], int(fields[1])
+        return (fields or [None])[0], None
+
+    #---------------------------------------------------------------
+    def mark_applied(self, fingerprint, held_until=None):
+        """
+            remember the fingerprint of the feeds just applied and when
+            the grace period next releases an entry
+        """
+        try:
+            self.write(os.path.join(self.path, "applied"), fingerprint + ("" if held_until is None else " %d" % held_until) + "\n")
+        except (IOError, OSError) as error:
+            syslog.syslog(syslog.LOG_WARNING, "Cannot write %s: %s" % (self.path, error))
+
+    #---------------------------------------------------------------
+    def write(self, filename, data):
+        """
+            replace a cache file atomically
+        """
+        atomic_write(filename, [data])
+
+#---------------------------------------------------------------
+class RunStats:
+    """
+        Timings and counters of one update run
+    """
+    #---------------------------------------------------------------
+    def __init__(self):
+        self.lock              = threading.Lock()             # feeds are recorded by the download threads
+        self.started           = time.time()                  # run start
+        self.stages            = dict()                       # stage -> seconds
+        self.feeds             = dict()                       # url -> counters
+        self.sets              = dict()                       # set name -> merge and Ipset.last counters
+
+    #---------------------------------------------------------------
+    @contextlib.contextmanager
+    def timer(self, stage):
+        """
+            add the wall time of a block to a stage
+        """
+        started                = time.time()
+        try:
+            yield
+        finally:
+            self.stages[stage] = round(self.stages.get(stage, 0) + time.time() - started, 3)
+
+    #---------------------------------------------------------------
+    def feed(self, url, **counters):
+        """
+            record counters of a feed
+        """
+        with self.lock:
+            self.feeds.setdefault(url, dict()).update(counters)
+
+    #---------------------------------------------------------------
+    def report(self):
+        """
+            the run as a JSON friendly dict
+        """
+        return {
+            "started"          : int(self.started),
+            "seconds"          : round(time.time() - self.started, 3),
+            "stages"           : self.stages,
+            "feeds"            : self.feeds,
+            "sets"             : self.sets,
+        }
+
+    #---------------------------------------------------------------
+    def write_json(self, filename):
+        """
+            write the run report as JSON
+        """
+        self.write(filename, json.dumps(self.report(), indent=2, sort_keys=True) + "\n")
+
+    #---------------------------------------------------------------
+    def write_prometheus(self, filename):
+        """
+            write the run report in node_exporter textfile format
+        """
+        report                 = self.report()
+        lines                  = list()
+
+        def metric(name, help, samples):
+            lines.append("# HELP bogon_%s %s" % (name, help))
+            lines.append("# TYPE bogon_%s gauge" % name)
+            for labels, value in samples:
+                label          = ",".join('%s="%s"' % (key, str(val).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for key, val in labels)
+                lines.append("bogon_%s%s %s" % (name, "{%s}" % label if label else "", float(value)))
+
+        feeds                  = sorted(report["feeds"].items())
+        sets                   = sorted(report["sets"].items())
+        metric("run_timestamp_seconds", "Start time of the last run.", [((), report["started"])])
+        metric("run_duration_seconds", "Wall time of the last run.", [((), report["seconds"])])
+        metric("stage_duration_seconds", "Wall time per pipeline stage.", [((("stage", stage),), seconds) for stage, seconds in sorted(report["stages"].items())])
+        metric("feed_duration_seconds", "Wall time spent downloading a feed.", [((("feed", url),), feed.get("seconds", 0)) for url, feed in feeds])
+        metric("feed_bytes", "Decoded bytes of a feed body fetched from the network.", [((("feed", url),), feed.get("bytes", 0)) for url, feed in feeds])
+        metric("feed_wire_bytes", "Bytes of a feed body received on the wire, before content decoding.", [((("feed", url),), feed.get("wire_bytes", 0)) for url, feed in feeds])
+        metric("feed_entries", "Entries parsed from a feed.", [((("feed", url),), feed["entries"]) for url, feed in feeds if "entries" in feed])
+        metric("feed_up", "1 if the feed was downloaded or not modified, 0 if a cached copy was used or nothing.", [((("feed", url),), feed.get("status") in ("downloaded", "not_modified")) for url, feed in feeds])
+        metric("set_feeds", "Feeds merged into the set.", [((("set", name),), counters["feeds"]) for name, counters in sets])
+        metric("entries_parsed", "Entries parsed from the feeds of the set.", [((("set", name),), counters["parsed"]) for name, counters in sets])
+        metric("entries_kept", "Entries left after aggregation.", [((("set", name),), counters["kept"]) for name, counters in sets])
+        metric("aggregation_ratio", "Kept over parsed entries.", [((("set", name),), counters["ratio"]) for name, counters in sets])
+        metric("ranges_excluded", "Aggregated ranges dropped by the allow list.", [((("set", name),), counters["excluded"]) for name, counters in sets])
+        metric("index_records", "Records of the provenance index.", [((("set", name),), counters["index_records"]) for name, counters in sets if "index_records" in counters])
+        metric("ranges_held", "Ranges missing from the feeds kept by the grace period.", [((("set", name),), counters["held"]) for name, counters in sets])
+        metric("ranges_split", "Aggregated ranges cut or split by the allow list.", [((("set", name),), counters["split"]) for name, counters in sets])
+        for key, help in (("added", "Entries added to the set."), ("deleted", "Entries deleted from the set."), ("unchanged", "Entries left in place."),
+                          ("entries", "Aggregated entries applied to the set."), ("stored", "Kernel entries the aggregated entries are stored as."),
+                          ("prefix_lengths", "Distinct network prefix lengths, one hash:net probe each."), ("read_seconds", "Time spent loading the current set."),
+                          ("apply_seconds", "Time spent applying changes, shared by the sets of one restore."), ("ipset_calls", "ipset processes the set took part in."),
+                          ("resized", "Member sets rebuilt at a larger size.")):
+            metric("set_" + key, help, [((("set", name),), counters[key]) for name, counters in sets if key in counters])
+        self.write(filename, "\n".join(lines) + "\n")
+
+    #---------------------------------------------------------------
+    def write(self, filename, data):
+        """
+            replace a report atomically, collectors never see a partial file
+        """
+        try:
+            atomic_write(filename, [data])
+        except (IOError, OSError) as error:
+            syslog.syslog(syslog.LOG_WARNING, "Cannot write report %s: %s" % (filename, error))
+
+#---------------------------------------------------------------
+class Updater:
+    """
+        Download and Parse files
+    """
+    #---------------------------------------------------------------
+    def __init__(self, url, mode, apply_mode="batch", workers=DOWNLOAD_WORKERS, deadline=DOWNLOAD_DEADLINE, force=False, state_dir=STATE_DIR, shards=1, layout="net",
+                 grace_runs=GRACE_RUNS, grace_seconds=GRACE_SECONDS):
+        self.urls              = url                                              # download url
+        self.mode              = mode                                             # address families
+        self.options           = (apply_mode, state_dir, shards, layout)          # Ipset arguments
+        self.grace_options     = (grace_runs, grace_seconds)                      # GracePeriod arguments
+        self.oips              = list()                                           # ipset objects, set major, family minor
+        self.sources           = dict()                                           # set name -> feed urls, None all
+        self.currentstor       = dict()                                           # merged (network, prefix) keys per set name
+        self.feeds             = dict()                                           # url -> {bits: (starts, ends)} parsed ranges
+        self.digests           = dict()                                           # url -> sha1 of the parsed body
+        self.broken            = set()                                            # urls that failed to parse with nothing parsed before
+        self.workers           = workers                                          # download threads
+        self.deadline          = deadline                                         # seconds for all downloads
+        self.cache             = FeedCache(os.path.join(state_dir, "cache"))      # feed body cache
+        self.http              = HttpPool()                                       # keep-alive connections per host
+        self.state_dir         = state_dir                                        # journals and provenance indexes
+        self.exclude           = dict()                                           # bits -> allow listed (starts, ends)
+        self.grace             = dict()                                           # set name -> GracePeriod, empty when off
+        self.force             = force                                            # apply unchanged feeds
+        self.stats             = RunStats()                                       # timings and counters of the current run
+        self.configure()
+
+    #---------------------------------------------------------------
+    def configure(self):
+        """
+            Build the sets of FEED_SETS, sets already known keep their
+            applied content
+        """
+        known                  = dict((oip.setname, oip) for oip in self.oips)
+        self.oips              = list()
+        self.sources.clear()
+        for name, options in sorted(FEED_SETS.items()):
+            for inet in INET_MODES[self.mode]:
+                oip            = known.get(inet + name) or Ipset(inet, *self.options, name=name)
+                self.oips.append(oip)
+                self.sources[oip.setname] = options.get("feeds")
+                if any(self.grace_options) and oip.setname not in self.grace:
+                    self.grace[oip.setname] = GracePeriod(os.path.join(self.state_dir, oip.setname + ".grace"), oip.bits, *self.grace_options)
+
+    #---------------------------------------------------------------
+    def fetch_all(self, urls):
+        """
+            Download feeds on a bounded pool of worker threads and return
+            the (body file, sha1) pairs which finished before the deadline,
+            feeds still pending at the deadline fall back to their cached copy
+        """
+        pending                = Queue.Queue()
+        results                = dict()
+        expires                = time.time() + self.deadline
+
+        for url in urls:
+            pending.put(url)
+
+        def worker():
+            while True:
+                try:
+                    url        = pending.get_nowait()
+                except Queue.Empty:
+                    return
+                started        = time.time()
+                results[url]   = self.download(url, expires)
+                self.stats.feed(url, seconds=round(time.time() - started, 3))
+
+        threads                = [threading.Thread(target=worker) for i in range(min(self.workers, len(urls)))]
+        for thread in threads:
+            thread.daemon      = True                                             # never block exit on a hung feed
+            thread.start()
+
+        for thread in threads:
+            thread.join(max(0, expires - time.time()))
+
+        finished               = dict(results)
+        for url in urls:
+            if url not in finished:
+                syslog.syslog(syslog.LOG_ERR, "Download deadline exceeded: %s" % url)
+                cached         = self.cached(url)
+                if cached:
+                    syslog.syslog(syslog.LOG_NOTICE, "Using cached copy of %s" % url)
+                self.stats.feed(url, status="cached" if cached else "timeout", bytes=0, wire_bytes=0)
+                finished[url]  = cached
+        return finished
+
+    #---------------------------------------------------------------
+    def download(self, url, expires):
+        """
+            Stream a feed into the cache unless the cached copy is still
+            current, returns (body file, sha1) or None when nothing usable exists
+        """
+        try:
+            data               = self.http.open(url, self.cache.headers(url), feed_option(url, "connect_timeout"), feed_option(url, "max_bytes"))
+            try:
+                if data.status == 200:
+                    chunks     = self.read_body(data, min(expires, time.time() + feed_option(url, "read_timeout")))
+                    body, digest = self.cache.store(url, chunks, data.getheader("ETag"), data.getheader("Last-Modified"))
+                    syslog.syslog(syslog.LOG_INFO, "Downloaded %s: %d bytes on the wire, %d decoded" % (url, data.wire_bytes, data.decoded_bytes))
+                    self.stats.feed(url, status="downloaded", bytes=data.decoded_bytes, wire_bytes=data.wire_bytes)
+                    return body, digest
+                if data.status == 304:
+                    data.drain()
+                    self.stats.feed(url, status="not_modified", bytes=0, wire_bytes=0)
+                    return self.cached(url)
+                syslog.syslog(syslog.LOG_ERR, "HTTP Error: %s %s" % (data.status, url))
+            finally:
+                self.http.release(data)
+
+        except FeedTooLarge as error:
+            syslog.syslog(syslog.LOG_ERR, "Feed too large: %s %s" % (error, url))
+        except httplib.HTTPException as error:
+            syslog.syslog(syslog.LOG_ERR, "HTTP Error: %s %s" % (error or error.__class__.__name__, url))
+        except (socket.timeout, socket.error) as error:
+            syslog.syslog(syslog.LOG_ERR, "Socket Error: %s %s" % (error, url))
+        except (IOError, OSError) as error:
+            syslog.syslog(syslog.LOG_ERR, "Cache Error: %s %s" % (error, url))
+
+        cached                 = self.cached(url)
+        if cached:
+            syslog.syslog(syslog.LOG_NOTICE, "Using cached copy of %s" % url)
+        self.stats.feed(url, status="cached" if cached else "failed", bytes=0, wire_bytes=0)
+        return cached
+
+    #---------------------------------------------------------------
+    def cached(self, url):
+        """
+            (body file, sha1) of the cached copy of a feed or None
+        """
+        body                   = self.cache.body(url)
+        if body is None:
+            return None
+        return body, self.cache.meta(url).get("sha1")
+
+    #---------------------------------------------------------------
+    def read_body(self, data, expires):
+        """
+            Yield a response in chunks, giving up once expires has passed
+        """
+        while True:
+            if time.time() > expires:
+                raise socket.timeout("read timeout")
+            chunk              = data.read(READ_CHUNK)
+            if not chunk:
+                return
+            yield chunk
+
+    #---------------------------------------------------------------
+    def parse(self, url, body):
+        """
+            Stream a feed through the parser registered for its format
+            into the compact range buffers of each address family,
+            returns False and keeps what was parsed before on errors
+        """
+        parser                 = FEED_FORMATS.get(feed_option(url, "format"))
+        if parser is None:
+            syslog.syslog(syslog.LOG_ERR, "Unknown feed format %s: %s" % (feed_option(url, "format"), url))
+            return False
+
+        ranges                 = dict((bits, (new_buffer(bits), new_buffer(bits))) for bits in (32, 128))
+        try:
+            for bits, start, end in parser(read_body_lines(body, feed_option(url, "member")), url):
+                starts, ends   = ranges[bits]
+                starts.append(start)
+                ends.append(end)
+        except (IOError, EOFError, zipfile.BadZipfile, zlib.error, struct.error, csv.Error) as error:  # struct.error: gzip trailer cut short
+            syslog.syslog(syslog.LOG_ERR, "Cannot parse %s: %s" % (url, error))
+            return False
+        except KeyError as error:                                                 # zip member missing from the archive
+            syslog.syslog(syslog.LOG_ERR, "Cannot parse %s: no member %s" % (url, error))
+            return False
+        self.feeds[url]        = ranges
+        self.stats.feed(url, entries=sum(len(starts) for starts, ends in ranges.values()))
+        return True
+
+    #---------------------------------------------------------------
+    def refresh(self, urls):
+        """
+            Download the given feeds and reparse the changed ones,
+            returns True if any changed
+        """
+        with self.stats.timer("download"):
+            bodies             = self.fetch_all(urls)
+        with self.stats.timer("parse"):
+            return self.update(bodies)
+
+    #---------------------------------------------------------------
+    def update(self, bodies):
+        """
+            Reparse the downloaded feeds whose body changed since they
+            were last parsed, returns True if any did
+        """
+        changed                = False
+        for url in self.urls:
+            if bodies.get(url) is None:
+                continue
+            body, digest       = bodies[url]
+            if url in self.feeds and self.digests.get(url) == digest:
+                continue
+            if not self.parse(url, body):
+                self.cache.forget(url)                                            # download it in full next time
+                if url not in self.feeds:
+                    self.broken.add(url)
+                    syslog.syslog(syslog.LOG_WARNING, "Keeping the sets of %s as they are" % url)
+                else:
+                    syslog.syslog(syslog.LOG_WARNING, "Keeping the previous entries of %s" % url)
+                self.stats.feed(url, parse_error=True)
+                continue
+            self.digests[url]  = digest
+            self.broken.discard(url)
+            changed            = True
+        return changed
+
+    #---------------------------------------------------------------
+    def fingerprint(self, digests):
+        """
+            Combined hash of the feed bodies and the settings they are
+            parsed with, the allow list, the sets behind a merge and the
+            options shaping them
+        """
+        apply_mode, state_dir, shards, layout = self.options
+        lines                  = ["%s %s %s" % (url, digests[url], json.dumps([feed_option(url, key) for key in PARSE_OPTIONS]))
+                                  for url in self.urls if url in digests]
+        lines.extend("exclude %s" % entry for entry in EXCLUDE_NETS)
+        lines.extend("set %s %s" % (oip.setname, " ".join(self.sources[oip.setname] or ["*"])) for oip in self.oips)
+        lines.append("layout %s shards %d" % (layout, shards))
+        lines.append("grace runs %d seconds %d" % self.grace_options)
+        return hashlib.sha1("\n".join(lines)).hexdigest()
+
+    #---------------------------------------------------------------
+    def merge(self):
+        """
+            Aggregate everything parsed from the feeds of every set
+        """
+        for url in list(self.feeds):
+            if url not in self.urls:
+                del self.feeds[url]                                               # dropped from the config
+                self.digests.pop(url, None)
+        self.broken.intersection_update(self.urls)
+
+        self.exclude           = exclude = parse_exclude(EXCLUDE_NETS)
+        for oip in self.oips:
+            bits               = oip.bits
+            if self.broken.intersection(self.sources[oip.setname] or self.urls):
+                self.currentstor[oip.setname] = KeyBuffer(bits)                   # left alone, a feed is missing
+                continue
+            feeds              = [self.feeds[url][bits] for url in self.sources[oip.setname] or self.urls if url in self.feeds]
+            ranges             = itertools.chain.from_iterable(itertools.izip(*feed) for feed in feeds)
+            starts, ends       = aggregate_ranges(ranges, bits)
+
+            held               = 0
+            grace              = self.grace.get(oip.setname)
+            if grace and len(starts):
+                starts, ends   = grace.update(starts, ends)
+                held           = len(grace.held[0])
+                if held:
+                    syslog.syslog(syslog.LOG_INFO, "%s | Held : %s" % (oip.setname, held))
+
+            removed = split    = 0
+            if len(exclude[bits][0]):
+                starts, ends, removed, split = subtract_ranges(starts, ends, exclude[bits][0], exclude[bits][1], bits)
+                if removed or split:
+                    syslog.syslog(syslog.LOG_INFO, "%s | Excluded : %s | Split : %s" % (oip.setname, removed, split))
+
+            keys               = KeyBuffer(bits)
+            for start, end in itertools.izip(starts, ends):
+                keys.extend(range_to_cidrs(start, end, bits))
+            self.currentstor[oip.setname] = keys
+
+            parsed             = sum(len(starts) for starts, ends in feeds)
+            kept               = len(keys)
+            self.stats.sets[oip.setname] = {"feeds": len(feeds), "parsed": parsed, "kept": kept, "ratio": round(float(kept) / parsed, 4) if parsed else 0,
+                                            "excluded": removed, "split": split, "held": held}
+
+    #---------------------------------------------------------------
+    def apply(self):
+        """
+            Merge all parsed feeds and process every set whose merged
+            content differs from what was last applied
+        """
+        with self.stats.timer("merge"):
+            self.merge()
+
+        applied                = True
+        processed              = False
+        changed                = list()
+        for oip in self.oips:
+            netlist            = self.currentstor[oip.setname]
+            if len(netlist) == 0:
+                continue
+            processed          = True
+            if not oip.loaded or netlist != oip.netlist:
+                changed.append(oip)
+
+        if changed:
+            with self.stats.timer("ipset"):
+                applied        = self.transaction(changed)
+            for oip in changed:
+                self.stats.sets[oip.setname].update(oip.last)
+
+        for oip in self.oips:
+            if oip.loaded and len(self.currentstor[oip.setname]):
+                # feed membership may change without changing the merged set
+                with self.stats.timer("index"):
+                    self.index(oip)
+
+        if not processed:
+            if not self.broken:
+                syslog.syslog(syslog.LOG_NOTICE, "Download failed!")
+            return False
+        if applied:
+            self.cache.mark_applied(self.fingerprint(self.digests), self.held_until())
+        return applied
+
+    #---------------------------------------------------------------
+    def in_step(self):
+        """
+            True if every set still holds what was last applied to it,
+            from one terse list of the kernel sets
+        """
+        kernel                 = ipset_headers()
+        drifted                = [oip.setname for oip in self.oips if not oip.in_step(kernel)]
+        if drifted:
+            syslog.syslog(syslog.LOG_NOTICE, "Journal out of step with the kernel: %s" % ", ".join(drifted))
+        return not drifted
+
+    #---------------------------------------------------------------
+    def held_until(self):
+        """
+            earliest time the grace period releases an entry, 0 when the
+            next merge may, None when nothing is held
+        """
+        expires                = [grace.expires for grace in self.grace.values() if grace.expires is not None]
+        return min(expires) if expires else None
+
+    #---------------------------------------------------------------
+    def transaction(self, oips):
+        """
+            Diff every set against its merged content and stream all
+            changes into one ipset restore, returns True if every set
+            was applied
+        """
+        kernel                 = ipset_headers()                                 # one terse list for all sets
+        cmds                   = list()
+        for oip in oips:
+            prepared           = oip.prepare(self.currentstor[oip.setname], kernel)
+            if prepared:
+                cmds.append(prepared)
+
+        started                = time.time()
+        restored               = not cmds or ipset_restore(itertools.chain.from_iterable(cmds))
+        seconds                = time.time() - started
+
+        applied                = True
+        for oip in oips:
+            oip.calls += 1 + bool(cmds)                                           # the shared list and restore
+            applied            = oip.commit(restored, seconds) and applied
+        return applied
+
+    #---------------------------------------------------------------
+    def index(self, oip):
+        """
+            Rebuild the provenance index of a set from its parsed feeds
+        """
+        feeds                  = dict((url, self.feeds[url][oip.bits]) for url in self.sources[oip.setname] or self.urls if url in self.feeds)
+        if oip.setname in self.grace:
+            feeds[GRACE_FEED]  = self.grace[oip.setname].held
+        index                  = ProvenanceIndex(os.path.join(self.state_dir, oip.setname + ".index"), oip.bits)
+        self.stats.sets[oip.setname]["index_records"] = index.rebuild(feeds, self.exclude[oip.bits])
+
+#---------------------------------------------------------------
+    def run(self):
+        """
+            main run func
+        """
+        self.stats             = RunStats()
+        with self.stats.timer("download"):
+            bodies             = self.fetch_all(self.urls)
+        digests                = dict((url, bodies[url][1]) for url in self.urls if bodies.get(url) is not None)
+
+        fingerprint, held_until = self.cache.applied()
+        if digests and not self.force and self.fingerprint(digests) == fingerprint and (held_until is None or held_until > time.time()) and self.in_step():
+            syslog.syslog(syslog.LOG_INFO, "Feeds unchanged, nothing to do")
+            return
+
+        with self.stats.timer("parse"):
+            self.update(bodies)
+        self.apply()
+
+    #---------------------------------------------------------------
+    def write_report(self, json_report=None, prom_report=None):
+        """
+            Write the stats of the last run
+        """
+        if json_report:
+            self.stats.write_json(json_report)
+        if prom_report:
+            self.stats.write_prometheus(prom_report)
+
+#---------------------------------------------------------------
+class Daemon:
+    """
+        Long running updater, refreshes every feed on its own interval
+    """
+    #---------------------------------------------------------------
+    def __init__(self, updater, config, json_report=None, prom_report=None):
+        self.updater           = updater                      # keeps parsed feeds and applied sets in memory
+        self.config            = config                       # config file reloaded on SIGHUP
+        self.reports           = (json_report, prom_report)   # written after every wakeup with work
+        self.due               = dict()                       # url -> next refresh time
+        self.retry             = None                         # time to retry a failed apply
+        self.reload            = False                        # SIGHUP seen
+        self.refresh           = False                        # SIGUSR1 seen
+        self.stop              = False                        # SIGTERM/SIGINT seen
+
+    #---------------------------------------------------------------
+    def signal(self, signum, frame):
+        """
+            record a signal, the main loop acts on it after waking up
+        """
+        if signum == signal.SIGHUP:
+            self.reload        = True
+        elif signum == signal.SIGUSR1:
+            self.refresh       = True
+        else:
+            self.stop          = True
+
+    #---------------------------------------------------------------
+    def schedule(self, url, now):
+        """
+            next refresh of a feed, interval +/- jitter
+        """
+        interval               = feed_option(url, "interval")
+        jitter                 = feed_option(url, "jitter")
+        self.due[url]          = now + interval * (1 + random.uniform(-jitter, jitter))
+
+    #---------------------------------------------------------------
+    def run(self):
+        """
+            main daemon loop
+        """
+        for signum in (signal.SIGHUP, signal.SIGUSR1, signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, self.signal)
+        self.write_pid()
+
+        while not self.stop:
+            if self.reload:
+                self.reload    = False
+                urls           = load_config(self.config)
+                if urls is not None:
+                    syslog.syslog(syslog.LOG_NOTICE, "Configuration reloaded")
+                    self.updater.urls  = urls
+                    self.updater.configure()
+                    self.updater.digests.clear()              # feed settings may have changed, reparse all
+                    self.due.clear()
+
+            if self.refresh:
+                self.refresh   = False
+                self.due.clear()
+
+            now                = time.time()
+            due                = [url for url in self.updater.urls if self.due.get(url, 0) <= now]
+            held_until         = self.updater.held_until()                  # a held entry is due for release
+            if due:
+                self.updater.stats = RunStats()
+                changed        = self.updater.refresh(due)
+                for url in due:
+                    self.schedule(url, time.time())
+                if changed or held_until is not None and held_until <= now:
+                    self.retry = None
+                    if not self.updater.apply():
+                        self.retry = time.time() + RETRY_INTERVAL
+                self.updater.write_report(*self.reports)
+            elif self.retry and self.retry <= now or held_until and held_until <= now:
+                self.retry     = None
+                self.updater.stats = RunStats()
+                if not self.updater.apply():
+                    self.retry = time.time() + RETRY_INTERVAL
+                self.updater.write_report(*self.reports)
+
+            held_until         = self.updater.held_until()
+            wakeups            = self.due.values() + ([self.retry] if self.retry else []) + ([held_until] if held_until else [])
+            if wakeups and not (self.stop or self.reload or self.refresh):
+                time.sleep(max(1, min(wakeups) - time.time()))   # cut short by signals
+
+        self.remove_pid()
+
+    #---------------------------------------------------------------
+    def write_pid(self):
+        """
+            write the pid file used to signal the daemon
+        """
+        try:
+            with open(PID_FILE, "w") as fh:
+                fh.write("%d\n" % os.getpid())
+        except IOError as error:
+            syslog.syslog(syslog.LOG_WARNING, "Cannot write %s: %s" % (PID_FILE, error))
+
+    #---------------------------------------------------------------
+    def remove_pid(self):
+        """
+            remove the pid file on exit
+        """
+        try:
+            os.unlink(PID_FILE)
+        except OSError:
+            pass
+
+#---------------------------------------------------------------
+def query(addresses, state_dir):
+    """
+        Print which sets and feeds block every address and since when
+    """
+    indexes                    = dict((bits, list()) for bits in INET_BITS.values())
+    for name in sorted(FEED_SETS):
+        for inet, bits in sorted(INET_BITS.items()):
+            index              = ProvenanceIndex(os.path.join(state_dir, inet + name + ".index"), bits)
+            index.open()
+            indexes[bits].append((inet + name, index))
+
+    for address in addresses:
+        address                = address.strip()
+        if not address:
+            continue
+        parsed                 = parse_address(address)
+        if parsed is None:
+            print "%s\tinvalid" % address
+            continue
+        blocked                = False
+        for setname, index in indexes[parsed[0]]:
+            found              = index.lookup(parsed[1])
+            if found is not None:
+                blocked        = True
+                urls, first    = found
+                print "%s\tblocked\t%s\t%s\t%s" % (address, setname, time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(first)), " ".join(urls))
+        if not blocked:
+            print "%s\tnot blocked" % address
+
+#---------------------------------------------------------------
+if __name__ == "__main__":
+    user_opts                  = get_args()
+    urls                       = load_config(user_opts.config) or IPV4_NETS_URL
+    if user_opts.query:
+        addresses              = user_opts.query
+        if addresses == ["-"]:
+            addresses          = sys.stdin
+        query(addresses, user_opts.state_dir)
+    elif user_opts.restore:
+        syslog.syslog(syslog.LOG_NOTICE, "Restoring emerging threats from journal...")
+        for name in sorted(FEED_SETS):
+            for inet in INET_MODES[user_opts.inet]:
+                Ipset(inet, state_dir=user_opts.state_dir, name=name).boot()                  # shards and layout come from the journal
+    else:
+        updater                = Updater(urls, user_opts.inet, user_opts.apply_mode, user_opts.workers, user_opts.deadline, user_opts.force, user_opts.state_dir, user_opts.shards, user_opts.layout,
+                                         user_opts.grace_runs, user_opts.grace_seconds)
+        if user_opts.daemon:
+            syslog.syslog(syslog.LOG_NOTICE, "Starting emerging threats daemon...")
+            Daemon(updater, user_opts.config, user_opts.json_report, user_opts.prom_report).run()
+            syslog.syslog(syslog.LOG_NOTICE, "Emerging threats daemon stopped.")
+        else:
+            syslog.syslog(syslog.LOG_NOTICE, "Starting emerging threats update...")
+            if user_opts.profile:
+                profiler       = cProfile.Profile()
+                profiler.runcall(updater.run)
+                profiler.dump_stats(user_opts.profile)
+            else:
+                updater.run()
+            updater.write_report(user_opts.json_report, user_opts.prom_report)
+            syslog.syslog(syslog.LOG_NOTICE, "Emerging threats update completed.")
     syslog.closelog()
 #     if Updater(IPV4_IPS_URL, "ips").run():
 #         logging.info('Successfully updated banned_ipv4_ips list.')
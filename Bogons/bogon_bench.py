@@ -0,0 +1,494 @@
+#!/usr/bin/env python
+import SimpleHTTPServer
+import SocketServer
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+"""
+---------------------------------------------------------------
+ Benchmark the bogon.py pipeline without a router or live feeds
+---------------------------------------------------------------
+
+ Synthetic feeds (a mix of /32 hosts, overlapping prefixes and
+ duplicates) are generated for every size, served from a local HTTP
+ server and applied through a fake ipset binary which records every
+ call. Each size runs in its own process so peak RSS is per size.
+
+ Per size three runs are timed:
+   cold - empty set, every entry is added
+   warm - same feeds again (-f), nothing changes
+   churn - a fraction of the entries replaced
+
+   bogon_bench.py -n 1000 10000 100000 1000000 -o results.json
+   bogon_bench.py                          # compare the counts with bogon_bench_baseline.json, exit 1 on a change
+   bogon_bench.py -save -b local.json      # record a baseline on this machine
+   bogon_bench.py -b local.json -timings   # also compare timings and peak RSS, exit 1 on regression
+
+ Every size runs -r times (3) and the fastest timings are kept, single
+ runs are too noisy to compare.
+
+ The comparison flags any change of the entry counts and ipset calls,
+ which the same seed reproduces on every machine. With -timings it also
+ flags timings and peak RSS more than -t slower or larger, only useful
+ against a baseline recorded on the same hardware.
+
+---------------------------------------------------------------
+"""
+SIZES                          = [1000, 10000, 100000, 1000000]
+FEED_MIX                       = {
+    "host"                     : 0.70,                        # single addresses
+    "net"                      : 0.20,                        # mostly /31../24, rarely down to /8, overlapping hosts and each other
+    "dup"                      : 0.10,                        # repeats of earlier entries
+}
+CHURN                          = 0.01                         # fraction of entries replaced in the churn run
+TOLERANCE                      = 0.25                         # allowed slowdown over the baseline
+REPEATS                        = 3                            # processes per size, the fastest timings are kept
+BASELINE                       = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bogon_bench_baseline.json")
+EXACT                          = ["kept", "stored", "added", "deleted", "ipset_calls", "restore_lines"]  # deterministic per seed
+FAKE_IPSET                     = r'''#!%(python)s
+"""
+    Recording stand-in for /sbin/ipset, sets live in a JSON state file
+"""
+import json
+import sys
+state, log                     = sys.argv[1], sys.argv[2]
+args                           = [arg for arg in sys.argv[3:] if arg not in ("-exist", "-!", "-q")]
+try:
+    sets                       = json.load(open(state))
+except (IOError, ValueError):
+    sets                       = dict()
+members                        = dict((name, set(value["members"])) for name, value in sets.items())
+
+def norm(entry):
+    return entry[:-3] if entry.endswith("/32") else entry
+
+def run(args):
+    op                         = args[0]
+    if op == "create":
+        sets.setdefault(args[1], {"type": " ".join(args[2:]), "members": []})
+        members.setdefault(args[1], set())
+    elif op == "flush":
+        members[args[1]]       = set()
+    elif op == "add":
+        members[args[1]].add(norm(args[2]))
+    elif op == "del":
+        members[args[1]].discard(norm(args[2]))
+    elif op == "swap":
+        sets[args[1]], sets[args[2]] = sets[args[2]], sets[args[1]]
+        members[args[1]], members[args[2]] = members[args[2]], members[args[1]]
+    elif op == "destroy":
+        sets.pop(args[1], None)
+        members.pop(args[1], None)
+    elif op == "list":
+        names                  = [arg for arg in args[1:] if not arg.startswith("-")] or sorted(sets)
+        for name in names:
+            if name not in sets:
+                sys.stderr.write("The set with the given name does not exist\n")
+                sys.exit(1)
+            kind               = sets[name]["type"].split()
+            out                = ["Name: %%s" %% name, "Type: %%s" %% kind[0], "Header: %%s" %% " ".join(kind[1:]),
+                                  "Number of entries: %%d" %% len(members[name]), "Members:"]
+            if "-t" not in args and "-n" not in args:
+                out.extend(members[name])
+            sys.stdout.write("\n".join(out) + "\n\n")
+
+lines                          = 0
+try:
+    if args[0] == "restore":
+        for line in sys.stdin:
+            if line.strip():
+                lines += 1
+                run(line.split())
+    else:
+        run(args)
+finally:
+    with open(log, "a") as fh:
+        fh.write("%%s %%d\n" %% (args[0], lines))
+for name in sets:
+    sets[name]["members"]      = sorted(members[name])
+json.dump(sets, open(state, "w"))
+'''
+
+#---------------------------------------------------------------
+def get_args():
+    """
+        Get arguments from command line
+    """
+    parser                     = argparse.ArgumentParser(
+        description            = 'Benchmark the bogon.py pipeline against synthetic feeds and a fake ipset.')
+
+    parser.add_argument(
+        '-n',
+        '-sizes',
+        default                = SIZES,
+        dest                   = 'sizes',
+        nargs                  = '+',
+        type                   = int,
+        help                   = 'Feed sizes (entries) to benchmark (default: %(default)s).')
+
+    parser.add_argument(
+        '-m',
+        '-mode',
+        default                = "batch",
+        dest                   = 'apply_mode',
+        help                   = 'bogon.py apply mode (default: %(default)s).')
+
+    parser.add_argument(
+        '-S',
+        '-shards',
+        default                = 1,
+        dest                   = 'shards',
+        type                   = int,
+        help                   = 'bogon.py member sets per family (default: %(default)s).')
+
+    parser.add_argument(
+        '-L',
+        '-layout',
+        default                = "net",
+        dest                   = 'layout',
+        help                   = 'bogon.py set layout (default: %(default)s).')
+
+    parser.add_argument(
+        '-s',
+        '-seed',
+        default                = 1,
+        dest                   = 'seed',
+        type                   = int,
+        help                   = 'Random seed of the synthetic feeds (default: %(default)s).')
+
+    parser.add_argument(
+        '-o',
+        '-output',
+        default                = None,
+        dest                   = 'output',
+        help                   = 'Write the results as JSON to this file (default: %(default)s).')
+
+    parser.add_argument(
+        '-b',
+        '-baseline',
+        default                = BASELINE,
+        dest                   = 'baseline',
+        help                   = 'Compare against this baseline file, none to skip (default: %(default)s).')
+
+    parser.add_argument(
+        '-save',
+        action                 = 'store_true',
+        default                = False,
+        dest                   = 'save',
+        help                   = 'Store the results as the new baseline instead of comparing (default: %(default)s).')
+
+    parser.add_argument(
+        '-r',
+        '-repeats',
+        default                = REPEATS,
+        dest                   = 'repeats',
+        type                   = int,
+        help                   = 'Runs per size, the fastest timings and lowest peak RSS are kept (default: %(default)s).')
+
+    parser.add_argument(
+        '-t',
+        '-tolerance',
+        default                = TOLERANCE,
+        dest                   = 'tolerance',
+        type                   = float,
+        help                   = 'Allowed slowdown over the baseline as a fraction (default: %(default)s).')
+
+    parser.add_argument(
+        '-timings',
+        action                 = 'store_true',
+        default                = False,
+        dest                   = 'timings',
+        help                   = 'Also compare timings and peak RSS, the baseline must come from this machine (default: %(default)s).')
+
+    parser.add_argument(
+        '-child',
+        default                = None,
+        dest                   = 'child',
+        type                   = int,
+        help                   = argparse.SUPPRESS)
+
+    return parser.parse_args()
+
+#---------------------------------------------------------------
+def generate_feed(filename, entries, rnd):
+    """
+        Write an Emerging Threats style feed with the FEED_MIX of
+        hosts, overlapping networks and duplicates
+    """
+    written                    = list()
+    with open(filename, "w") as fh:
+        fh.write("# synthetic feed, %d entries\n" % entries)
+        for i in xrange(entries):
+            pick               = rnd.random()
+            if written and pick < FEED_MIX["dup"]:
+                entry          = written[rnd.randrange(len(written))]
+            elif pick < FEED_MIX["dup"] + FEED_MIX["net"]:
+                prefix         = max(8, 31 - int(rnd.expovariate(0.5)))
+                network        = rnd.getrandbits(32) >> (32 - prefix) << (32 - prefix)
+                entry          = "%s/%d" % (dotted(network), prefix)
+            else:
+                entry          = dotted(rnd.getrandbits(32))
+            if len(written) < 65536:
+                written.append(entry)
+            fh.write("%s\n" % entry)
+
+#---------------------------------------------------------------
+def churn_feed(filename, fraction, rnd):
+    """
+        Replace a fraction of the lines of a feed by new hosts
+    """
+    with open(filename) as fh:
+        lines                  = fh.readlines()
+    for i in xrange(1, len(lines)):
+        if rnd.random() < fraction:
+            lines[i]           = "%s\n" % dotted(rnd.getrandbits(32))
+    with open(filename, "w") as fh:
+        fh.writelines(lines)
+
+#---------------------------------------------------------------
+def dotted(address):
+    """
+        32 bit integer to dotted quad
+    """
+    return "%d.%d.%d.%d" % (address >> 24, address >> 16 & 255, address >> 8 & 255, address & 255)
+
+#---------------------------------------------------------------
+class QuietHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    """
+        Serve the feed directory without logging every request
+    """
+    #---------------------------------------------------------------
+    def translate_path(self, path):
+        return os.path.join(self.server.root, os.path.basename(path.split("?", 1)[0]))
+
+    #---------------------------------------------------------------
+    def log_message(self, *args):
+        pass
+
+#---------------------------------------------------------------
+class FeedServer:
+    """
+        Local HTTP stand-in for the feed hosts
+    """
+    #---------------------------------------------------------------
+    def __init__(self, root):
+        self.root              = root                         # directory served
+        self.httpd             = None                         # SocketServer.TCPServer
+        self.thread            = None                         # serve_forever thread
+
+    #---------------------------------------------------------------
+    def __enter__(self):
+        self.httpd             = SocketServer.TCPServer(("127.0.0.1", 0), QuietHandler)
+        self.httpd.root        = self.root
+        self.thread            = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon     = True
+        self.thread.start()
+        return "http://127.0.0.1:%d/" % self.httpd.server_address[1]
+
+    #---------------------------------------------------------------
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+#---------------------------------------------------------------
+class FakeIpset:
+    """
+        Install the recording ipset stand-in and read back its calls
+    """
+    #---------------------------------------------------------------
+    def __init__(self, root):
+        self.state             = os.path.join(root, "ipset.json")       # set contents
+        self.log               = os.path.join(root, "ipset.log")        # one line per call
+        self.path              = os.path.join(root, "ipset")            # wrapper called by bogon.py
+        script                 = os.path.join(root, "fake_ipset.py")
+        with open(script, "w") as fh:
+            fh.write(FAKE_IPSET % {"python": sys.executable})
+        with open(self.path, "w") as fh:
+            fh.write('#!/bin/sh\nexec "%s" "%s" "%s" "%s" "$@"\n' % (sys.executable, script, self.state, self.log))
+        os.chmod(self.path, 0755)
+
+    #---------------------------------------------------------------
+    def calls(self):
+        """
+            (process count, restore lines) recorded since the last call
+        """
+        if not os.path.exists(self.log):
+            return 0, 0
+        with open(self.log) as fh:
+            records            = [line.split() for line in fh]
+        os.remove(self.log)
+        return len(records), sum(int(lines) for op, lines in records)
+
+    #---------------------------------------------------------------
+    def entries(self):
+        """
+            entries per set
+        """
+        with open(self.state) as fh:
+            return dict((name, len(value["members"])) for name, value in json.load(fh).items())
+
+#---------------------------------------------------------------
+def bench_size(entries, apply_mode, seed, shards=1, layout="net"):
+    """
+        Run cold, warm and churn updates over a feed of the given size
+        and return the timings of every run
+    """
+    import bogon
+
+    root                       = tempfile.mkdtemp(prefix="bogon-bench-")
+    try:
+        rnd                    = random.Random(seed)
+        feed                   = os.path.join(root, "feed.txt")
+        started                = time.time()
+        generate_feed(feed, entries, rnd)
+        generated              = time.time() - started
+
+        ipset                  = FakeIpset(root)
+        bogon.IPSET_PATH       = ipset.path
+        results                = {"entries": entries, "generate_seconds": round(generated, 3), "runs": dict()}
+
+        with FeedServer(root) as base:
+            url                = base + "feed.txt"
+            bogon.FEED_OPTIONS[url] = {"format": "list"}
+            for run in ("cold", "warm", "churn"):
+                if run == "churn":
+                    churn_feed(feed, CHURN, rnd)
+                updater        = bogon.Updater([url], "ipv4", apply_mode, force=True, state_dir=os.path.join(root, "state"), shards=shards, layout=layout)
+                started        = time.time()
+                updater.run()
+                seconds        = time.time() - started
+                calls, lines   = ipset.calls()
+                stats          = updater.stats.report()
+                setname        = updater.oips[0].setname
+                applied        = stats["sets"].get(setname, dict())
+                results["runs"][run] = {
+                    "seconds"          : round(seconds, 3),
+                    "entries_per_second" : int(entries / seconds) if seconds else 0,
+                    "stages"           : stats["stages"],
+                    "kept"             : applied.get("kept", 0),
+                    "stored"           : applied.get("stored", 0),
+                    "prefix_lengths"   : applied.get("prefix_lengths", 0),
+                    "added"            : applied.get("added", 0),
+                    "deleted"          : applied.get("deleted", 0),
+                    "ipset_calls"      : calls,
+                    "restore_lines"    : lines,
+                }
+        results["set_entries"] = ipset.entries().get(setname, 0)
+        results["peak_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return results
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+#---------------------------------------------------------------
+def fastest(repeats):
+    """
+        Merge the results of repeated runs of one size, keeping the
+        lowest time of every run and stage and the lowest peak RSS
+    """
+    result                     = repeats[0]
+    for other in repeats[1:]:
+        result["peak_rss_kb"]  = min(result["peak_rss_kb"], other["peak_rss_kb"])
+        for run, timings in result["runs"].items():
+            again              = other["runs"][run]
+            timings["seconds"] = min(timings["seconds"], again["seconds"])
+            for stage, seconds in timings["stages"].items():
+                timings["stages"][stage] = min(seconds, again["stages"].get(stage, seconds))
+    for timings in result["runs"].values():
+        timings["entries_per_second"] = int(result["entries"] / timings["seconds"]) if timings["seconds"] else 0
+    return result
+
+#---------------------------------------------------------------
+def compare(results, baseline, tolerance, timings=False):
+    """
+        Report every changed count and, with timings, every timing that
+        got slower than the baseline by more than tolerance, returns the
+        number of regressions
+    """
+    regressions                = 0
+    for size, result in sorted(results.items(), key=lambda item: int(item[0])):
+        base                   = baseline.get(size)
+        if not base:
+            print "%8s : no baseline" % size
+            continue
+        counts                 = [("set_entries", base.get("set_entries"), result["set_entries"])]
+        checks                 = [("peak_rss_kb", base["peak_rss_kb"], result["peak_rss_kb"])]
+        for run, measured in sorted(result["runs"].items()):
+            before             = base["runs"].get(run, dict())
+            counts.extend(("%s %s" % (run, key), before.get(key), measured[key]) for key in EXACT)
+            checks.append(("%s seconds" % run, before.get("seconds"), measured["seconds"]))
+            for stage, seconds in sorted(measured["stages"].items()):
+                checks.append(("%s %s" % (run, stage), before.get("stages", dict()).get(stage), seconds))
+        changed                = [(name, old, new) for name, old, new in counts if old is not None and old != new]
+        regressions += len(changed)
+        for name, old, new in changed:
+            print "%8s : %-24s %12s -> %12s          CHANGED" % (size, name, old, new)
+        if not changed:
+            print "%8s : counts match the baseline" % size
+        if not timings:
+            continue
+        for name, old, new in checks:
+            # sub 50ms stages are noise
+            if not old or max(old, new) < 0.05 and name != "peak_rss_kb":
+                continue
+            change             = float(new - old) / old
+            flag               = "REGRESSION" if change > tolerance else ""
+            regressions += bool(flag)
+            print "%8s : %-24s %12s -> %12s %+7.1f%% %s" % (size, name, old, new, change * 100, flag)
+    return regressions
+
+#---------------------------------------------------------------
+def summary(results):
+    """
+        Print one line per size and run
+    """
+    print "%8s %6s %9s %12s %8s %8s %8s %8s %8s %8s %6s %10s" % ("entries", "run", "seconds", "entries/s", "download", "parse", "merge", "ipset", "index", "kept", "calls", "rss kB")
+    for size, result in sorted(results.items(), key=lambda item: int(item[0])):
+        for run in ("cold", "warm", "churn"):
+            timings            = result["runs"][run]
+            stages             = timings["stages"]
+            print "%8s %6s %9.3f %12d %8.3f %8.3f %8.3f %8.3f %8.3f %8d %6d %10d" % (
+                size, run, timings["seconds"], timings["entries_per_second"], stages.get("download", 0), stages.get("parse", 0),
+                stages.get("merge", 0), stages.get("ipset", 0), stages.get("index", 0), timings["kept"], timings["ipset_calls"], result["peak_rss_kb"])
+
+#---------------------------------------------------------------
+if __name__ == '__main__':
+    user_opts                  = get_args()
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    if user_opts.child:
+        json.dump(bench_size(user_opts.child, user_opts.apply_mode, user_opts.seed, user_opts.shards, user_opts.layout), sys.stdout)
+        sys.exit(0)
+
+    results                    = dict()
+    for size in user_opts.sizes:
+        # one process per size and repeat, ru_maxrss never goes down
+        repeats                = [json.loads(subprocess.check_output([sys.executable, os.path.abspath(__file__), "-child", str(size), "-m", user_opts.apply_mode,
+                                                                      "-s", str(user_opts.seed), "-S", str(user_opts.shards), "-L", user_opts.layout]))
+                                  for repeat in range(max(1, user_opts.repeats))]
+        results[str(size)]     = fastest(repeats)
+    summary(results)
+
+    if user_opts.output:
+        with open(user_opts.output, "w") as fh:
+            json.dump(results, fh, indent=2, separators=(",", ": "), sort_keys=True)
+
+    # counts only compare between runs of the same options
+    options                    = {"apply_mode": user_opts.apply_mode, "seed": user_opts.seed, "shards": user_opts.shards, "layout": user_opts.layout}
+    if user_opts.save:
+        with open(user_opts.baseline, "w") as fh:
+            json.dump(dict(results, options=options), fh, indent=2, separators=(",", ": "), sort_keys=True)
+    elif user_opts.baseline != "none" and os.path.exists(user_opts.baseline):
+        with open(user_opts.baseline) as fh:
+            baseline           = json.load(fh)
+        if baseline.pop("options", options) != options:
+            print "baseline %s was recorded with other options, not compared" % user_opts.baseline
+        elif compare(results, baseline, user_opts.tolerance, user_opts.timings):
+            sys.exit(1)
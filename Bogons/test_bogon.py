@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+try:
+    import netaddr                                            # reference for the aggregation, optional
+except ImportError:
+    netaddr                    = None
+"""
+---------------------------------------------------------------
+ Tests of the bogon.py feed pipeline, no router or network needed
+---------------------------------------------------------------
+
+   python test_bogon.py
+   python -m unittest -v test_bogon
+
+---------------------------------------------------------------
+"""
+HERE                           = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+import bogon
+
+FEED_LINES                     = [100000, 800000]             # small and large synthetic feed, ~2 MB and ~17 MB
+OVERHEAD_KB                    = 4096                         # allowed RSS growth beyond the range buffers
+MERGE_ROUNDS                   = 300                          # random feeds compared against cidr_merge
+PARSE_CHILD                    = r'''
+import json
+import resource
+import sys
+import tempfile
+sys.path.insert(0, sys.argv[1])
+import bogon
+
+feed                           = sys.argv[2]
+url                            = "file://" + feed
+bogon.FEED_OPTIONS[url]        = {"format": "list"}
+updater                        = bogon.Updater([url], "ipv4", state_dir=tempfile.mkdtemp(prefix="bogon-test-"))
+before                         = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+updater.parse(url, feed)
+after                          = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+buffers                        = [buf for pair in updater.feeds[url].values() for buf in pair]
+json.dump({"growth_kb"         : after - before,
+           "buffer_kb"         : sum(len(buf) * getattr(buf, "itemsize", 8) for buf in buffers) // 1024,
+           "entries"           : len(updater.feeds[url][32][0])}, sys.stdout)
+'''
+
+#---------------------------------------------------------------
+def write_feed(filename, lines, rnd):
+    """
+        Write a list feed of hosts, /24 networks with trailing comments
+        and comment lines, returns the number of address lines
+    """
+    entries                    = 0
+    with open(filename, "w") as fh:
+        for i in xrange(lines):
+            pick               = rnd.random()
+            if pick < 0.1:
+                fh.write("# comment %s\n" % ("x" * 60))
+                continue
+            if pick < 0.3:
+                fh.write("%d.%d.%d.0/24 ; network\n" % (rnd.randrange(256), rnd.randrange(256), rnd.randrange(256)))
+            else:
+                fh.write("%d.%d.%d.%d\n" % (rnd.randrange(256), rnd.randrange(256), rnd.randrange(256), rnd.randrange(256)))
+            entries += 1
+    return entries
+
+#---------------------------------------------------------------
+class StreamingParseTest(unittest.TestCase):
+    """
+        Parsing a feed grows memory by its range buffers only, never by
+        a copy of the body
+    """
+    #---------------------------------------------------------------
+    def setUp(self):
+        self.root              = tempfile.mkdtemp(prefix="bogon-test-")
+
+    #---------------------------------------------------------------
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    #---------------------------------------------------------------
+    def parse(self, lines):
+        """
+            parse a synthetic feed in a fresh process, ru_maxrss never
+            goes down
+        """
+        feed                   = os.path.join(self.root, "feed-%d.txt" % lines)
+        entries                = write_feed(feed, lines, random.Random(lines))
+        output                 = subprocess.check_output([sys.executable, "-c", PARSE_CHILD, HERE, feed])
+        result                 = json.loads(output)
+        result["feed_kb"]      = os.path.getsize(feed) // 1024
+        self.assertEqual(result["entries"], entries)
+        return result
+
+    #---------------------------------------------------------------
+    def test_memory_flat(self):
+        small, large           = [self.parse(lines) for lines in FEED_LINES]
+        for result in (small, large):
+            overhead           = result["growth_kb"] - result["buffer_kb"]
+            self.assertLess(overhead, OVERHEAD_KB, "parsing a %d kB feed grew RSS by %d kB over its buffers" % (result["feed_kb"], overhead))
+        # eight times the feed, the same overhead
+        self.assertLess(abs((large["growth_kb"] - large["buffer_kb"]) - (small["growth_kb"] - small["buffer_kb"])), OVERHEAD_KB)
+        self.assertLess(large["growth_kb"], large["feed_kb"])
+
+#---------------------------------------------------------------
+class ScanTokenTest(unittest.TestCase):
+    """
+        The scan format finds the address in every token shape feeds use
+    """
+    #---------------------------------------------------------------
+    def networks(self, line):
+        return [(bits, network, prefix) for bits, network, prefix in bogon.iter_networks([line])]
+
+    #---------------------------------------------------------------
+    def test_host_port(self):
+        for line in ("1.2.3.4:8080", "proxy 1.2.3.4:3128 http", "1.2.3.4: up", "1.2.3.4"):
+            self.assertEqual(self.networks(line), [(32, 0x01020304, 32)], line)
+
+    #---------------------------------------------------------------
+    def test_ipv6(self):
+        self.assertEqual(self.networks("::ffff:1.2.3.4"), [(128, 0xFFFF01020304, 128)])
+        self.assertEqual(self.networks("[2001:db8::1]:443 2001:db8::/32"), [(128, 0x20010DB8 << 96 | 1, 128), (128, 0x20010DB8 << 96, 32)])
+
+#---------------------------------------------------------------
+def random_networks(rnd, bits, count):
+    """
+        (network, prefix) pairs of every length, clustered so that
+        they overlap, nest and touch, the top of the space included
+        every time
+    """
+    networks                   = [((1 << bits) - 1, bits)]
+    base                       = rnd.getrandbits(bits)
+    for i in xrange(count):
+        prefix                 = rnd.choice([rnd.randint(0, bits), rnd.randint(bits - 8, bits), bits])
+        address                = base ^ rnd.getrandbits(rnd.randint(1, bits)) if rnd.random() < 0.8 else rnd.getrandbits(bits)
+        networks.append((address & ~((1 << (bits - prefix)) - 1) & ((1 << bits) - 1), prefix))
+    return networks
+
+#---------------------------------------------------------------
+@unittest.skipIf(netaddr is None, "netaddr is not installed")
+class AggregateTest(unittest.TestCase):
+    """
+        The integer interval engine gives the same CIDRs as netaddr
+    """
+    #---------------------------------------------------------------
+    def check(self, bits, rnd):
+        networks               = random_networks(rnd, bits, rnd.randint(1, 200))
+        ranges                 = [(network, network | ((1 << (bits - prefix)) - 1)) for network, prefix in networks]
+        version                = 4 if bits == 32 else 6
+        expected               = [(int(net.network), net.prefixlen) for net in sorted(set(netaddr.cidr_merge(
+                                  [netaddr.IPNetwork((network, prefix), version=version) for network, prefix in networks])))]
+        self.assertEqual(bogon.get_ip_and_subnet_list(ranges, bits), expected, "IPv%d %s" % (version, networks))
+
+    #---------------------------------------------------------------
+    def test_ipv4(self):
+        rnd                    = random.Random(4)
+        for i in xrange(MERGE_ROUNDS):
+            self.check(32, rnd)
+
+    #---------------------------------------------------------------
+    def test_ipv6(self):
+        rnd                    = random.Random(6)
+        for i in xrange(MERGE_ROUNDS):
+            self.check(128, rnd)
+
+#---------------------------------------------------------------
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,431 @@
+#!/usr/bin/env python
+#
+# test_ubnt_fw_zone_gen.py - Offline tests of the ruleset optimizer, sharing,
+# incremental diff, group aggregation and flow evaluation
+#
+#   python test_ubnt_fw_zone_gen.py
+#   python -m unittest -v test_ubnt_fw_zone_gen
+#
+# -*- coding: utf-8 -*-
+
+import copy
+import os
+import random
+import shlex
+import shutil
+import subprocess as sp
+import sys
+import tempfile
+import unittest
+
+here                                                        = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, here)
+import ubnt_fw_zone_gen as zg
+
+flow_count                                                  = 4000   # random flows per verdict comparison
+ruleset_rounds                                              = 200    # random rulesets optimized per test
+group_rounds                                                = 300    # random groups aggregated per type
+
+# Addresses, ports and rules of the random rulesets stay inside one /24 and a
+# few ports so that rules overlap, nest and shadow each other a lot
+#
+net                                                         = zg.parse_address('10.0.0.0')[0]
+test_ports                                                  = ('22', '25', '53', '80', '443', '20-25', '80,443', '1000-2000')
+icmp_names                                                  = ('echo-request', 'echo-reply', 'destination-unreachable')
+
+
+def generated_commands(*options):
+    '''
+    'set' commands the script prints for the shipped policy
+    '''
+    output                                                  = sp.check_output([sys.executable, os.path.join(here, 'ubnt_fw_zone_gen.py')] + list(options),
+                                                                              stderr=open(os.devnull, 'w'))
+    return [line for line in output.splitlines() if line.startswith('set ')]
+
+
+def random_cidr(rnd):
+    '''
+    A network of the test /24, from single hosts to all of it
+    '''
+    prefix                                                  = rnd.choice((24, 25, 26, 28, 30, 32, 32))
+    return '%s/%d' % (zg.format_address(net | rnd.getrandbits(8) & ~((1 << (32 - prefix)) - 1), 32), prefix)
+
+
+def random_rule(rnd):
+    '''
+    Parameters of a rule built from the dimensions the optimizer models
+    '''
+    params                                                  = ['action %s' % rnd.choice(('accept', 'accept', 'drop', 'reject'))]
+    if rnd.random() < 0.5:
+        params.extend('state %s enable' % state for state in rnd.sample(sorted(zg.conntrack_states), rnd.randint(1, 3)))
+    protocol                                                = rnd.choice(('tcp', 'tcp', 'udp', 'tcp_udp', 'icmp', None))
+    if protocol:
+        params.append('protocol %s' % protocol)
+    if protocol in ('tcp', 'udp', 'tcp_udp') and rnd.random() < 0.7:
+        params.append('destination port %s' % rnd.choice(test_ports))
+    if protocol == 'icmp' and rnd.random() < 0.5:
+        params.append('icmp type-name %s' % rnd.choice(icmp_names))
+    for side in ('source', 'destination'):
+        if rnd.random() < 0.4:
+            params.append('%s address %s' % (side, random_cidr(rnd)))
+    if rnd.random() < 0.1:
+        params.append('log enable')
+    return params
+
+
+def ruleset_commands(name, rule_params):
+    '''
+    Commands of one ruleset with the given rules numbered 10, 20, ...
+    '''
+    commands                                                = ['set firewall name %s default-action drop' % name]
+    for i, params in enumerate(rule_params):
+        base_cmd                                            = 'set firewall name %s rule %d' % (name, (i + 1) * 10)
+        commands.append(base_cmd)
+        commands.extend('%s %s' % (base_cmd, param) for param in params)
+    return commands
+
+
+def random_packets(rnd, count):
+    '''
+    (protocol, src, dst, sport, dport, state, icmp type) packets of the test
+    /24 and ports, every connection state included
+    '''
+    ports                                                   = [22, 25, 53, 80, 443, 20, 21, 1000, 1500, 2000, 2001, 8080]
+    packets                                                 = []
+    for i in xrange(count):
+        protocol                                            = rnd.choice(('tcp', 'udp', 'icmp', 'gre'))
+        icmp_type                                           = rnd.choice((0, 3, 8)) if protocol == 'icmp' else None
+        packets.append((protocol, net | rnd.getrandbits(8), net | rnd.getrandbits(8) if rnd.random() < 0.9 else net + 256,
+                        rnd.randint(1024, 65535) if protocol in ('tcp', 'udp') else None,
+                        rnd.choice(ports) if protocol in ('tcp', 'udp') else None, rnd.choice(sorted(zg.conntrack_states)), icmp_type))
+    return packets
+
+
+def verdicts(ruleset, packets):
+    '''
+    Action of every packet in a ruleset tree
+    '''
+    index                                                   = zg.RulesetIndex('test', ruleset)
+    return [index.match(*packet)[1] for packet in packets]
+
+
+def policy_flows(tree, rnd, count):
+    '''
+    (in, out, protocol, src, dst, sport, dport, state) flows between every
+    pair of zones of a config tree, addresses and ports taken from its
+    groups and rules
+    '''
+    interfaces                                              = []
+    for zone, config in sorted(tree['zone-policy']['zone'].items()):
+        interfaces.append(sorted(config.get('interface', {})) or ['local'])
+    values                                                  = {'address': set(), 'port': set()}
+    for path in zg.leaf_paths(tree.get('firewall', {}), ()):
+        if path[-2] in ('address', 'network', 'ipv6-address', 'ipv6-network') and '!' not in path[-1]:
+            interval                                        = zg.parse_address(path[-1])
+            if interval:
+                values['address'].update(interval)
+        elif path[-2] == 'port' and path[-1].replace('-', '').replace(',', '').isdigit():
+            values['port'].update(int(port) for part in path[-1].split(',') for port in part.split('-'))
+    addresses                                               = sorted(values['address'])
+    ports                                                   = sorted(values['port']) + [1, 65535]
+    flows                                                   = []
+    for i in xrange(count):
+        src, dst                                            = [rnd.choice(addresses) + rnd.choice((-1, 0, 0, 1)) for side in (0, 1)]
+        if (src > 0xffffffff) != (dst > 0xffffffff):
+            continue
+        protocol                                            = rnd.choice(('tcp', 'udp', 'icmp', 'icmpv6', 'esp'))
+        flows.append((rnd.choice(rnd.choice(interfaces)), rnd.choice(rnd.choice(interfaces)), protocol, src, dst,
+                      rnd.randint(1, 65535) if protocol in ('tcp', 'udp') else None,
+                      rnd.choice(ports) if protocol in ('tcp', 'udp') else rnd.choice((0, 3, 8, 128)), rnd.choice(sorted(zg.conntrack_states))))
+    return flows
+
+
+def policy_actions(commands, flows):
+    '''
+    Action of every flow under the policy of the given commands
+    '''
+    evaluator                                               = zg.PolicyEvaluator(zg.build_tree(commands))
+    return [evaluator.classify(*flow)[2] for flow in flows]
+
+
+def random_profile(commands, rnd):
+    '''
+    Random "show firewall statistics" hit counts of every rule
+    '''
+    profile                                                 = {}
+    for name_param in ('name', 'ipv6-name'):
+        for set_name, ruleset in zg.build_tree(commands).get('firewall', {}).get(name_param, {}).items():
+            rows                                            = profile.setdefault(set_name, [])
+            for number, rule in ruleset.get('rule', {}).items():
+                rows.append((number, rnd.choice((0, 1, 10, 1000, 100000)), list(rule.get('action', {'': {}}))[0],
+                             list(rule.get('description', {'': {}}))[0]))
+            rows.append(('10000', rnd.choice((0, 10, 1000)), 'drop', 'DEFAULT ACTION'))
+    return profile
+
+
+def apply_commands(tree, commands):
+    '''
+    A copy of a config tree with the delete and set commands applied
+    '''
+    tree                                                    = copy.deepcopy(tree)
+    for cmd in commands:
+        tokens                                              = shlex.split(cmd)
+        node                                                = tree
+        for token in tokens[1:-1]:
+            node                                            = node.setdefault(token, {})
+        if tokens[0] == 'delete':
+            del node[tokens[-1]]
+        else:
+            node.setdefault(tokens[-1], {})
+    return tree
+
+
+def managed(tree):
+    '''
+    The parts of a config tree the script manages
+    '''
+    parts                                                   = []
+    for root in zg.managed_paths:
+        node                                                = tree
+        for key in root:
+            node                                            = node.get(key, {})
+        parts.append(node)
+    return parts
+
+
+class OptimizeTest(unittest.TestCase):
+    '''
+    Dropping shadowed rules and reordering by hits never changes a verdict
+    '''
+
+    def check(self, commands, profile=None):
+        optimized, report                                   = zg.optimize_rulesets(commands, profile)
+        before, after                                       = [zg.build_tree(cmds)['firewall']['name']['test'] for cmds in (commands, optimized)]
+        packets                                             = random_packets(random.Random(len(commands)), 300)
+        self.assertEqual(verdicts(before, packets), verdicts(after, packets), '\n'.join(commands))
+        self.assertEqual(len(before['rule']) - len(after['rule']), report['dropped'])
+        return report
+
+    def test_random_rulesets(self):
+        rnd                                                 = random.Random(23)
+        dropped                                             = 0
+        for i in xrange(ruleset_rounds):
+            commands                                        = ruleset_commands('test', [random_rule(rnd) for rule in xrange(rnd.randint(1, 25))])
+            dropped += self.check(commands)['dropped']
+        self.assertTrue(dropped, 'no rule was ever shadowed, the test proves nothing')
+
+    def test_random_profiles(self):
+        rnd                                                 = random.Random(42)
+        moved                                               = 0
+        for i in xrange(ruleset_rounds):
+            commands                                        = ruleset_commands('test', [random_rule(rnd) for rule in xrange(rnd.randint(1, 25))])
+            report                                          = self.check(commands, random_profile(commands, rnd))
+            moved += report['after'] < report['before']
+            self.assertLessEqual(report['after'], report['before'])
+        self.assertTrue(moved, 'no ruleset was ever reordered, the test proves nothing')
+
+    def test_state_split_shadowing(self):
+        commands                                            = ruleset_commands('test', [
+            ('action accept', 'state established enable', 'state related enable'),
+            ('action drop', 'state invalid enable'),
+            ('action accept', 'state new enable', 'protocol tcp', 'destination port 22'),
+            ('action accept', 'protocol tcp', 'destination port 22'),                       # covered by 10, 20 and 30 together
+            ('action drop', 'protocol tcp', 'destination port 22', 'state new enable'),     # contradicts 30
+            ('action accept', 'protocol tcp', 'destination port 80')])
+        report                                              = self.check(commands)
+        self.assertEqual(report['dropped'], 2)
+        self.assertEqual(report['contradictions'], [('name', 'test', '50', '30', 'drop', 'accept')])
+        optimized                                           = zg.build_tree(zg.optimize_rulesets(commands)[0])
+        self.assertEqual(sorted(optimized['firewall']['name']['test']['rule'], key=zg.node_order), ['10', '20', '30', '60'])
+
+    def test_invalid_drop_is_no_contradiction(self):
+        commands                                            = ruleset_commands('test', [
+            ('action drop', 'state invalid enable'),
+            ('action accept', 'protocol all', 'state new enable', 'state established enable', 'state related enable'),
+            ('action accept',)])
+        report                                              = self.check(commands)
+        self.assertEqual(report['dropped'], 1)
+        self.assertEqual(report['contradictions'], [])
+
+    def test_shipped_policy(self):
+        commands                                            = generated_commands('-u', '-k')
+        rnd                                                 = random.Random(7)
+        flows                                               = policy_flows(zg.build_tree(commands), rnd, flow_count)
+        expected                                            = policy_actions(commands, flows)
+        for profile in (None, random_profile(commands, rnd)):
+            optimized, report                               = zg.optimize_rulesets(commands, profile)
+            self.assertEqual(policy_actions(optimized, flows), expected)
+            shared, removed                                 = zg.share_rulesets(optimized)
+            self.assertTrue(removed)
+            self.assertEqual(policy_actions(shared, flows), expected)
+
+
+class ShareTest(unittest.TestCase):
+    '''
+    Zone directions with identical rulesets share one under a stable name
+    '''
+
+    def test_shared_verdicts(self):
+        commands                                            = generated_commands('-u', '-k')
+        shared, removed                                     = zg.share_rulesets(commands)
+        before, after                                       = [zg.build_tree(cmds) for cmds in (commands, shared)]
+        self.assertEqual(len(before['firewall']['name']) + len(before['firewall']['ipv6-name']) - removed,
+                         len(after['firewall']['name']) + len(after['firewall']['ipv6-name']))
+        flows                                               = policy_flows(before, random.Random(22), flow_count)
+        self.assertEqual(policy_actions(shared, flows), policy_actions(commands, flows))
+
+    def test_stable_names(self):
+        rules                                               = [('action accept', 'protocol tcp', 'destination port 22')]
+        commands                                            = ruleset_commands('b-c', rules) + ruleset_commands('a-c', rules) + [
+            'set zone-policy zone c from a firewall name a-c', 'set zone-policy zone c from b firewall name b-c']
+        shared, removed                                     = zg.share_rulesets(commands)
+        self.assertEqual(removed, 1)
+        self.assertEqual(sorted(zg.build_tree(shared)['firewall']['name']), ['shared-a-c'])
+        edited                                              = [cmd.replace('port 22', 'port 2222') for cmd in commands]
+        self.assertEqual(sorted(zg.build_tree(zg.share_rulesets(edited)[0])['firewall']['name']), ['shared-a-c'])
+
+    def test_shared_after_optimizing(self):
+        optimized, report                                   = zg.optimize_rulesets(generated_commands('-u', '-k'))
+        expected                                            = zg.build_tree(zg.share_rulesets(optimized)[0])['firewall']
+        firewall                                            = zg.build_tree(generated_commands())['firewall']
+        for name_param in ('name', 'ipv6-name'):
+            self.assertEqual(sorted(firewall[name_param]), sorted(expected[name_param]))
+
+
+class DiffTest(unittest.TestCase):
+    '''
+    Incremental apply only sets and deletes what differs
+    '''
+
+    def setUp(self):
+        self.root                                           = tempfile.mkdtemp(prefix='zone-gen-test-')
+        self.tree                                           = zg.build_tree(generated_commands())
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def write(self, name, lines):
+        filename                                            = os.path.join(self.root, name)
+        with open(filename, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        return filename
+
+    def test_identical_commands(self):
+        lines                                               = ['set ' + ' '.join(zg.quote_value(token) for token in path) for path in zg.leaf_paths(self.tree, ())]
+        lines.append('set system host-name router')                                             # outside the managed paths
+        self.assertEqual(zg.diff_commands(zg.read_config(self.write('commands.txt', lines)), self.tree), [])
+
+    def test_identical_config_boot(self):
+        lines, paths                                        = zg.render_tree(dict(self.tree, system={'host-name': {'router': {}}}))
+        self.assertEqual(zg.diff_commands(zg.read_config(self.write('config.boot', ['/* generated */'] + lines)), self.tree), [])
+
+    def test_changes(self):
+        desired                                             = copy.deepcopy(self.tree)
+        names                                               = desired['firewall']['name']
+        changed                                             = sorted(names)[0]
+        del names[sorted(names)[-1]]
+        rule                                                = names[changed]['rule'][sorted(names[changed]['rule'])[0]]
+        rule['action']                                      = {'reject': {}}
+        desired['firewall']['group']['network-group'].setdefault('test', {})['network']  = {'192.0.2.0/24': {}}
+        current                                             = dict(self.tree, system={'host-name': {'router': {}}})
+        commands                                            = zg.diff_commands(current, desired)
+        self.assertTrue(commands and len(commands) < 20, commands)
+        self.assertEqual(managed(apply_commands(current, commands)), managed(desired))
+        self.assertEqual(apply_commands(current, commands)['system'], current['system'])
+
+
+class AggregateGroupTest(unittest.TestCase):
+    '''
+    Group members are merged without covering an address more or less
+    '''
+
+    def covered(self, members):
+        addresses                                           = set()
+        for member in members:
+            first, last                                     = zg.parse_address(member)
+            addresses.update(xrange(first, last + 1))
+        return addresses
+
+    def test_network_group(self):
+        rnd                                                 = random.Random(24)
+        for i in xrange(group_rounds):
+            members                                         = [random_cidr(rnd) for member in xrange(rnd.randint(1, 12))]
+            merged, log                                     = zg.aggregate_group('network-group', 'test', members)
+            self.assertEqual(self.covered(merged), self.covered(members), members)
+            intervals                                       = sorted(zg.parse_address(member) for member in merged)
+            for a, b in zip(intervals, intervals[1:]):
+                self.assertLess(a[1], b[0], merged)                                               # no overlap
+            for member in merged:
+                self.assertEqual(zg.range_to_cidrs(*(zg.parse_address(member) + (32,))), [member if '/' in member else member + '/32'])
+            self.assertEqual(len(merged), sum(len(zg.range_to_cidrs(first, last, 32))
+                                              for first, last in zg.normalize(zg.parse_address(member) for member in members)))
+
+    def test_address_group(self):
+        rnd                                                 = random.Random(25)
+        for i in xrange(group_rounds):
+            members                                         = []
+            for member in xrange(rnd.randint(1, 12)):
+                first                                       = net | rnd.getrandbits(8)
+                last                                        = min(first + rnd.choice((0, 0, 1, 5, 40)), net | 255)
+                members.append(zg.format_address(first, 32) if first == last else '%s-%s' % (zg.format_address(first, 32), zg.format_address(last, 32)))
+            merged, log                                     = zg.aggregate_group('address-group', 'test', members)
+            self.assertEqual(self.covered(merged), self.covered(members), members)
+            intervals                                       = sorted(zg.parse_address(member) for member in merged)
+            for a, b in zip(intervals, intervals[1:]):
+                self.assertLess(a[1] + 1, b[0], merged)                                           # neither overlapping nor adjacent
+            self.assertEqual(bool(log), sorted(merged) != sorted(members))
+
+    def test_invalid_members_kept(self):
+        merged, log                                         = zg.aggregate_group('network-group', 'test', ['10.0.0.0/25', '10.0.0.128/25', 'bogus', '2001:db8::/32'])
+        self.assertEqual(merged, ['10.0.0.0/24', 'bogus', '2001:db8::/32'])
+        self.assertEqual(len(log), 3)
+        merged, log                                         = zg.aggregate_group('ipv6-network-group', 'test', ['2001:db8::/33', '2001:db8:8000::/33'])
+        self.assertEqual(merged, ['2001:db8::/32'])
+
+
+class PolicyEvaluatorTest(unittest.TestCase):
+    '''
+    Flows are placed in their zones and matched against the right ruleset
+    '''
+
+    def setUp(self):
+        self.tree                                           = zg.build_tree(ruleset_commands('int-ext', [
+            ('action accept', 'state established enable', 'state related enable'),
+            ('action accept', 'protocol tcp', 'destination port 443'),
+            ('action accept', 'protocol icmp', 'icmp type-name echo-request')]) + [
+            'set zone-policy zone ext interface eth1',
+            'set zone-policy zone ext default-action drop',
+            'set zone-policy zone ext from int firewall name int-ext',
+            'set zone-policy zone int interface eth0.5',
+            'set zone-policy zone int default-action drop',
+            'set zone-policy zone loc local-zone',
+            'set zone-policy zone loc default-action drop'])
+        self.addresses                                      = [('eth0.5', '192.168.5.1/24'), ('eth1', '203.0.113.5/24')]
+
+    def test_interfaces(self):
+        evaluator                                           = zg.PolicyEvaluator(self.tree)
+        self.assertEqual(evaluator.classify('eth0.5', 'eth1', 'tcp', '192.168.5.10', '93.184.216.34', 50000, 443), ('int-ext', '20', 'accept'))
+        self.assertEqual(evaluator.classify('eth0.5', 'eth1', 'tcp', '192.168.5.10', '93.184.216.34', 50000, 80), ('int-ext', 'default', 'drop'))
+        self.assertEqual(evaluator.classify('eth0.5', 'eth1', '6', '192.168.5.10', '93.184.216.34', 50000, 80, 'established'), ('int-ext', '10', 'accept'))
+        self.assertEqual(evaluator.classify('eth0.5', 'eth1', 'icmp', '192.168.5.10', '93.184.216.34', None, 8), ('int-ext', '30', 'accept'))
+        self.assertEqual(evaluator.classify('eth0.5', 'eth1', 'icmp', '192.168.5.10', '93.184.216.34', None, 0), ('int-ext', 'default', 'drop'))
+        self.assertEqual(evaluator.classify('eth1', 'eth0.5', 'tcp', '93.184.216.34', '192.168.5.10', 443, 50000), (None, 'zone-default', 'drop'))
+        self.assertEqual(evaluator.classify('eth0.5', 'eth9', 'tcp', '192.168.5.10', '93.184.216.34', 50000, 443), (None, 'no-zone', 'drop'))
+
+    def test_addresses(self):
+        evaluator                                           = zg.PolicyEvaluator(self.tree, self.addresses)
+        flows                                               = list(zg.read_flows([
+            'ipv4     2 tcp      6 431999 ESTABLISHED src=192.168.5.10 dst=93.184.216.34 sport=50000 dport=443 src=93.184.216.34 dst=203.0.113.5 sport=443 dport=50000 [ASSURED] mark=0 use=1',
+            'tcp      6 10 SYN_SENT src=192.168.5.10 dst=192.168.5.20 sport=50001 dport=22 [UNREPLIED] src=192.168.5.20 dst=192.168.5.10 sport=22 dport=50001 mark=0 use=1',
+            'icmp     1 29 src=8.8.8.8 dst=203.0.113.5 type=8 code=0 id=1 src=203.0.113.5 dst=8.8.8.8 type=0 code=0 id=1 mark=0 use=1']))
+        self.assertEqual([evaluator.classify(*flow) for flow in flows],
+                         [('int-ext', '20', 'accept'), (None, 'intra-zone', 'accept'), (None, 'zone-default', 'drop')])
+
+    def test_unroutable_without_addresses(self):
+        evaluator                                           = zg.PolicyEvaluator(self.tree)
+        self.assertEqual(evaluator.classify('', '', 'tcp', '192.168.5.10', '93.184.216.34', 50000, 443), (None, 'unroutable', 'unknown'))
+        self.assertEqual(evaluator.classify('eth0.5', '', 'tcp', '192.168.5.10', '93.184.216.34', 50000, 443), (None, 'unroutable', 'unknown'))
+
+
+if __name__ == '__main__':
+    unittest.main()
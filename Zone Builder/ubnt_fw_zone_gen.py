@@ -7,10 +7,17 @@
 version = '1.7.2'
 
 import argparse
+import bisect
 import itertools
+import json
+import os
 import re
+import shlex
+import socket
 import subprocess as sp
 import sys
+import tempfile
+import time
 
 # Define zones and which interfaces reside in each. The 'int' and
 # 'ext' zones are required
@@ -53,6 +60,8 @@ zones = {
 
 # Define Groups which can be used in rules
 # Note that Comcast distributes ipv6 from 'fe80::/10' - so do not add this to the bogon list
+# Address and network groups are merged into the fewest members when written,
+# every change is logged
 fw_groups = {
     'port_group': {
         'email': {
@@ -319,6 +328,35 @@ global commands
 commands         = []
 
 vyatta_cmd       = "/opt/vyatta/sbin/vyatta-cfg-cmd-wrapper"
+vyatta_op_cmd    = "/opt/vyatta/bin/vyatta-op-cmd-wrapper"
+
+# Config subtrees owned by the generator, anything else in the current
+# configuration is left alone by the incremental diff
+#
+managed_paths    = (
+    ('firewall', 'group'),
+    ('firewall', 'name'),
+    ('firewall', 'ipv6-name'),
+    ('zone-policy',),)
+
+# Rule origins, maps "firewall name int-ext rule 2000" to the indexes of
+# the entries in rules which built it
+#
+rule_origins     = {}
+
+# Connection tracking states a rule can match, every packet has one
+#
+conntrack_states = frozenset(('established', 'invalid', 'new', 'related'))
+
+# Config tree paths of tag nodes, whose children are values such as the
+# 'int-ext' of 'firewall name int-ext', rendered as "name int-ext {"
+#
+tag_nodes        = (
+    re.compile(r'^firewall (name|ipv6-name)$'),
+    re.compile(r'^firewall (name|ipv6-name) \S+ rule$'),
+    re.compile(r'^firewall group (port-group|address-group|network-group|ipv6-network-group)$'),
+    re.compile(r'^zone-policy zone$'),
+    re.compile(r'^zone-policy zone \S+ from$'),)
 
 
 # vyatta_cmd                                                = "echo" # Debug
@@ -359,6 +397,82 @@ def get_args():
         help         =
         'Sets enable-default-log option on built-in rule 10000 for each rule set. Any dropped packets unmatched by your rule set will be logged.')
 
+    parser.add_argument(
+        '-m',
+        '-mode',
+        choices      = ('merge', 'commands'),
+        default      ='merge',
+        dest         ='apply_mode',
+        help         =
+        'How -U applies the configuration: merge loads it as one config fragment in a single configure session, commands runs one vyatta-cfg-cmd-wrapper per command (default: %(default)s).')
+
+    parser.add_argument(
+        '-f',
+        '-fragment',
+        default      =None,
+        dest         ='fragment',
+        help         =
+        'Config fragment written and merged by -m merge and kept afterwards (default: a private temporary file, removed after the merge).')
+
+    parser.add_argument(
+        '-c',
+        '-current',
+        default      =None,
+        dest         ='current',
+        help         =
+        'Current configuration to diff against, "show configuration commands" output or a config.boot file, only the set/delete commands needed to reach the generated firewall are printed or applied. -U reads the running configuration when -c is not given.')
+
+    parser.add_argument(
+        '-R',
+        '-rebuild',
+        action       = "store_true",
+        default      =False,
+        dest         ='rebuild',
+        help         =
+        'Delete and rebuild the whole firewall and zone-policy instead of applying the difference.')
+
+    parser.add_argument(
+        '-u',
+        '-unshared',
+        action       = "store_true",
+        default      =False,
+        dest         ='unshared',
+        help         =
+        'Keep a ruleset for every zone direction, by default directions with identical rulesets share a single "shared-<direction>" ruleset.')
+
+    parser.add_argument(
+        '-k',
+        '-keep',
+        action       = "store_true",
+        default      =False,
+        dest         ='keep_rules',
+        help         =
+        'Keep rules shadowed by an earlier rule of the same ruleset, by default they are dropped and contradicting ones reported.')
+
+    parser.add_argument(
+        '-p',
+        '-profile',
+        default      =None,
+        dest         ='profile',
+        help         =
+        '"show firewall statistics" output, rules are reordered so the most matched ones are evaluated first wherever that cannot change the verdict.')
+
+    parser.add_argument(
+        '-e',
+        '-evaluate',
+        default      =None,
+        dest         ='flows',
+        help         =
+        'Classify flows against the generated policy instead of printing or applying it: a CSV file of "in,out,protocol,src,dst,sport,dport[,state]" rows or a "conntrack -L" dump ("-" reads stdin), the ruleset, rule and action of every flow are written as CSV.')
+
+    parser.add_argument(
+        '-A',
+        '-addresses',
+        default      =None,
+        dest         ='addresses',
+        help         =
+        'Saved "ip -o addr" output of the router, places flows without interfaces (conntrack dumps) by their addresses, without it they are reported as unroutable.')
+
     parser.add_argument(
         '-v',
         '-version',
@@ -418,9 +532,10 @@ def yesno(*args):
         else:
             sys.stdout.write("Answer must be either y or n.\n")
 
-def build_rule(source_zones, dest_zones, params, ipversions = [4, 6], rulenum=None):
+def build_rule(source_zones, dest_zones, params, ipversions = [4, 6], rulenum=None, origin=None):
     '''
-    Build a rule for each applicable zone direction and IP version
+    Build a rule for each applicable zone direction and IP version, origin
+    is the index of the entry in rules, recorded in rule_origins
     '''
     # If zones are passed as simple strings, convert to tuples
     if isinstance(source_zones, str):
@@ -455,18 +570,1043 @@ def build_rule(source_zones, dest_zones, params, ipversions = [4, 6], rulenum=No
                 set_name                                    = 'ipv6-' + ruleset
             base_cmd                                        = "set firewall %s %s rule %s" % (name_param, set_name,
                                                        ruleid)
+            if origin is not None:
+                rule_origins.setdefault(base_cmd[4:], []).append(origin)
             commands.append(base_cmd)
             for param in params:
                 commands.append(base_cmd + " " + param)
 
 
+def build_tree(commands):
+    '''
+    Nest the 'set' commands into a config tree, every node is a dict of
+    its children keyed by token
+    '''
+    tree                                                    = {}
+    for cmd in commands:
+        tokens                                              = shlex.split(cmd)
+        if not tokens or tokens[0] != 'set':
+            continue
+        node                                                = tree
+        for token in tokens[1:]:
+            node                                            = node.setdefault(token, {})
+    return tree
+
+
+def quote_value(value):
+    '''
+    Quote a config value the way config.boot does
+    '''
+    if re.match(r'^[\w.:/@+-]+$', value):
+        return value
+    return '"%s"' % value.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def is_tag(path):
+    '''
+    True if the config path is a tag node
+    '''
+    return any(tag.match(' '.join(path)) for tag in tag_nodes)
+
+
+def node_order(key):
+    '''
+    Sort key of config nodes, numbered rules in numeric order
+    '''
+    return (0, int(key), key) if key.isdigit() else (1, 0, key)
+
+
+def render_tree(tree, path=(), indent=0, lines=None, paths=None):
+    '''
+    Render a config tree in config.boot format, returns the lines and the
+    config path each line belongs to
+    '''
+    if lines is None:
+        lines, paths                                        = [], []
+    pad                                                     = '    ' * indent
+    for key in sorted(tree, key=node_order):
+        children                                            = tree[key]
+        if is_tag(path + (key,)):
+            # tag node, e.g. "name int-ext {"
+            for value in sorted(children, key=node_order):
+                lines.append('%s%s %s {' % (pad, key, quote_value(value)))
+                paths.append(path + (key, value))
+                render_tree(children[value], path + (key, value), indent + 1, lines, paths)
+                lines.append(pad + '}')
+                paths.append(path + (key, value))
+        elif not children:
+            # valueless leaf, e.g. 'local-zone'
+            lines.append(pad + key)
+            paths.append(path + (key,))
+        elif not any(children.values()):
+            # leaf, one line per value of a multi value leaf
+            for value in sorted(children, key=node_order):
+                lines.append('%s%s %s' % (pad, key, quote_value(value)))
+                paths.append(path + (key, value))
+        else:
+            lines.append('%s%s {' % (pad, key))
+            paths.append(path + (key,))
+            render_tree(children, path + (key,), indent + 1, lines, paths)
+            lines.append(pad + '}')
+            paths.append(path + (key,))
+    return lines, paths
+
+
+def share_rulesets(commands):
+    '''
+    Merge rulesets with identical rules, default action and logging into
+    one shared ruleset named after its first zone direction and point the
+    zone-policy at it, returns the rewritten commands and the number of
+    rulesets removed; the name does not change with the rules, so an edit
+    patches the shared ruleset instead of replacing it
+    '''
+    firewall                                                = build_tree(commands).get('firewall', {})
+    renames                                                 = {}
+    removed                                                 = 0
+    for name_param in ('name', 'ipv6-name'):
+        members                                             = {}
+        for set_name, ruleset in firewall.get(name_param, {}).items():
+            fingerprint                                     = json.dumps(ruleset, sort_keys=True)
+            members.setdefault(fingerprint, []).append(set_name)
+        for fingerprint, set_names in members.items():
+            if len(set_names) < 2:
+                continue
+            prefix                                          = 'ipv6-' if name_param == 'ipv6-name' else ''
+            shared                                          = prefix + 'shared-' + min(set_names)[len(prefix):]
+            for set_name in set_names:
+                renames[(name_param, set_name)]             = shared
+            removed += len(set_names) - 1
+
+    result                                                  = []
+    written                                                 = set()
+    for cmd in commands:
+        tokens                                              = shlex.split(cmd)
+        if tokens[:2] == ['set', 'firewall'] and (tuple(tokens[2:4]) in renames):
+            # keep the commands of one member, under the shared name
+            shared                                          = renames[tuple(tokens[2:4])]
+            cmd                                             = ' '.join(tokens[:3] + [shared] + [quote_value(token) for token in tokens[4:]])
+            if cmd in written:
+                continue
+            written.add(cmd)
+            origin_key                                      = ' '.join(tokens[1:6])
+            if origin_key in rule_origins and len(tokens) == 6:
+                shared_key                                  = ' '.join(tokens[1:3] + [shared] + tokens[4:6])
+                rule_origins.setdefault(shared_key, [])
+                rule_origins[shared_key].extend(origin for origin in rule_origins[origin_key]
+                                                if origin not in rule_origins[shared_key])
+        elif tokens[:2] == ['set', 'zone-policy'] and tuple(tokens[-2:]) in renames:
+            cmd                                             = ' '.join([quote_value(token) for token in tokens[:-1]] + [renames[tuple(tokens[-2:])]])
+        result.append(cmd)
+    return result, removed
+
+
+def parse_address(value):
+    '''
+    (first, last) integers of an address, CIDR or first-last range, None
+    if it cannot be parsed
+    '''
+    def to_int(address):
+        family                                              = socket.AF_INET6 if ':' in address else socket.AF_INET
+        return int(socket.inet_pton(family, address).encode('hex'), 16), 32 if family == socket.AF_INET else 128
+
+    try:
+        if '-' in value:
+            first, last                                     = value.split('-', 1)
+            return to_int(first)[0], to_int(last)[0]
+        address, _, prefix                                  = value.partition('/')
+        number, bits                                        = to_int(address)
+        size                                                = 1 << (bits - int(prefix or bits))
+        return number & ~(size - 1), (number & ~(size - 1)) + size - 1
+    except (socket.error, ValueError):
+        return None
+
+
+def format_address(number, bits):
+    '''
+    Address string of an integer address, IPv6 without the dotted quad
+    inet_ntop gives mapped addresses
+    '''
+    if bits == 32:
+        return socket.inet_ntop(socket.AF_INET, ('%08x' % number).decode('hex'))
+    hextets                                                 = ['%x' % (number >> shift & 0xffff) for shift in range(112, -16, -16)]
+    runs                                                    = [(len(list(run)), -start) for start, run in
+                                                               ((start, itertools.takewhile(lambda hextet: hextet == '0', hextets[start:]))
+                                                                for start in range(8)) if hextets[start] == '0']
+    if not runs or max(runs)[0] < 2:
+        return ':'.join(hextets)
+    length, start                                           = max(runs)
+    return ':'.join(hextets[:-start]) + '::' + ':'.join(hextets[-start + length:])
+
+
+def range_to_cidrs(first, last, bits):
+    '''
+    Fewest CIDRs covering exactly first..last
+    '''
+    cidrs                                                   = []
+    while first <= last:
+        size                                                = (first & -first).bit_length() - 1 if first else bits
+        while first + (1 << size) - 1 > last:
+            size -= 1
+        cidrs.append('%s/%d' % (format_address(first, bits), bits - size))
+        first += 1 << size
+    return cidrs
+
+
+def aggregate_group(gtype, name, members):
+    '''
+    Merge the overlapping and adjacent members of an address or network
+    group, network groups get the fewest covering CIDRs, address groups
+    single addresses and ranges; returns the members and a log line for
+    every member replaced
+    '''
+    bits                                                    = 128 if gtype == 'ipv6-network-group' else 32
+    parsed, kept, log                                       = [], [], []
+    for member in members:
+        interval                                            = parse_address(member)
+        if interval is None or (':' in member) != (bits == 128):
+            kept.append(member)
+            log.append("%s %s: keeping %s, not a valid member" % (gtype, name, member))
+        else:
+            parsed.append((interval, member))
+
+    result                                                  = []
+    for first, last in normalize(interval for interval, member in parsed):
+        if gtype == 'address-group':
+            merged                                          = [format_address(first, bits) if first == last else
+                                                               '%s-%s' % (format_address(first, bits), format_address(last, bits))]
+        else:
+            merged                                          = range_to_cidrs(first, last, bits)
+        sources                                             = [member for interval, member in parsed if first <= interval[0] and interval[1] <= last]
+        if sorted(sources) != sorted(merged):
+            log.append("%s %s: %s -> %s" % (gtype, name, ', '.join(sources), ', '.join(merged)))
+        result.extend(merged)
+    return result + kept, log
+
+
+def service_port(name):
+    '''
+    Port number of a service name, None if unknown
+    '''
+    for protocol in ('tcp', 'udp'):
+        try:
+            return socket.getservbyname(name, protocol)
+        except socket.error:
+            pass
+    return None
+
+
+def normalize(intervals):
+    '''
+    Sort and merge overlapping or adjacent (first, last) intervals
+    '''
+    merged                                                  = []
+    for first, last in sorted(intervals):
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1]                                      = (merged[-1][0], max(merged[-1][1], last))
+        else:
+            merged.append((first, last))
+    return merged
+
+
+def intersect(a, b):
+    '''
+    Intersection of two normalized interval lists
+    '''
+    result                                                  = []
+    i = j                                                   = 0
+    while i < len(a) and j < len(b):
+        first, last                                         = max(a[i][0], b[j][0]), min(a[i][1], b[j][1])
+        if first <= last:
+            result.append((first, last))
+        if a[i][1] < b[j][1]:
+            i += 1
+        else:
+            j += 1
+    return result
+
+
+def group_members(kind, name):
+    '''
+    Members of a firewall group used by a rule, None if not in fw_groups
+    '''
+    for group_key, gtype in (('port_group', 'port-group'), ('address_group', 'address-group'),
+                             ('ipv4_group', 'network-group'), ('ipv6_group', 'ipv6-network-group')):
+        if gtype == kind and name in fw_groups.get(group_key, {}):
+            group                                           = fw_groups[group_key][name]
+            return group['ports'] if group_key == 'port_group' else group['addresses']
+    return None
+
+
+def rule_match(rule):
+    '''
+    The packets a rule tree matches as a dict of dimensions, a missing
+    dimension matches everything; anything not understood is kept as an
+    ('opaque', path) dimension which only equals itself
+    '''
+    match                                                   = {}
+
+    def restrict(dim, value):
+        if dim not in match:
+            match[dim]                                      = value
+        elif dim[1] == 'port':
+            match[dim]                                      = (intersect(match[dim][0], value[0]), match[dim][1] & value[1])
+        else:
+            match[dim]                                      = intersect(match[dim], value)
+
+    def ports(values):
+        intervals, names                                    = [], set()
+        for value in values:
+            for part in value.split(','):
+                found                                       = re.match(r'^(\d+)(?:-(\d+))?$', part)
+                number                                      = None if found else service_port(part)
+                if found:
+                    intervals.append((int(found.group(1)), int(found.group(2) or found.group(1))))
+                elif number is not None:
+                    intervals.append((number, number))
+                else:
+                    names.add(part)
+        return normalize(intervals), frozenset(names)
+
+    def addresses(values):
+        intervals                                           = [parse_address(value) for value in values]
+        return None if None in intervals else normalize(intervals)
+
+    for path in leaf_paths(rule, ()):
+        head, value                                         = path[0], path[-1]
+        if head in ('description', 'action', 'log'):
+            continue
+        if '!' in value:
+            match[('opaque', path)]                         = True
+        elif head == 'state' and len(path) == 3:
+            if value == 'enable':
+                match['state']                              = match.get('state', frozenset()) | frozenset([path[1]])
+        elif head == 'protocol' and len(path) == 2:
+            if value != 'all':
+                match['protocol']                           = frozenset(value.split('_'))
+        elif head in ('source', 'destination') and len(path) == 3 and path[1] == 'address':
+            intervals                                       = addresses([value])
+            if intervals is None:
+                match[('opaque', path)]                     = True
+            else:
+                restrict((head, 'address'), intervals)
+        elif head in ('source', 'destination') and len(path) == 3 and path[1] == 'port':
+            restrict((head, 'port'), ports([value]))
+        elif head in ('source', 'destination') and len(path) == 4 and path[1] == 'group':
+            members                                         = group_members(path[2], value)
+            if members is None:
+                match[('opaque', path)]                     = True
+            elif path[2] == 'port-group':
+                restrict((head, 'port'), ports(members))
+            else:
+                intervals                                   = addresses(members)
+                if intervals is None:
+                    match[('opaque', path)]                 = True
+                else:
+                    restrict((head, 'address'), intervals)
+        else:
+            match[('opaque', path)]                         = True
+    return match
+
+
+def dim_contains(dim, outer, inner):
+    '''
+    True if the outer value of a dimension covers the inner one
+    '''
+    if dim in ('state', 'protocol'):
+        return inner <= outer
+    if dim[0] == 'opaque':
+        return True
+    if dim[1] == 'port':
+        return not inner[1] - outer[1] and intersect(outer[0], inner[0]) == inner[0]
+    return intersect(outer, inner) == inner
+
+
+def dim_overlaps(dim, a, b):
+    '''
+    True if two values of a dimension may match the same packet
+    '''
+    if dim in ('state', 'protocol'):
+        return bool(a & b)
+    if dim[0] == 'opaque':
+        return True
+    if dim[1] == 'port':
+        # unknown service names may be any port
+        return bool(intersect(a[0], b[0]) or a[1] & b[1] or (a[1] and (b[0] or b[1])) or (b[1] and a[0]))
+    return bool(intersect(a, b))
+
+
+def shadowing(earlier, inner):
+    '''
+    (state, earlier rule) pairs of the first earlier rule matching the
+    packets of inner in every connection state, None if some packet of
+    inner gets past them, so states split over several rules are covered
+    '''
+    found                                                   = []
+    for state in sorted(inner.get('state', conntrack_states)):
+        part                                                = dict(inner, state=frozenset([state]))
+        cover                                               = [number for number, match in earlier if covers(match, part)]
+        if not cover:
+            return None
+        found.append((state, cover[0]))
+    return found
+
+
+def covers(outer, inner):
+    '''
+    True if every packet matched by inner is matched by outer
+    '''
+    return all(dim in inner and dim_contains(dim, outer[dim], inner[dim]) for dim in outer)
+
+
+def overlaps(a, b):
+    '''
+    True if a packet may match both rules
+    '''
+    return all(dim_overlaps(dim, a[dim], b[dim]) for dim in a if dim in b)
+
+
+def read_profile(filename):
+    '''
+    Parse "show firewall statistics" output into ruleset -> list of
+    (rule number, packets, action, description)
+    '''
+    scale                                                   = {'': 1, 'K': 10 ** 3, 'M': 10 ** 6, 'G': 10 ** 9, 'T': 10 ** 12}
+    profile                                                 = {}
+    name                                                    = None
+    with open(filename) as f:
+        for line in f:
+            header                                          = re.match(r'^\s*IPv[46] Firewall "([^"]+)"', line)
+            if header:
+                name                                        = header.group(1)
+                profile.setdefault(name, [])
+                continue
+            row                                             = re.match(r'^\s*(\d+)\s+([\d.]+)([KMGT]?)\s+[\d.]+[KMGT]?\s+(\S+)\s*(.*?)\s*$', line)
+            if name and row:
+                packets                                     = int(float(row.group(2)) * scale[row.group(3)])
+                profile[name].append((row.group(1), packets, row.group(4).lower(), row.group(5)))
+    return profile
+
+
+def rule_hits(set_name, numbers, ruleset, profile):
+    '''
+    Packets per rule number of a ruleset and for its default action, rows
+    are matched by description and action, by rule number when the
+    description is not unique
+    '''
+    rows                                                    = profile.get(set_name, [])
+    keys                                                    = {}
+    for number in numbers:
+        rule                                                = ruleset[number]
+        key                                                 = (list(rule.get('description', {'': {}}))[0], list(rule.get('action', {'': {}}))[0])
+        keys.setdefault(key, []).append(number)
+
+    hits                                                    = dict((number, 0) for number in numbers)
+    default                                                 = 0
+    for number, packets, action, description in rows:
+        if number == '10000':
+            default += packets
+        elif len(keys.get((description, action), [])) == 1:
+            hits[keys[(description, action)][0]] += packets
+        elif number in hits:
+            hits[number] += packets
+    return hits, default
+
+
+def walk_length(order, weights, default):
+    '''
+    Total rules evaluated for the weighted matches, unmatched packets walk
+    the whole ruleset
+    '''
+    return sum(weights[number] * (position + 1) for position, number in enumerate(order)) + default * len(order)
+
+
+def required(number, before, placed):
+    '''
+    A rule and every rule not yet placed which has to come before it,
+    directly or through another such rule
+    '''
+    needed, pending                                         = set([number]), [number]
+    while pending:
+        for earlier in before[pending.pop()] - placed - needed:
+            needed.add(earlier)
+            pending.append(earlier)
+    return needed
+
+
+def optimize_rulesets(commands, profile=None):
+    '''
+    Drop the rules of every ruleset which are shadowed by an earlier rule,
+    warn when the shadowed rule has a different action, and with a hit
+    count profile move the most matched rules first where no overlapping
+    rule with another action is passed, a rule stuck behind such rules
+    moves up together with them when their average hits are the highest;
+    returns the rewritten commands and a report
+    '''
+    firewall                                                = build_tree(commands).get('firewall', {})
+    dropped                                                 = set()
+    renumbered                                              = {}
+    report                                                  = {'dropped': 0, 'contradictions': [], 'before': 0, 'after': 0, 'weight': 0}
+    for name_param in ('name', 'ipv6-name'):
+        for set_name, ruleset in sorted(firewall.get(name_param, {}).items()):
+            rules_tree                                      = ruleset.get('rule', {})
+            numbers                                         = sorted(rules_tree, key=node_order)
+            matches                                         = dict((number, rule_match(rules_tree[number])) for number in numbers)
+            effects                                         = dict((number, (list(rules_tree[number].get('action', {'': {}}))[0],
+                                                                             'log' in rules_tree[number])) for number in numbers)
+
+            kept                                            = []
+            for number in numbers:
+                shadow                                      = shadowing([(earlier, matches[earlier]) for earlier in kept], matches[number])
+                if shadow is None:
+                    kept.append(number)
+                    continue
+                dropped.add((name_param, set_name, number))
+                report['dropped'] += 1
+                # invalid packets dropped up front are no contradiction
+                conflict                                    = [earlier for state, earlier in shadow
+                                                               if state != 'invalid' and effects[earlier][0] != effects[number][0]]
+                if conflict:
+                    report['contradictions'].append((name_param, set_name, number, conflict[0], effects[number][0], effects[conflict[0]][0]))
+
+            if profile is None:
+                hits, default                               = dict((number, 1) for number in kept), 0
+            else:
+                hits, default                               = rule_hits(set_name, kept, rules_tree, profile)
+
+            order                                           = kept
+            if profile is not None:
+                # a rule may only pass earlier rules it cannot conflict with
+                before                                      = dict((number, set(earlier for earlier in kept[:i]
+                                                                            if effects[earlier] != effects[number] and overlaps(matches[earlier], matches[number])))
+                                                                   for i, number in enumerate(kept))
+                order, placed                               = [], set()
+                while len(order) < len(kept):
+                    # place the rule with the most hits per rule it has to be preceded by
+                    needed                                  = dict((number, required(number, before, placed)) for number in kept if number not in placed)
+                    best                                    = max(needed, key=lambda number: (float(sum(hits[other] for other in needed[number])) / len(needed[number]),
+                                                                                              -kept.index(number)))
+                    for number in sorted(needed[best], key=kept.index):
+                        order.append(number)
+                        placed.add(number)
+                if walk_length(order, hits, default) > walk_length(kept, hits, default):
+                    order                                   = kept
+                for old, new in zip(order, kept):
+                    if old != new:
+                        renumbered[(name_param, set_name, old)] = new
+
+            report['before'] += walk_length(numbers, dict((number, hits.get(number, 0)) for number in numbers), default)
+            report['after'] += walk_length(order, hits, default)
+            report['weight'] += sum(hits.values()) + default
+
+    result                                                  = []
+    origins                                                 = {}
+    for cmd in commands:
+        tokens                                              = shlex.split(cmd)
+        if tokens[:2] == ['set', 'firewall'] and len(tokens) > 5 and tokens[4] == 'rule':
+            key                                             = (tokens[2], tokens[3], tokens[5])
+            if key in dropped:
+                continue
+            if key in renumbered:
+                tokens[5]                                   = renumbered[key]
+                cmd                                         = ' '.join(tokens[:6] + [quote_value(token) for token in tokens[6:]])
+                if len(tokens) == 6:
+                    origins[' '.join(tokens[1:6])]          = rule_origins.get(' '.join(tokens[1:5] + [key[2]]), [])
+        result.append(cmd)
+    rule_origins.update(origins)
+    return result, report
+
+
+# ICMP type names used by 'icmp type-name' and 'icmpv6 type'
+#
+icmp_types       = {
+    'echo-reply': 0, 'pong': 0, 'destination-unreachable': 3, 'source-quench': 4, 'redirect': 5,
+    'echo-request': 8, 'ping': 8, 'router-advertisement': 9, 'router-solicitation': 10,
+    'time-exceeded': 11, 'parameter-problem': 12, 'timestamp-request': 13, 'timestamp-reply': 14}
+icmpv6_types     = {
+    'destination-unreachable': 1, 'packet-too-big': 2, 'time-exceeded': 3, 'parameter-problem': 4,
+    'echo-request': 128, 'ping': 128, 'echo-reply': 129, 'pong': 129, 'router-solicitation': 133,
+    'router-advertisement': 134, 'neighbor-solicitation': 135, 'neighbour-solicitation': 135,
+    'neighbor-advertisement': 136, 'neighbour-advertisement': 136, 'redirect': 137}
+protocol_numbers = {'1': 'icmp', '6': 'tcp', '17': 'udp', '47': 'gre', '50': 'esp', '51': 'ah', '58': 'icmpv6'}
+
+
+class RulesetIndex(object):
+    '''
+    One ruleset compiled into per dimension lookup tables, every lookup
+    gives the bitmask of the rules accepting the value (bit i for the i-th
+    rule) and a packet matches the lowest bit set in all of them
+    '''
+
+    def __init__(self, name, ruleset):
+        self.name                                           = name
+        self.numbers                                        = sorted(ruleset.get('rule', {}), key=node_order)
+        self.actions                                        = [list(ruleset['rule'][number].get('action', {'': {}}))[0] for number in self.numbers]
+        self.default_action                                 = list(ruleset.get('default-action', {'drop': {}}))[0]
+        self.skipped                                        = []
+        matches                                             = [rule_match(ruleset['rule'][number]) for number in self.numbers]
+
+        everything                                          = (1 << len(self.numbers)) - 1
+        for i, match in enumerate(matches):
+            unsupported                                     = [' '.join(dim[1]) for dim in match if dim[0] == 'opaque' and dim[1][0] not in ('icmp', 'icmpv6')]
+            unsupported.extend('port %s' % name for dim in match if dim in (('source', 'port'), ('destination', 'port'))
+                               for name in sorted(match[dim][1]))
+            if unsupported:
+                # cannot be decided offline, the rule never matches
+                self.skipped.append((self.numbers[i], ', '.join(unsupported)))
+                everything &= ~(1 << i)
+
+        self.protocols                                      = self.value_table(matches, 'protocol', everything)
+        self.states                                         = self.value_table(matches, 'state', everything)
+        self.icmp_types                                     = self.icmp_table(matches, everything)
+        self.addresses                                      = [self.interval_table(matches, (side, 'address'), everything) for side in ('source', 'destination')]
+        self.ports                                          = [self.interval_table(matches, (side, 'port'), everything) for side in ('source', 'destination')]
+        self.cache                                          = [{}, {}]
+
+    def value_table(self, matches, dim, everything):
+        '''
+        value -> mask of a set valued dimension, None -> rules without it
+        '''
+        table                                               = {None: everything}
+        for i, match in enumerate(matches):
+            if dim in match:
+                table[None] &= ~(1 << i)
+        for i, match in enumerate(matches):
+            for value in match.get(dim, ()):
+                table.setdefault(value, table[None])
+                table[value] |= (1 << i) & everything
+        return table
+
+    def icmp_table(self, matches, everything):
+        '''
+        ICMP type -> mask, None -> rules without a type
+        '''
+        typed                                               = {}
+        for i, match in enumerate(matches):
+            for dim in match:
+                if dim[0] == 'opaque' and dim[1][0] in ('icmp', 'icmpv6'):
+                    names                                   = icmp_types if dim[1][0] == 'icmp' else icmpv6_types
+                    value                                   = dim[1][-1].split('/')[0]
+                    typed[i]                                = int(value) if value.isdigit() else names.get(value, -1)
+        table                                               = {None: everything & ~sum(1 << i for i in typed)}
+        for i, value in typed.items():
+            table.setdefault(value, table[None])
+            table[value] |= (1 << i) & everything
+        return table
+
+    def interval_table(self, matches, dim, everything):
+        '''
+        (boundaries, masks) of an interval dimension, masks[k] holds the
+        rules matching boundaries[k] up to the next boundary
+        '''
+        free                                                = everything
+        toggles                                             = {0: 0}
+        for i, match in enumerate(matches):
+            if dim not in match:
+                continue
+            free &= ~(1 << i)
+            intervals                                       = match[dim][0] if dim[1] == 'port' else match[dim]
+            for first, last in intervals:
+                toggles[first]                              = toggles.get(first, 0) ^ (1 << i)
+                toggles[last + 1]                           = toggles.get(last + 1, 0) ^ (1 << i)
+        boundaries, masks, mask                             = [], [], 0
+        for point in sorted(toggles):
+            mask ^= toggles[point]
+            boundaries.append(point)
+            masks.append((mask & everything) | free)
+        return boundaries, masks, free
+
+    def interval_mask(self, table, value):
+        '''
+        Mask of the rules matching value in an interval dimension
+        '''
+        boundaries, masks, free                             = table
+        if value is None:
+            return free
+        return masks[bisect.bisect_right(boundaries, value) - 1]
+
+    def match(self, protocol, src, dst, sport, dport, state, icmp_type):
+        '''
+        (rule number, action) of the first matching rule, ('default',
+        default action) when none matches
+        '''
+        mask                                                = self.protocols.get(protocol, self.protocols[None])
+        mask &= self.states.get(state, self.states[None])
+        if protocol in ('icmp', 'icmpv6'):
+            mask &= self.icmp_types.get(icmp_type, self.icmp_types[None])
+        else:
+            mask &= self.icmp_types[None]
+        for side, address in ((0, src), (1, dst)):
+            if mask:
+                cached                                      = self.cache[side].get(address)
+                if cached is None:
+                    cached = self.cache[side][address]      = self.interval_mask(self.addresses[side], address)
+                mask &= cached
+        if mask and protocol in ('tcp', 'udp'):
+            mask &= self.interval_mask(self.ports[0], sport) & self.interval_mask(self.ports[1], dport)
+        elif mask:
+            mask &= self.ports[0][2] & self.ports[1][2]
+        if not mask:
+            return 'default', self.default_action
+        i                                                   = (mask & -mask).bit_length() - 1
+        return self.numbers[i], self.actions[i]
+
+
+class PolicyEvaluator(object):
+    '''
+    Classify flows against the generated zone policy without a router
+    '''
+
+    def __init__(self, tree, addresses=None):
+        firewall                                            = tree.get('firewall', {})
+        self.rulesets                                       = {}
+        for name_param in ('name', 'ipv6-name'):
+            for name, ruleset in firewall.get(name_param, {}).items():
+                self.rulesets[(name_param, name)]           = RulesetIndex(name, ruleset)
+
+        self.zones                                          = {}
+        self.interfaces                                     = {}
+        self.local_zone                                     = None
+        for zone, config in tree.get('zone-policy', {}).get('zone', {}).items():
+            self.zones[zone]                                = config
+            for interface in config.get('interface', {}):
+                self.interfaces[interface]                  = zone
+            if 'local-zone' in config:
+                self.local_zone                             = zone
+
+        # interface addresses, to place flows which do not name interfaces;
+        # without them nothing is routed, not even to the default route
+        self.local                                          = set()
+        self.networks                                       = []
+        self.default_interface                              = (list(zones.get('ext', {}).get('interfaces', ())) or [None])[0] if addresses else None
+        for interface, address in addresses or ():
+            interval                                        = parse_address(address)
+            if interval is None:
+                continue
+            self.local.add(parse_address(address.split('/')[0])[0])
+            self.networks.append((interval[1] - interval[0], interval[0], interval[1], interface))
+        self.networks.sort()
+        self.route_cache                                    = {}
+        self.address_cache                                  = {}
+
+    def skipped(self):
+        '''
+        (ruleset, rule, reason) of the rules which cannot be evaluated
+        '''
+        return [(index.name, number, reason) for key, index in sorted(self.rulesets.items()) for number, reason in index.skipped]
+
+    def address(self, text):
+        '''
+        Integer of an address string, flows repeat the same hosts a lot
+        '''
+        number                                              = self.address_cache.get(text)
+        if number is None:
+            number = self.address_cache[text]               = parse_address(text)[0]
+        return number
+
+    def route(self, address):
+        '''
+        Interface of an address, 'local' for the router's own addresses,
+        None when there is no address map to route it by
+        '''
+        if address in self.route_cache:
+            return self.route_cache[address]
+        if address in self.local:
+            interface                                       = 'local'
+        else:
+            interface                                       = next((network[3] for network in self.networks if network[1] <= address <= network[2]),
+                                                                   self.default_interface)
+        self.route_cache[address]                           = interface
+        return interface
+
+    def zone_of(self, interface):
+        '''
+        Zone of an interface, the local zone for the router itself
+        '''
+        if interface in ('local', 'lo', '-'):
+            return self.local_zone
+        return self.interfaces.get(interface)
+
+    def classify(self, in_interface, out_interface, protocol, src, dst, sport=None, dport=None, state='new'):
+        '''
+        (ruleset, rule, action) a flow is handled by, addresses are strings
+        or integers, empty interfaces are looked up from the addresses;
+        for ICMP dport holds the ICMP type
+        '''
+        protocol                                            = protocol_numbers.get(str(protocol).lower(), str(protocol).lower())
+        ipv6                                                = ':' in src if isinstance(src, str) else src > 0xffffffff
+        if isinstance(src, str):
+            src                                             = self.address(src)
+        if isinstance(dst, str):
+            dst                                             = self.address(dst)
+        in_interface                                        = in_interface or self.route(src)
+        out_interface                                       = out_interface or self.route(dst)
+        if in_interface is None or out_interface is None:
+            return None, 'unroutable', 'unknown'
+        src_zone                                            = self.zone_of(in_interface)
+        dst_zone                                            = self.zone_of(out_interface)
+
+        if src_zone is None or dst_zone is None:
+            return None, 'no-zone', 'drop'
+        if src_zone == dst_zone:
+            return None, 'intra-zone', 'accept'
+        name_param                                          = 'ipv6-name' if ipv6 else 'name'
+        binding                                             = self.zones[dst_zone].get('from', {}).get(src_zone, {}).get('firewall', {}).get(name_param)
+        if not binding:
+            return None, 'zone-default', list(self.zones[dst_zone].get('default-action', {'drop': {}}))[0]
+        index                                               = self.rulesets.get((name_param, list(binding)[0]))
+        if index is None:
+            return list(binding)[0], 'missing', 'drop'
+        icmp_type                                           = int(dport) if protocol in ('icmp', 'icmpv6') and dport not in (None, '') else None
+        rule, action                                        = index.match(protocol, src, dst,
+                                                                          int(sport) if sport not in (None, '') else None,
+                                                                          int(dport) if dport not in (None, '') else None,
+                                                                          state or 'new', icmp_type)
+        return index.name, rule, action
+
+
+def read_addresses(filename):
+    '''
+    (interface, address/prefix) pairs of saved "ip -o addr" output
+    '''
+    addresses                                               = []
+    with open(filename) as f:
+        for line in f:
+            found                                           = re.match(r'^\d+:\s+(\S+?)(?:@\S+)?\s+inet6?\s+(\S+)', line)
+            if found:
+                addresses.append((found.group(1), found.group(2)))
+    return addresses
+
+
+def read_flows(lines):
+    '''
+    Yield (in interface, out interface, protocol, src, dst, sport, dport,
+    state) from CSV lines "in,out,protocol,src,dst,sport,dport[,state]"
+    or from "conntrack -L" / /proc/net/nf_conntrack lines, which are
+    classified as the new connection that created them
+    '''
+    conntrack                                               = re.compile(r'^(?:ipv[46]\s+\d+\s+)?([a-z0-9]+)\s+\d+\s+(?:\d+\s+)?(?:[A-Z_]+\s+)?'
+                                                                         r'src=(\S+) dst=(\S+)(?: sport=(\d+) dport=(\d+)| type=(\d+) code=\d+)?')
+    for line in lines:
+        line                                                = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        found                                               = conntrack.match(line)
+        if found:
+            protocol, src, dst, sport, dport, icmp_type     = found.groups()
+            yield '', '', protocol, src, dst, sport, dport or icmp_type, 'new'
+            continue
+        fields                                              = [field.strip() for field in line.split(',')]
+        if len(fields) < 7 or fields[3] == 'src':
+            continue                                        # header or malformed
+        yield tuple(fields[:7]) + ((fields[7] if len(fields) > 7 and fields[7] else 'new'),)
+
+
+def evaluate_flows(evaluator, lines, out):
+    '''
+    Classify every flow, write it with its ruleset, rule and action as CSV
+    and return the counts per (ruleset, rule, action)
+    '''
+    counts                                                  = {}
+    out.write('in,out,protocol,src,dst,sport,dport,state,ruleset,rule,action\n')
+    for flow in read_flows(lines):
+        try:
+            result                                          = evaluator.classify(*flow)
+        except (TypeError, ValueError):
+            result                                          = (None, 'invalid', '')
+        counts[result]                                      = counts.get(result, 0) + 1
+        out.write('%s,%s,%s,%s\n' % (','.join(str(field or '') for field in flow), result[0] or '', result[1], result[2]))
+    return counts
+
+
+def parse_config_boot(text):
+    '''
+    Parse a config.boot file into a config tree
+    '''
+    tree                                                    = {}
+    stack                                                   = [tree]
+    text                                                    = re.sub(r'/\*.*?\*/', '', text, flags=re.S)
+    for line in text.splitlines():
+        tokens                                              = shlex.split(line)
+        if not tokens:
+            continue
+        if tokens == ['}']:
+            stack.pop()
+            continue
+        node                                                = stack[-1]
+        opens                                               = tokens[-1] == '{'
+        if opens:
+            tokens                                          = tokens[:-1]
+        for token in tokens:
+            node                                            = node.setdefault(token, {})
+        if opens:
+            stack.append(node)
+    return tree
+
+
+def read_config(source):
+    '''
+    Read the current configuration from a "show configuration commands"
+    output or config.boot file, or the running configuration when source
+    is None, returns a config tree
+    '''
+    if source is None:
+        text                                                = sp.check_output([vyatta_op_cmd, 'show', 'configuration', 'commands'])
+    elif source == '-':
+        text                                                = sys.stdin.read()
+    else:
+        with open(source) as f:
+            text                                            = f.read()
+
+    if re.search(r'^set ', text, re.M):
+        return build_tree(text.splitlines())
+    return parse_config_boot(text)
+
+
+def leaf_paths(tree, path):
+    '''
+    Yield the path of every leaf below path
+    '''
+    if not tree:
+        yield path
+    for key in sorted(tree, key=node_order):
+        for leaf in leaf_paths(tree[key], path + (key,)):
+            yield leaf
+
+
+def diff_tree(current, desired, path=()):
+    '''
+    Yield the ('delete', path) and ('set', path) steps turning the current
+    config tree into the desired one, removed subtrees are deleted at
+    their top node
+    '''
+    for key in sorted(current, key=node_order):
+        if key not in desired:
+            yield 'delete', path + (key,)
+    for key in sorted(desired, key=node_order):
+        if key not in current:
+            for leaf in leaf_paths(desired[key], path + (key,)):
+                yield 'set', leaf
+        elif current[key] != desired[key]:
+            for step in diff_tree(current[key], desired[key], path + (key,)):
+                yield step
+
+
+def diff_commands(current, desired):
+    '''
+    The delete and set commands which turn the managed part of the
+    current configuration into the desired one, deletes first
+    '''
+    steps                                                   = []
+    for root in managed_paths:
+        subtrees                                            = []
+        for tree in (current, desired):
+            for key in root:
+                tree                                        = tree.get(key, {})
+            subtrees.append(tree)
+        if subtrees[0] and not subtrees[1]:
+            steps.append(('delete', root))
+        else:
+            steps.extend(diff_tree(subtrees[0], subtrees[1], root))
+
+    return (['delete ' + ' '.join(quote_value(token) for token in path) for action, path in steps if action == 'delete'] +
+            ['set ' + ' '.join(quote_value(token) for token in path) for action, path in steps if action == 'set'])
+
+
+def run_session(cmds):
+    '''
+    Run the commands through vyatta-cfg-cmd-wrapper in one bash process,
+    so they share a single configure session, echoing them to stdout
+    '''
+    vyatta_shell                                            = sp.Popen(
+        'bash',
+        shell=True,
+        stdin                                               = sp.PIPE,
+        stdout=sp.PIPE,
+        stderr                                              = sp.PIPE)
+    for cmd in cmds:  # print to stdout
+        print cmd
+        vyatta_shell.stdin.write('{} {};\n'.format(vyatta_cmd, cmd))
+
+    out, err                                                = vyatta_shell.communicate()
+    return vyatta_shell.returncode, out, err
+
+
+def rule_errors(output, paths):
+    '''
+    Map the configure error messages back to the entries in rules which
+    produced the offending config, paths holds the config path of every
+    line of a merged fragment; returns a list of messages
+    '''
+    messages                                                = []
+    context                                                 = None
+    for line in output.splitlines():
+        line                                                = line.strip()
+        if not line:
+            context                                         = None
+            continue
+        # commit errors are reported below a '[ firewall name ... ]' banner
+        banner                                              = re.match(r'^\[ (.*) \]$', line)
+        if banner:
+            context                                         = banner.group(1)
+            continue
+        if not re.search(r'error|invalid|failed|not valid', line, re.I):
+            continue
+        found                                               = re.search(r'firewall (?:name|ipv6-name) \S+ rule \d+', line)
+        where                                               = found.group(0) if found else context
+        # merge errors name the fragment line
+        at_line                                             = re.search(r'\bline (\d+)', line)
+        if not found and at_line and 0 < int(at_line.group(1)) <= len(paths):
+            where                                           = ' '.join(paths[int(at_line.group(1)) - 1])
+        if not where:
+            continue
+        rule                                                = re.search(r'firewall (?:name|ipv6-name) \S+ rule \d+', where)
+        origins                                             = rule_origins.get(rule.group(0), []) if rule else []
+        for origin in origins:
+            description                                     = [param for param in rules[origin][2] if param.startswith('description')]
+            messages.append('rules[%d] %s: [ %s ] %s' % (origin, description[0] if description else '', where, line))
+        if not origins:
+            messages.append('[ %s ] %s' % (where, line))
+    return messages
+
+
+def merge_config(commands, fragment):
+    '''
+    Write the 'set' commands as one config fragment and load it with a
+    single merge in one configure session, the 'delete' commands run first
+    in the same session and everything is committed once; without a
+    fragment name a private temporary file is used and removed
+    '''
+    lines, paths                                            = render_tree(build_tree(commands))
+    temporary                                               = not fragment
+    if temporary:
+        # mkstemp never follows a planted symlink or clobbers another run
+        fd, fragment                                        = tempfile.mkstemp(prefix='ubnt_fw_zone_gen.', suffix='.config')
+        f                                                   = os.fdopen(fd, 'w')
+    else:
+        f                                                   = open(fragment, 'w')
+    try:
+        with f:
+            f.write('\n'.join(lines) + '\n')
+
+        session                                             = ['begin']
+        session.extend(cmd for cmd in commands if cmd.startswith('delete '))
+        session.extend(['merge %s' % fragment, 'commit', 'save', 'end'])
+        returncode, out, err                                = run_session(session)
+    finally:
+        if temporary:
+            os.remove(fragment)
+    return returncode, out, err, rule_errors(out + '\n' + err, paths)
+
+
 if __name__ == '__main__':
     get_args()
 
-    commands.append("delete firewall group")
-    commands.append("delete firewall name")
-    commands.append("delete firewall ipv6-name")
-    commands.append("delete zone-policy")
+    incremental                                             = not user_opts.rebuild and (user_opts.current or user_opts.update_config_boot)
+    if not incremental:
+        commands.append("delete firewall group")
+        commands.append("delete firewall name")
+        commands.append("delete firewall ipv6-name")
+        commands.append("delete zone-policy")
 
     for a in all_groups:
         for case in switch(a):
@@ -498,7 +1638,13 @@ if __name__ == '__main__':
             commands.append("set firewall group %s %s description '%s'" %
                             (gtype, b, fw_groups[a][b]['description']))
 
-            for c in fw_groups[a][b][dkey]:
+            members                                         = fw_groups[a][b][dkey]
+            if dkey == 'addresses':
+                members, log                                = aggregate_group(gtype, b, members)
+                for line in log:
+                    sys.stderr.write(line + '\n')
+
+            for c in members:
                 commands.append(
                     "set firewall group %s %s %s %s" % (gtype, b, gtarget, c))
 
@@ -518,8 +1664,8 @@ if __name__ == '__main__':
                             (prefix, prefix, src, dest))
 
     # Add rules
-    for rule in rules:
-        build_rule(*rule)
+    for origin, rule in enumerate(rules):
+        build_rule(*rule, origin=origin)
 
     # Create zones
     for zone in all_zones:
@@ -558,25 +1704,75 @@ if __name__ == '__main__':
             result.append(item)
     commands = result
 
+    if not user_opts.keep_rules:
+        profile                                             = None
+        if user_opts.profile:
+            try:
+                profile                                     = read_profile(user_opts.profile)
+            except IOError as error:
+                sys.exit("Cannot read the rule profile: %s" % error)
+        commands, report                                    = optimize_rulesets(commands, profile)
+        contradictions                                      = {}                    # one warning for the directions sharing it
+        for name_param, set_name, number, shadow, action, shadow_action in report['contradictions']:
+            origins                                         = tuple(rule_origins.get('firewall %s %s rule %s' % (name_param, set_name, number), []))
+            contradictions.setdefault((number, action, shadow, shadow_action, origins), []).append(set_name)
+        for (number, action, shadow, shadow_action, origins), set_names in sorted(contradictions.items()):
+            sys.stderr.write("Warning: %s rule %s (%s) never matches, rule %s %ss the same packets first%s\n" %
+                             (', '.join(set_names), number, action, shadow, shadow_action, ' [rules %s]' % ', '.join(str(origin) for origin in origins) if origins else ''))
+        if report['weight']:
+            sys.stderr.write("Optimized rulesets: %d shadowed rules dropped, average rule walk %.2f -> %.2f\n" %
+                             (report['dropped'], float(report['before']) / report['weight'], float(report['after']) / report['weight']))
+
+    # rulesets may only become identical once shadowed rules are dropped
+    if not user_opts.unshared:
+        generated                                           = len(commands)
+        commands, removed                                   = share_rulesets(commands)
+        if removed:
+            sys.stderr.write("Shared identical rulesets: %d rulesets and %d commands fewer\n" % (removed, generated - len(commands)))
+
+    if user_opts.flows:
+        try:
+            evaluator                                       = PolicyEvaluator(build_tree(commands), read_addresses(user_opts.addresses) if user_opts.addresses else None)
+            flows                                           = sys.stdin if user_opts.flows == '-' else open(user_opts.flows)
+        except IOError as error:
+            sys.exit("Cannot read flows: %s" % error)
+        for set_name, number, reason in evaluator.skipped():
+            sys.stderr.write("Warning: %s rule %s is never matched offline (%s)\n" % (set_name, number, reason))
+        if not user_opts.addresses:
+            sys.stderr.write("Warning: no -A address map, flows without interfaces are reported as unroutable\n")
+        started                                             = time.time()
+        counts                                              = evaluate_flows(evaluator, flows, sys.stdout)
+        seconds                                             = time.time() - started
+        total                                               = sum(counts.values())
+        sys.stderr.write("%d flows classified in %.1f seconds (%d flows/s)\n" % (total, seconds, total / seconds if seconds else 0))
+        for (set_name, rule, action), count in sorted(counts.items(), key=lambda item: -item[1]):
+            sys.stderr.write("%10d  %-24s %-12s %s\n" % (count, set_name or '-', rule, action))
+        sys.exit(0)
+
+    if incremental:
+        try:
+            current                                         = read_config(user_opts.current)
+        except (IOError, OSError, sp.CalledProcessError, ValueError) as error:
+            sys.exit("Cannot read the current configuration: %s" % error)
+        generated                                           = len(commands)
+        commands                                            = diff_commands(current, build_tree(commands))
+        sys.stderr.write("%d of %d generated commands needed to update the current configuration\n" % (len(commands), generated))
+        if not commands:
+            print "Zone firewall configuration is up to date."
+            sys.exit(0)
+
     if user_opts.update_config_boot and yesno(
             'y', 'OK to update your configuration?'):  # Open a pipe to bash and iterate commands
 
-        commands[:0]                                        = ["begin"]
-        commands.append("commit")
-        commands.append("save")
-        commands.append("end")
-
-        vyatta_shell                                        = sp.Popen(
-            'bash',
-            shell=True,
-            stdin                                           = sp.PIPE,
-            stdout=sp.PIPE,
-            stderr                                          = sp.PIPE)
-        for cmd in commands:  # print to stdout
-            print cmd
-            vyatta_shell.stdin.write('{} {};\n'.format(vyatta_cmd, cmd))
-
-        out, err                                            = vyatta_shell.communicate()
+        if user_opts.apply_mode == 'merge':
+            returncode, out, err, messages                  = merge_config(commands, user_opts.fragment)
+        else:
+            commands[:0]                                    = ["begin"]
+            commands.append("commit")
+            commands.append("save")
+            commands.append("end")
+            returncode, out, err                            = run_session(commands)
+            messages                                        = rule_errors(out + '\n' + err, [])
 
         cfg_error                                           = False
         if out:
@@ -588,7 +1784,12 @@ if __name__ == '__main__':
             cfg_error                                       = True
             print "Error reported by configure:"
             print err
-        if (vyatta_shell.returncode == 0) and not cfg_error:
+        if messages:
+            cfg_error                                       = True
+            print "Errors by rule:"
+            for message in messages:
+                print message
+        if (returncode == 0) and not cfg_error:
             print "Zone firewall configuration was successful."
         else:
             print "Zone firewall configuration was NOT successful!"